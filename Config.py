@@ -1,199 +1,699 @@
+import atexit
 import configparser
 import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
 from datetime import datetime
 
 import ftputil
 import pymysql
 from ftputil.error import FTPOSError
 
+from Metrics import registry
 
-class __DatabaseManager:
-    def __init__(self):
+
+class MysqlPool:
+    # 进程内共享的 MySQL 连接池，按连接参数区分；连接空闲超过 check_idle 秒后借出前先 ping，超过 idle_timeout 秒直接关闭
+    # fork 出的子进程不复用父进程的连接，首次使用时重新建池
+    # tuning.ini 中 Database.backend 为 sqlite 时改为连接本地 SQLite 文件(用于基准测试与无 MySQL 的环境)
+    _pools = {}
+    _pools_lock = threading.Lock()
+    _pid = None
+    # 已建表的库，启动时建一次即可，子进程继承该标记
+    _schema_ready = set()
+    # tuning.ini 中的连接池设置，每个进程首次 get 时读取一次，之后 get 只是一次字典查找
+    _settings = None
+
+    def __init__(self, host, port, user, passwd, database=None, max_size=8, timeout=30, idle_timeout=300,
+                 check_idle=30, backend='mysql', sqlite_path=None):
+        self.backend = backend
+        self.sqlite_path = sqlite_path
+        self.host = host
+        self.port = port
+        self.user = user
+        self.passwd = passwd
+        self.database = database
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.check_idle = check_idle
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.size = 0
+        self.connects = 0
+        self.reconnects = 0
+
+    @classmethod
+    def _load_settings(cls):
+        tune = TuneInfo()
+        return {'backend': tune.get('Database', 'backend'), 'sqlite_path': tune.get('Database', 'sqlite_path'),
+                'max_size': tune.getint('MysqlPool', 'max_size'), 'timeout': tune.getint('MysqlPool', 'timeout'),
+                'idle_timeout': tune.getint('MysqlPool', 'idle_timeout'),
+                'check_idle': tune.getint('MysqlPool', 'check_idle')}
+
+    @classmethod
+    def get(cls, mysqlinfo, db_name=None):
+        with cls._pools_lock:
+            if cls._pid != os.getpid():
+                cls._pools = {}
+                cls._pid = os.getpid()
+            if cls._settings is None:
+                cls._settings = cls._load_settings()
+            settings = cls._settings
+            if settings['backend'] == 'sqlite':
+                key = (settings['backend'], settings['sqlite_path'])
+            else:
+                key = (mysqlinfo.host, mysqlinfo.port, mysqlinfo.user, mysqlinfo.passwd, db_name)
+            pool = cls._pools.get(key)
+            if pool is None:
+                pool = cls._pools[key] = cls(mysqlinfo.host, mysqlinfo.port, mysqlinfo.user, mysqlinfo.passwd,
+                                             db_name, settings['max_size'], settings['timeout'],
+                                             settings['idle_timeout'], settings['check_idle'],
+                                             settings['backend'], settings['sqlite_path'])
+            return pool
+
+    def _open(self):
+        if self.backend == 'sqlite':
+            conn = _SqliteConnection(self.sqlite_path, self.timeout)
+            self.connects += 1
+            return conn
+        try:
+            conn = pymysql.connect(
+                host=self.host,
+                port=self.port,
+                user=self.user,
+                password=self.passwd,
+                database=self.database,
+                autocommit=True
+            )
+        except pymysql.Error as e:
+            registry().inc('db.pool.connect_errors', database=self.database)
+            raise Exception(f"Error connecting to MySQL: {e}")
+        self.connects += 1
+        registry().inc('db.pool.connects', database=self.database)
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except (pymysql.Error, Exception):
+            pass
+        with self.lock:
+            self.size -= 1
+
+    def _usable(self, conn, last_used):
+        idle = time.time() - last_used
+        if idle > self.idle_timeout:
+            return False
+        if idle < self.check_idle:
+            return True
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except (pymysql.Error, Exception):
+            return False
+
+    def acquire(self, block=True):
+        while True:
+            try:
+                conn, last_used = self.idle.get_nowait()
+            except queue.Empty:
+                with self.lock:
+                    can_open = self.size < self.max_size
+                    if can_open:
+                        self.size += 1
+                if can_open:
+                    try:
+                        return self._open()
+                    except Exception:
+                        with self.lock:
+                            self.size -= 1
+                        raise
+                try:
+                    conn, last_used = self.idle.get(block, self.timeout)
+                except queue.Empty:
+                    raise Exception('Timeout waiting for MySQL connection')
+            if self._usable(conn, last_used):
+                return conn
+            self._discard(conn)
+            self.reconnects += 1
+
+    def release(self, conn, broken=False):
+        if broken or not conn.open:
+            self._discard(conn)
+        else:
+            self.idle.put((conn, time.time()))
+
+    def connection(self):
+        return _PooledConnection(self)
+
+    def cursor(self):
+        return _PooledCursor(self)
+
+    def close(self):
+        while True:
+            try:
+                conn, _ = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+    def ensure_schema(self):
+        schema_key = self.sqlite_path if self.backend == 'sqlite' else self.database
+        if schema_key in self._schema_ready:
+            return
+        with self.cursor() as cursor:
+            for ddl in SQLITE_SCHEMA if self.backend == 'sqlite' else SCHEMA:
+                cursor.execute(ddl)
+        self._schema_ready.add(schema_key)
+
+    def stats(self):
+        return {'size': self.size, 'idle': self.idle.qsize(), 'connects': self.connects,
+                'reconnects': self.reconnects}
+
+
+class _PooledConnection:
+    def __init__(self, pool):
+        self.pool = pool
         self.conn = None
-        self.cursor = None
 
     def __enter__(self):
-        return self
+        self.conn = self.pool.acquire()
+        return self.conn
 
     def __exit__(self, exc_type, exc_val, traceback):
-        if self.cursor:
-            self.cursor.close()
-        if self.conn:
-            if exc_type:
-                self.conn.rollback()
-            else:
-                self.conn.commit()
-            self.conn.close()
-        self.closedb = True
+        # 连接级错误后不再复用该连接
+        self.pool.release(self.conn, broken=exc_type is not None and issubclass(
+            exc_type, (pymysql.OperationalError, pymysql.InterfaceError)))
+
 
-    def __del__(self):
+class _PooledCursor(_PooledConnection):
+    def __init__(self, pool):
+        super().__init__(pool)
+        self.cursor = None
+
+    def __enter__(self):
+        self.cursor = super().__enter__().cursor()
+        return self.cursor
+
+    def __exit__(self, exc_type, exc_val, traceback):
         try:
-            if not self.closedb:
-                if self.cursor:
-                    self.cursor.close()
-                if self.conn:
-                    self.conn.close()
-                self.closedb = True
+            self.cursor.close()
         except (pymysql.Error, Exception):
             pass
+        super().__exit__(exc_type, exc_val, traceback)
 
 
-class DownLog(__DatabaseManager):
+# 程序启动时建表一次，之后的 DownLog/ErrorLog 不再执行 DDL
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS downlog ("
+    "id INT PRIMARY KEY AUTO_INCREMENT, "
+    "ftp_name VARCHAR(255) NOT NULL, "
+    "filepath VARCHAR(255) NOT NULL, "
+    "log_time DATETIME NOT NULL, "
+    "INDEX filepath_index (filepath), "
+    "INDEX ftp_name_index (ftp_name))",
+    "CREATE TABLE IF NOT EXISTS ErrorLog ("
+    "id INTEGER PRIMARY KEY AUTO_INCREMENT, "
+    "log_time DATETIME NOT NULL, "
+    "from_class VARCHAR(255) NOT NULL, "
+    "from_func VARCHAR(255) NOT NULL, "
+    "error_text TEXT NOT NULL, "
+    "INDEX log_time_index (log_time))",
+)
+
+# 解析结果表(由 MroLoader.BulkLoader 写入)，唯一键保证失败批次重放、任务被回收后重新解析时不会产生重复数据
+# mro_cell_kpi 按 XML 逐小区保存，同一 bundle 的 XML 可能由不同解析进程处理，bundle 级汇总按 (ftp_name, main_zip) 查询
+MEASUREMENT_TABLES = {
+    'mro_measurement': ("CREATE TABLE IF NOT EXISTS mro_measurement ("
+                        "xml_key CHAR(40) NOT NULL, "
+                        "row_no INT NOT NULL, "
+                        "enb_id INT NOT NULL, "
+                        "cell_id INT NOT NULL, "
+                        "time_stamp VARCHAR(32) NOT NULL, "
+                        "v_index SMALLINT NOT NULL, "
+                        "sc_rsrp SMALLINT NULL, "
+                        "sc_rsrq SMALLINT NULL, "
+                        "nc_earfcn INT NULL, "
+                        "nc_pci SMALLINT NULL, "
+                        "nc_rsrp SMALLINT NULL, "
+                        "nc_rsrq SMALLINT NULL, "
+                        "PRIMARY KEY (xml_key, row_no), "
+                        "INDEX cell_index (enb_id, cell_id))"),
+    'mro_cell_kpi': ("CREATE TABLE IF NOT EXISTS mro_cell_kpi ("
+                     "xml_key CHAR(40) NOT NULL, "
+                     "ftp_name VARCHAR(255) NOT NULL, "
+                     "main_zip VARCHAR(255) NOT NULL, "
+                     "enb_id INT NOT NULL, "
+                     "cell_id INT NOT NULL, "
+                     "samples BIGINT NOT NULL, "
+                     "nc_rows BIGINT NOT NULL, "
+                     "rsrp_avg DOUBLE NOT NULL, "
+                     "rsrq_avg DOUBLE NOT NULL, "
+                     "rsrp_p5 SMALLINT NOT NULL, "
+                     "rsrp_p50 SMALLINT NOT NULL, "
+                     "rsrp_p95 SMALLINT NOT NULL, "
+                     "coverage_rate DOUBLE NOT NULL, "
+                     "overlap_rate DOUBLE NOT NULL, "
+                     "uptime DATETIME NOT NULL, "
+                     "PRIMARY KEY (xml_key, enb_id, cell_id), "
+                     "INDEX bundle_index (ftp_name, main_zip), "
+                     "INDEX cell_index (enb_id, cell_id))"),
+}
+SCHEMA += tuple(MEASUREMENT_TABLES.values())
+
+SQLITE_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS downlog ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+    "ftp_name TEXT NOT NULL, "
+    "filepath TEXT NOT NULL, "
+    "log_time TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS filepath_index ON downlog (filepath)",
+    "CREATE INDEX IF NOT EXISTS ftp_name_index ON downlog (ftp_name)",
+    "CREATE TABLE IF NOT EXISTS ErrorLog ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+    "log_time TEXT NOT NULL, "
+    "from_class TEXT NOT NULL, "
+    "from_func TEXT NOT NULL,"
+    "error_text TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS log_time_index ON ErrorLog (log_time)",
+    # SQLite 不支持建表语句中的 INDEX 子句，索引单独创建
+    MEASUREMENT_TABLES['mro_measurement'].replace(", INDEX cell_index (enb_id, cell_id))", ")"),
+    "CREATE INDEX IF NOT EXISTS measurement_cell_index ON mro_measurement (enb_id, cell_id)",
+    MEASUREMENT_TABLES['mro_cell_kpi'].replace(
+        ", INDEX bundle_index (ftp_name, main_zip), INDEX cell_index (enb_id, cell_id))", ")"),
+    "CREATE INDEX IF NOT EXISTS kpi_bundle_index ON mro_cell_kpi (ftp_name, main_zip)",
+    "CREATE INDEX IF NOT EXISTS kpi_cell_index ON mro_cell_kpi (enb_id, cell_id)",
+)
+
+
+def _sqlite_error(e):
+    # 转换为对应的 pymysql 异常，DownLog/ErrorLog 的异常处理无需区分后端
+    if isinstance(e, sqlite3.IntegrityError):
+        return pymysql.IntegrityError(str(e))
+    if isinstance(e, sqlite3.OperationalError):
+        return pymysql.OperationalError(str(e))
+    return pymysql.Error(str(e))
+
+
+class _SqliteCursor:
+    # pymysql 风格的 %s 占位符转换为 sqlite3 的 ?
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, args=None):
+        try:
+            return self.cursor.execute(sql.replace('%s', '?'), tuple(args or ()))
+        except sqlite3.Error as e:
+            raise _sqlite_error(e)
+
+    def executemany(self, sql, args):
+        try:
+            return self.cursor.executemany(sql.replace('%s', '?'), [tuple(a) for a in args])
+        except sqlite3.Error as e:
+            raise _sqlite_error(e)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return tuple(self.cursor.fetchall())
+
+    def close(self):
+        self.cursor.close()
+
+
+class _SqliteConnection:
+    # 与 pymysql 连接相同的最小接口，autocommit 模式
+    def __init__(self, path, timeout=30):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.open = True
+
+    def cursor(self):
+        return _SqliteCursor(self.conn.cursor())
+
+    def ping(self, reconnect=False):
+        try:
+            self.conn.execute('SELECT 1')
+        except sqlite3.Error as e:
+            raise _sqlite_error(e)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.open = False
+        self.conn.close()
+
+
+def init_schema(mysqlinfo=None):
+    mysqlinfo = mysqlinfo or MysqlInfo(section='LocalServer')
+    MysqlPool.get(mysqlinfo, 'mroparse').ensure_schema()
+
+
+class __DatabaseManager:
+    # 连接从 MysqlPool 借用，每次操作结束即归还，对象本身不持有连接
     def __init__(self):
+        self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        pass
+
+
+class DownLog(__DatabaseManager):
+    # 进程内已下载文件缓存: OrderedDict((ftp_name, filepath) -> None)，各数据源共用，总数不超过 cache_size，按 LRU 淘汰
+    _known_files = OrderedDict()
+    _known_lock = threading.Lock()
+
+    def __init__(self, ftpinfo=None):
         super().__init__()
         self.mysqlinfo = MysqlInfo(section='LocalServer')
-        self.ftpinfo = FTPInfo()
+        # 多个数据源共用 downlog 表，按 ftp_name 区分
+        self.ftpinfo = ftpinfo or FTPInfo()
+        self.tune = TuneInfo()
+        self.chunk_size = self.tune.getint('DownLog', 'chunk_size')
+        self.cache_size = self.tune.getint('DownLog', 'cache_size')
         self.mysqlinfo.db_name = 'mroparse'
         self.mysqlinfo.tb_name = "downlog"
-        self._connect()
-        self.closedb = False
         self.errlog = ErrorLog('DownLog')
+        self.pool = MysqlPool.get(self.mysqlinfo, self.mysqlinfo.db_name)
+        self.pool.ensure_schema()
 
-    def _connect(self):
+    def isexists(self, filepath):
+        if self._cache_get([filepath]):
+            return True
         try:
-            self.conn = pymysql.connect(
-                host=self.mysqlinfo.host,
-                port=self.mysqlinfo.port,
-                user=self.mysqlinfo.user,
-                password=self.mysqlinfo.passwd,
-                database=self.mysqlinfo.db_name,
-                autocommit=True
-            )
-            self.cursor = self.conn.cursor()
-            self._create_table()
+            with registry().timer('db.downlog.seconds', op='isexists'), self.pool.cursor() as cursor:
+                cursor.execute(f"SELECT * FROM {self.mysqlinfo.tb_name} WHERE ftp_name = %s AND filepath = %s",
+                               (self.ftpinfo.ftp_name, filepath))
+                result = cursor.fetchone()
+            if result:
+                self._cache_add([filepath])
+            return bool(result) if result else False
         except pymysql.Error as e:
-            self.cursor = None
-            self.conn = None
-            self.errlog.add_error('_connect', f"Error connecting to MySQL: {e}")
-            raise f"Error connecting to MySQL: {e}"
+            self.errlog.add_error('isexists', f"check file isexists: {filepath}; error:{e}")
+            return False
 
-    def _create_table(self):
-        # 判断数据表是否存在，不存在则创建
-        try:
-            self.cursor.execute(
-                f"SELECT table_name FROM information_schema.tables WHERE table_name='{self.mysqlinfo.tb_name}'")
-            if not self.cursor.fetchone():
-                self.cursor.execute(f"CREATE TABLE {self.mysqlinfo.tb_name} ("
-                                    f"id INT PRIMARY KEY AUTO_INCREMENT, "
-                                    f"ftp_name VARCHAR(255) NOT NULL, "
-                                    f"filepath VARCHAR(255) NOT NULL, "
-                                    f"log_time DATETIME NOT NULL)")
-
-                self.cursor.execute(f"CREATE INDEX filepath_index ON {self.mysqlinfo.tb_name} (filepath)")
-                self.cursor.execute(f"CREATE INDEX ftp_name_index ON {self.mysqlinfo.tb_name} (ftp_name)")
-                self.conn.commit()
+    def _cache_get(self, filepaths):
+        if self.cache_size <= 0:
+            return set()
+        ftp_name = self.ftpinfo.ftp_name
+        with self._known_lock:
+            cache = self._known_files
+            if not cache:
+                return set()
+            hits = set()
+            for filepath in filepaths:
+                key = (ftp_name, filepath)
+                if key in cache:
+                    cache.move_to_end(key)
+                    hits.add(filepath)
+            return hits
 
-        except pymysql.Error as e:
-            self.errlog.add_error('_create_table', f"Error creating table: {e}")
-            raise f"Error creating table: {e}"
+    def _cache_add(self, filepaths):
+        if self.cache_size <= 0:
+            return
+        ftp_name = self.ftpinfo.ftp_name
+        with self._known_lock:
+            cache = self._known_files
+            for filepath in filepaths:
+                key = (ftp_name, filepath)
+                cache[key] = None
+                cache.move_to_end(key)
+            while len(cache) > self.cache_size:
+                cache.popitem(last=False)
 
-    def isexists(self, filepath):
-        if not self.cursor:
-            self._connect()
+    @classmethod
+    def cache_clear(cls, ftp_name=None):
+        with cls._known_lock:
+            if ftp_name is None:
+                cls._known_files.clear()
+            else:
+                for key in [key for key in cls._known_files if key[0] == ftp_name]:
+                    del cls._known_files[key]
 
+    def exists_many(self, filepaths):
+        # 批量判断文件是否已下载，返回已存在的文件集合；先查缓存，未命中的按 chunk_size 分批 IN 查询
+        filepaths = list(dict.fromkeys(filepaths))
+        found = self._cache_get(filepaths)
+        pending = [f for f in filepaths if f not in found]
+        registry().inc('downlog.cache_hits', len(found))
+        registry().inc('downlog.cache_misses', len(pending))
+        if not pending:
+            return found
         try:
-            self.cursor.execute(f"SELECT * FROM {self.mysqlinfo.tb_name} WHERE ftp_name = %s AND filepath = %s",
-                                (self.ftpinfo.ftp_name, filepath))
-            result = self.cursor.fetchone()
-            return bool(result) if result else False
+            with registry().timer('db.downlog.seconds', op='exists_many'), self.pool.cursor() as cursor:
+                for i in range(0, len(pending), self.chunk_size):
+                    chunk = pending[i:i + self.chunk_size]
+                    cursor.execute(
+                        f"SELECT filepath FROM {self.mysqlinfo.tb_name} WHERE ftp_name = %s AND filepath IN "
+                        f"({', '.join(['%s'] * len(chunk))})",
+                        (self.ftpinfo.ftp_name, *chunk))
+                    rows = {row[0] for row in cursor.fetchall()}
+                    self._cache_add(rows)
+                    found.update(rows)
         except pymysql.Error as e:
-            self.errlog.add_error('isexists', f"check file isexists: {filepath}; error:{e}")
-            return False
+            self.errlog.add_error('exists_many', f"check {len(filepaths)} files isexists; error:{e}")
+            raise
+        return found
+
+    def filter_new(self, filepaths):
+        filepaths = list(filepaths)
+        found = self.exists_many(filepaths)
+        return [f for f in filepaths if f not in found]
 
     def savelog(self, filepath):
-        if not self.cursor:
-            self._connect()
         now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         try:
-            self.cursor.execute(
-                f"INSERT INTO {self.mysqlinfo.tb_name} (ftp_name, filepath, log_time) VALUES (%s, %s, %s)",
-                (self.ftpinfo.ftp_name, filepath, now))
+            with registry().timer('db.downlog.seconds', op='savelog'), self.pool.cursor() as cursor:
+                cursor.execute(
+                    f"INSERT INTO {self.mysqlinfo.tb_name} (ftp_name, filepath, log_time) VALUES (%s, %s, %s)",
+                    (self.ftpinfo.ftp_name, filepath, now))
         except pymysql.IntegrityError:
             return True
         except pymysql.Error as e:
             self.errlog.add_error('savelog', f"Error savelog file{filepath}; error: {e}")
             return False
+        self._cache_add([filepath])
+        return True
+
+    def savelog_many(self, filepaths):
+        # 批量写入下载记录，已存在的记录会被跳过
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            new_files = self.filter_new(filepaths)
+            if not new_files:
+                return True
+            with registry().timer('db.downlog.seconds', op='savelog_many'), self.pool.cursor() as cursor:
+                for i in range(0, len(new_files), self.chunk_size):
+                    chunk = new_files[i:i + self.chunk_size]
+                    cursor.executemany(
+                        f"INSERT INTO {self.mysqlinfo.tb_name} (ftp_name, filepath, log_time) VALUES (%s, %s, %s)",
+                        [(self.ftpinfo.ftp_name, filepath, now) for filepath in chunk])
+                    self._cache_add(chunk)
+        except pymysql.Error as e:
+            self.errlog.add_error('savelog_many', f"Error savelog {len(filepaths)} files; error: {e}")
+            return False
         return True
 
     def dellog_by_time(self, time=None):
-        if not self.cursor:
-            self._connect()
         if time is None:
             time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         try:
-            self.cursor.execute(f"DELETE FROM {self.mysqlinfo.tb_name} WHERE log_time < %s", (time,))
+            with registry().timer('db.downlog.seconds', op='dellog_by_time'), self.pool.cursor() as cursor:
+                cursor.execute(f"DELETE FROM {self.mysqlinfo.tb_name} WHERE log_time < %s", (time,))
         except pymysql.Error as e:
             self.errlog.add_error('dellog_by_time', f"Error dellog: {e}")
             return False
+        self.cache_clear()
         return True
 
 
+class _ErrorSink:
+    # 进程内的错误日志缓冲: add 只写入定长环形缓冲区，后台线程按批写入 MySQL
+    # 数据库不可用时整批写入本地文件，恢复后随下一批一起补写；缓冲区满时丢弃最旧的记录
+    _sink = None
+    _sink_lock = threading.Lock()
+
+    def __init__(self, pool):
+        tune = TuneInfo()
+        self.pool = pool
+        self.pid = os.getpid()
+        self.capacity = tune.getint('ErrorLog', 'buffer_size')
+        self.batch_size = tune.getint('ErrorLog', 'batch_size')
+        self.flush_interval = tune.getfloat('ErrorLog', 'flush_interval')
+        self.fallback_path = tune.get('ErrorLog', 'fallback_path')
+        self.buffer = deque()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.idle = threading.Event()
+        self.idle.set()
+        self.added = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.fallback = 0
+        self.replayed = 0
+        self.thread = threading.Thread(target=self._run, name='ErrorLogWriter', daemon=True)
+        self.thread.start()
+        atexit.register(self.flush, 5)
+
+    @classmethod
+    def get(cls, pool):
+        with cls._sink_lock:
+            # fork 出的子进程没有父进程的写入线程，需要重新创建
+            if cls._sink is None or cls._sink.pid != os.getpid():
+                cls._sink = cls(pool)
+            return cls._sink
+
+    def add(self, record):
+        with self.lock:
+            if len(self.buffer) >= self.capacity:
+                self.buffer.popleft()
+                self.dropped += 1
+            self.buffer.append(record)
+            self.added += 1
+            self.idle.clear()
+            full = len(self.buffer) >= self.batch_size
+        if full:
+            self.wakeup.set()
+
+    def _take(self):
+        with self.lock:
+            batch = [self.buffer.popleft() for _ in range(min(self.batch_size, len(self.buffer)))]
+            if not batch:
+                self.idle.set()
+            registry().set('errorlog.buffered', len(self.buffer))
+            return batch
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            while True:
+                batch = self._take()
+                if not batch:
+                    break
+                self._write(batch)
+
+    def _insert(self, rows):
+        self.pool.ensure_schema()
+        with self.pool.cursor() as cursor:
+            cursor.executemany(
+                "INSERT INTO ErrorLog (log_time, from_class, from_func, error_text) VALUES (%s, %s, %s, %s)", rows)
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+    @staticmethod
+    def _unescape(value):
+        return re.sub(r'\\(.)', lambda m: {'n': '\n', 't': '\t'}.get(m.group(1), m.group(1)), value)
+
+    def _write_fallback(self, rows):
+        try:
+            os.makedirs(os.path.dirname(self.fallback_path) or '.', exist_ok=True)
+            with open(self.fallback_path, 'a', encoding='utf-8') as f:
+                for record in rows:
+                    f.write('\t'.join(self._escape(v) for v in record) + '\n')
+            return True
+        except OSError:
+            return False
+
+    def _write(self, batch):
+        try:
+            self._insert(batch)
+            self.flushed += len(batch)
+            registry().inc('errorlog.flushed', len(batch))
+        except (pymysql.Error, Exception):
+            if self._write_fallback(batch):
+                self.fallback += len(batch)
+                registry().inc('errorlog.fallback', len(batch))
+            else:
+                self.dropped += len(batch)
+            return
+        self._replay_fallback()
+
+    def _replay_fallback(self):
+        if not os.path.exists(self.fallback_path):
+            return
+        replay_path = f"{self.fallback_path}.{os.getpid()}.replay"
+        try:
+            os.replace(self.fallback_path, replay_path)
+            with open(replay_path, encoding='utf-8') as f:
+                rows = [tuple(self._unescape(v) for v in line.rstrip('\n').split('\t')) for line in f if line.strip()]
+        except OSError:
+            return
+        done = 0
+        try:
+            for done in range(0, len(rows), self.batch_size):
+                self._insert(rows[done:done + self.batch_size])
+                self.replayed += len(rows[done:done + self.batch_size])
+            done = len(rows)
+        except (pymysql.Error, Exception):
+            pass
+        # 数据库再次不可用时，剩余记录写回文件留到下次补写
+        if done < len(rows) and not self._write_fallback(rows[done:]):
+            return
+        os.remove(replay_path)
+
+    def flush(self, timeout=None):
+        # 等待缓冲区清空，返回是否在超时前完成
+        self.wakeup.set()
+        return self.idle.wait(timeout)
+
+    def stats(self):
+        with self.lock:
+            return {'buffered': len(self.buffer), 'added': self.added, 'flushed': self.flushed,
+                    'dropped': self.dropped, 'fallback': self.fallback, 'replayed': self.replayed}
+
+
 class ErrorLog:
+    # add_error 只把记录放入缓冲区即返回，不等待数据库写入，也不会因数据库异常而抛出
     def __init__(self, class_name=None):
         self.class_name = class_name
         self.mysql_info = MysqlInfo()
         self.mysql_info.db_name = 'mroparse'
-        self._connect()
-        self.closedb = False
-
-    def _connect(self):
-        try:
-            self.conn = pymysql.connect(
-                host=self.mysql_info.host,
-                port=self.mysql_info.port,
-                user=self.mysql_info.user,
-                password=self.mysql_info.passwd,
-                database=self.mysql_info.db_name
-            )
-            self.cursor = self.conn.cursor()
-            self._create_table()
-        except pymysql.Error as e:
-            self.cursor = None
-            self.conn = None
-            raise Exception(f"Error connecting to MySQL: {e}")
-
-    def _create_table(self):
-        try:
-            self.cursor.execute("CREATE TABLE IF NOT EXISTS ErrorLog ("
-                                "id INTEGER PRIMARY KEY AUTO_INCREMENT, "
-                                "log_time DATETIME NOT NULL, "
-                                "from_class VARCHAR(255) NOT NULL, "
-                                "from_func VARCHAR(255) NOT NULL,"
-                                "error_text TEXT NOT NULL)")
-            self.conn.commit()
-            try:
-                self.cursor.execute("""
-                            CREATE INDEX log_time_index ON ErrorLog (log_time);
-                        """)
-                self.conn.commit()
-            except pymysql.Error:
-                pass
-        except pymysql.Error as e:
-            raise Exception(f"Error creating table: {e}")
+        self.pool = MysqlPool.get(self.mysql_info, self.mysql_info.db_name)
+        self.sink = _ErrorSink.get(self.pool)
 
     def add_error(self, from_func, error_text):
-        from_class = self.class_name
         now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        try:
-            self.cursor.execute(
-                "INSERT INTO ErrorLog (log_time, from_class, from_func, error_text) VALUES (%s, %s, %s, %s)",
-                (now, from_class, from_func, str(error_text).replace("'", "‘")))
-            self.conn.commit()
-        except pymysql.Error as e:
-            raise Exception(f"Error adding error record: {e}")
+        self.sink.add((now, self.class_name or '', from_func, str(error_text).replace("'", "‘")))
+
+    def flush(self, timeout=None):
+        return self.sink.flush(timeout)
+
+    @staticmethod
+    def stats():
+        sink = _ErrorSink._sink
+        return sink.stats() if sink is not None else {}
 
     def delete_errors_before(self, start_time, end_time):
         try:
-            self.cursor.execute("DELETE FROM ErrorLog WHERE log_time >= %s AND log_time <= %s", (start_time, end_time))
-            self.conn.commit()
+            with self.pool.cursor() as cursor:
+                cursor.execute("DELETE FROM ErrorLog WHERE log_time >= %s AND log_time <= %s",
+                               (start_time, end_time))
         except pymysql.Error as e:
             raise Exception(f"Error deleting error records before time: {e}")
 
     def query_errors_by_time(self, start_time, end_time):
         try:
-            self.cursor.execute("SELECT * FROM ErrorLog WHERE log_time >= %s AND log_time <= %s",
-                                (start_time, end_time))
-            results = self.cursor.fetchall()
+            with self.pool.cursor() as cursor:
+                cursor.execute("SELECT * FROM ErrorLog WHERE log_time >= %s AND log_time <= %s",
+                               (start_time, end_time))
+                results = cursor.fetchall()
             return results
         except pymysql.Error as e:
             raise Exception(f"Error querying error records by time: {e}")
@@ -262,14 +762,9 @@ class MysqlInfo:
 
     def check(self):
         try:
-            conn = pymysql.connect(
-                host=self.host,
-                port=self.port,
-                user=self.user,
-                password=self.passwd,
-                database=self.db_name
-            )
-            conn.close()
+            # 检查通过的连接留在池中，后续直接复用
+            with MysqlPool.get(self, self.db_name).connection() as conn:
+                conn.ping(reconnect=False)
             return True
         except (pymysql.Error, Exception) as e:
             return False
@@ -277,14 +772,17 @@ class MysqlInfo:
 
 
 class FTPInfo:
-    def __init__(self, cfg_path=os.path.join(os.getcwd(), 'configure', 'ftpinfo.ini')):
+    # ftpinfo.ini 中每个节对应一个 FTP 数据源，默认节为 [FTPInfo]；pool_size 为该数据源的连接数上限，0 表示使用全局配置
+    # time_shift 为服务器 LIST 时间与 UTC 之差(秒)，sync 表示连接后测量，为空表示未知
+    def __init__(self, cfg_path=os.path.join(os.getcwd(), 'configure', 'ftpinfo.ini'), section='FTPInfo'):
         self.__cfg_path = cfg_path
         os.makedirs(os.path.dirname(cfg_path), exist_ok=True)
         self.__config = configparser.ConfigParser()
+        self.section = section
         self.errorlog = ErrorLog('FTPInfo')
         try:
             if not os.path.exists(cfg_path):
-                self.__config['FTPInfo'] = {
+                self.__config[self.section] = {
                     'ftp_name': '',
                     'host': '',
                     'port': -1,
@@ -297,43 +795,59 @@ class FTPInfo:
                 with open(cfg_path, 'w') as f:
                     self.__config.write(f)
             self.__config.read(cfg_path)
-            self.ftp_name = self.__config.get('FTPInfo', 'ftp_name')
-            self.host = self.__config.get('FTPInfo', 'host')
-            self.port = int(self.__config.get('FTPInfo', 'port'))
-            self.user = self.__config.get('FTPInfo', 'user')
-            self.passwd = self.__config.get('FTPInfo', 'passwd')
-            self.sync_path = self.__config.get('FTPInfo', 'sync_path')
-            self.down_path = self.__config.get('FTPInfo', 'down_path')
-            self.scan_filter = self.__config.get('FTPInfo', 'scan_filter')
+            self.ftp_name = self.__config.get(self.section, 'ftp_name')
+            self.host = self.__config.get(self.section, 'host')
+            self.port = int(self.__config.get(self.section, 'port'))
+            self.user = self.__config.get(self.section, 'user')
+            self.passwd = self.__config.get(self.section, 'passwd')
+            self.sync_path = self.__config.get(self.section, 'sync_path')
+            self.down_path = self.__config.get(self.section, 'down_path')
+            self.scan_filter = self.__config.get(self.section, 'scan_filter')
+            self.pool_size = self.__config.getint(self.section, 'pool_size', fallback=0)
+            self.time_shift = self.__config.get(self.section, 'time_shift', fallback='')
         except (configparser.Error, Exception) as e:
             self.errorlog.add_error('init', e)
 
+    @staticmethod
+    def sections(cfg_path=os.path.join(os.getcwd(), 'configure', 'ftpinfo.ini')):
+        config = configparser.ConfigParser()
+        config.read(cfg_path)
+        return config.sections() or ['FTPInfo']
+
     def update(self, ftp_name=None, host=None, port=None, user=None, passwd=None, sync_path=None, down_path=None,
-               scan_filter=None):
+               scan_filter=None, pool_size=None, time_shift=None):
+        if not self.__config.has_section(self.section):
+            self.__config.add_section(self.section)
         if ftp_name is not None:
-            self.__config.set('FTPInfo', 'ftp_name', ftp_name)
+            self.__config.set(self.section, 'ftp_name', ftp_name)
             self.ftp_name = ftp_name
         if host is not None:
-            self.__config.set('FTPInfo', 'host', host)
+            self.__config.set(self.section, 'host', host)
             self.host = host
         if port is not None:
-            self.__config.set('FTPInfo', 'port', str(port))
+            self.__config.set(self.section, 'port', str(port))
             self.port = int(port)
         if user is not None:
-            self.__config.set('FTPInfo', 'user', user)
+            self.__config.set(self.section, 'user', user)
             self.user = user
         if passwd is not None:
-            self.__config.set('FTPInfo', 'passwd', passwd)
+            self.__config.set(self.section, 'passwd', passwd)
             self.passwd = passwd
         if sync_path is not None:
-            self.__config.set('FTPInfo', 'sync_path', sync_path)
+            self.__config.set(self.section, 'sync_path', sync_path)
             self.sync_path = sync_path
         if down_path is not None:
-            self.__config.set('FTPInfo', 'down_path', down_path)
+            self.__config.set(self.section, 'down_path', down_path)
             self.down_path = down_path
         if scan_filter is not None:
-            self.__config.set('FTPInfo', 'scan_filter', scan_filter)
+            self.__config.set(self.section, 'scan_filter', scan_filter)
             self.scan_filter = scan_filter
+        if pool_size is not None:
+            self.__config.set(self.section, 'pool_size', str(pool_size))
+            self.pool_size = int(pool_size)
+        if time_shift is not None:
+            self.__config.set(self.section, 'time_shift', str(time_shift))
+            self.time_shift = str(time_shift)
         try:
             with open(self.__cfg_path, 'w') as f:
                 self.__config.write(f)
@@ -345,14 +859,16 @@ class FTPInfo:
     def read(self):
         try:
             self.__config.read(self.__cfg_path)
-            self.ftp_name = self.__config.get('FTPInfo', 'ftp_name')
-            self.host = self.__config.get('FTPInfo', 'host')
-            self.port = int(self.__config.get('FTPInfo', 'port'))
-            self.user = self.__config.get('FTPInfo', 'user')
-            self.passwd = self.__config.get('FTPInfo', 'passwd')
-            self.sync_path = self.__config.get('FTPInfo', 'sync_path')
-            self.down_path = self.__config.get('FTPInfo', 'down_path')
-            self.scan_filter = self.__config.get('FTPInfo', 'scan_filter')
+            self.ftp_name = self.__config.get(self.section, 'ftp_name')
+            self.host = self.__config.get(self.section, 'host')
+            self.port = int(self.__config.get(self.section, 'port'))
+            self.user = self.__config.get(self.section, 'user')
+            self.passwd = self.__config.get(self.section, 'passwd')
+            self.sync_path = self.__config.get(self.section, 'sync_path')
+            self.down_path = self.__config.get(self.section, 'down_path')
+            self.scan_filter = self.__config.get(self.section, 'scan_filter')
+            self.pool_size = self.__config.getint(self.section, 'pool_size', fallback=0)
+            self.time_shift = self.__config.get(self.section, 'time_shift', fallback='')
         except (configparser.Error, ValueError) as e:
             self.errorlog.add_error('read', e)
             return False
@@ -365,3 +881,170 @@ class FTPInfo:
             self.errorlog.add_error('check', e)
             return False
         return True
+
+
+class TuneInfo:
+    # 性能相关参数，缺失的配置项会以默认值写回配置文件
+    DEFAULTS = {
+        'Scan': {
+            'scan_mode': 'incremental',
+            'manifest_path': './database/manifest',
+            'full_scan_every': '60',
+            'stat_cache_size': '100000',
+            'stable_scans': '2',
+            'stable_age': '300',
+            'mtime_precision': '120'
+        },
+        'DownLog': {
+            'chunk_size': '1000',
+            'cache_size': '1000000'
+        },
+        'Download': {
+            'workers': '4',
+            'pool_size': '4',
+            'pool_timeout': '60',
+            'check_idle': '30',
+            'memory_max': '0',
+            'memory_budget': str(512 * 1024 * 1024),
+            'persist': '1',
+            'retries': '2',
+            'checksum': ''
+        },
+        'Zip': {
+            'spool_threshold': str(64 * 1024 * 1024),
+            'spool_dir': '',
+            'cache_bytes': str(256 * 1024 * 1024),
+            'workers': '0',
+            'parallel_bytes': str(256 * 1024 * 1024)
+        },
+        'Loader': {
+            'mode': 'insert',
+            'batch_size': '5000',
+            'commit_interval': '10',
+            'max_retries': '3',
+            'spool_dir': ''
+        },
+        'Parse': {
+            'workers': '0',
+            'claim_size': '8',
+            'idle_sleep': '5',
+            'batch_size': '65536',
+            'columnar_dir': '',
+            'lease': '600',
+            'checkpoint_interval': '5',
+            'reclaim_interval': '60',
+            'restart_backoff_max': '60',
+            'restart_stable': '60'
+        },
+        'Pipeline': {
+            'download_queue': '100',
+            'index_queue': '16',
+            'register_queue': '16',
+            'index_workers': '2',
+            'parse_queue': '4',
+            'parse_workers': '1',
+            'min_free_mb': '10240',
+            'max_parse_backlog': '200000',
+            'backlog_check': '10',
+            'download_lease': '3600'
+        },
+        'Scheduler': {
+            'policy': 'freshness',
+            'sla': '3600',
+            'size_weight': '1',
+            'large_size': str(256 * 1024 * 1024),
+            'large_slots': '0',
+            'starvation': '1800'
+        },
+        'Control': {
+            'enabled': '1',
+            'auto': '0',
+            'interval': '10',
+            'download_min': '1',
+            'download_max': '8',
+            'parse_min': '1',
+            'parse_max': '0',
+            'scan_interval': '60',
+            'interval_min': '10',
+            'interval_max': '600',
+            'interval_step': '10',
+            'decrease': '0.5',
+            'latency_factor': '2',
+            'min_samples': '5',
+            'error_windows': '3'
+        },
+        'Database': {
+            'backend': 'mysql',
+            'sqlite_path': './database/sqllite3.db'
+        },
+        'MysqlPool': {
+            'max_size': '8',
+            'timeout': '30',
+            'idle_timeout': '300',
+            'check_idle': '30'
+        },
+        'ErrorLog': {
+            'buffer_size': '10000',
+            'batch_size': '200',
+            'flush_interval': '2',
+            'fallback_path': './log/errorlog.tsv'
+        },
+        'Metrics': {
+            'enabled': '1',
+            'http_host': '127.0.0.1',
+            'http_port': '9108',
+            'publish_interval': '5',
+            'snapshot_path': './database/metrics.json'
+        }
+    }
+
+    def __init__(self, cfg_path='./configure/tuning.ini'):
+        self.__cfg_path = cfg_path
+        os.makedirs(os.path.dirname(self.__cfg_path), exist_ok=True)
+        self.__config = configparser.ConfigParser()
+        try:
+            self.__config.read(self.__cfg_path)
+            changed = False
+            for section, options in self.DEFAULTS.items():
+                if not self.__config.has_section(section):
+                    self.__config.add_section(section)
+                    changed = True
+                for key, value in options.items():
+                    if not self.__config.has_option(section, key):
+                        self.__config.set(section, key, value)
+                        changed = True
+            if changed:
+                self._write()
+        except (FileNotFoundError, configparser.Error) as e:
+            raise Exception(f"Error initializing TuneInfo: {e}")
+
+    def _write(self):
+        # 先写临时文件再替换，避免其他线程/进程读到写了一半的配置后把默认值写回
+        tmp_path = f'{self.__cfg_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            self.__config.write(f)
+        os.replace(tmp_path, self.__cfg_path)
+
+    def get(self, section, key):
+        return self.__config.get(section, key, fallback=self.DEFAULTS.get(section, {}).get(key))
+
+    def getint(self, section, key):
+        return int(self.get(section, key))
+
+    def getfloat(self, section, key):
+        return float(self.get(section, key))
+
+    def getboolean(self, section, key):
+        return str(self.get(section, key)).strip().lower() in ('1', 'true', 'yes', 'on')
+
+    def update(self, section, **kwargs):
+        try:
+            if not self.__config.has_section(section):
+                self.__config.add_section(section)
+            for key, value in kwargs.items():
+                if value is not None:
+                    self.__config.set(section, key, str(value))
+            self._write()
+        except (FileNotFoundError, configparser.Error) as e:
+            raise Exception(f"Error updating TuneInfo: {e}")
+        return True
@@ -0,0 +1,194 @@
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from Metrics import registry
+
+# 可调整的设置及其在 tuning.ini [Control] 中的上下界配置项
+KNOBS = {
+    'download_workers': ('download_min', 'download_max'),
+    'parse_workers': ('parse_min', 'parse_max'),
+    'scan_interval': ('interval_min', 'interval_max'),
+}
+
+
+class ConcurrencyController:
+    # 主进程中运行: 每 Control.interval 秒根据汇总的指标按 AIMD 调整下载并发、解析进程数与扫描间隔
+    # FTP 错误或时延超过基线 latency_factor 倍连续 error_windows 个窗口时乘性减小(偶发的一次重试不减小)，
+    # 有积压时加性增大；结果写入 manager_dict['control']，
+    # FtpScanProcess 与 ParseSupervisor 运行中读取生效。通过控制接口设置的值固定不变，直到 release
+    def __init__(self, manager_dict, collect: Callable[[], dict], tune):
+        self.manager_dict = manager_dict
+        self.collect = collect
+        self.tune = tune
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='ConcurrencyController', daemon=True)
+        self.auto = tune.getboolean('Control', 'auto')
+        self.bounds = {}
+        for knob, (low, high) in KNOBS.items():
+            self.bounds[knob] = [tune.getint('Control', low), tune.getint('Control', high)]
+        if self.bounds['parse_workers'][1] <= 0:
+            self.bounds['parse_workers'][1] = os.cpu_count() or 1
+        self.settings = {'download_workers': tune.getint('Download', 'workers'),
+                         'parse_workers': tune.getint('Parse', 'workers') or os.cpu_count() or 1,
+                         'scan_interval': tune.getint('Control', 'scan_interval')}
+        for knob, value in self.settings.items():
+            self.settings[knob] = self._clamp(knob, value)
+        self.pinned = set()
+        self.previous: Optional[dict] = None
+        self.baseline: Dict[str, float] = {}
+        self.last: Dict[str, float] = {}
+        self.updated = None
+        # 连续出现错误或时延升高的窗口数: {'ftp': n, 'db': n}
+        self.strikes = {'ftp': 0, 'db': 0}
+        self._publish()
+
+    def _clamp(self, knob, value):
+        low, high = self.bounds[knob]
+        return max(low, min(high, int(value)))
+
+    def _publish(self):
+        try:
+            self.manager_dict['control'] = dict(self.settings)
+        except (EOFError, OSError, BrokenPipeError):
+            pass
+        for knob, value in self.settings.items():
+            registry().set('control.setting', value, knob=knob)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self):
+        while not self.stopped.wait(self.tune.getfloat('Control', 'interval')):
+            try:
+                self.step(self.collect())
+            except Exception:
+                registry().inc('control.errors')
+
+    @staticmethod
+    def _counter(result, name):
+        # 同名计数器各标签之和
+        return sum(value for key, value in result['counters'].items() if key.partition('{')[0] == name)
+
+    @staticmethod
+    def _gauge(result, name):
+        return sum(value for key, value in result['gauges'].items() if key == name)
+
+    @staticmethod
+    def _histogram(result, name):
+        count = total = 0
+        for key, summary in result['histograms'].items():
+            if key.partition('{')[0] == name:
+                count += summary['count']
+                total += summary['sum']
+        return count, total
+
+    def _window(self, result):
+        # 与上一次采样相比的增量: 吞吐、错误数与窗口内的平均时延
+        prev = self.previous or result
+        window = {}
+        for name in ('ftp.download.bytes', 'ftp.download.failed', 'ftp.download.retries', 'scan.new_files',
+                     'mrotask.updated'):
+            window[name] = self._counter(result, name) - self._counter(prev, name)
+        for name in ('ftp.download.seconds', 'db.mrotask.seconds', 'db.downlog.seconds'):
+            count, total = self._histogram(result, name)
+            prev_count, prev_total = self._histogram(prev, name)
+            window[name + '.count'] = count - prev_count
+            window[name] = (total - prev_total) / (count - prev_count) if count > prev_count else 0.0
+        window['download_queue'] = self._gauge(result, 'pipeline.queue{stage=download}')
+        window['parse_backlog'] = self._gauge(result, 'mrotask.backlog')
+        return window
+
+    def _spike(self, window, name):
+        # 时延高于基线(正常时的指数滑动平均) latency_factor 倍视为拥塞；正常时更新基线
+        if window[name + '.count'] < self.tune.getint('Control', 'min_samples'):
+            return False
+        base = self.baseline.get(name)
+        if base is not None and window[name] > base * self.tune.getfloat('Control', 'latency_factor'):
+            return True
+        self.baseline[name] = window[name] if base is None else base * 0.8 + window[name] * 0.2
+        return False
+
+    def _persistent(self, kind, bad):
+        # 连续 error_windows 个窗口都有问题才返回 True，之后重新计数，避免每个窗口都继续减小
+        self.strikes[kind] = self.strikes[kind] + 1 if bad else 0
+        if self.strikes[kind] >= self.tune.getint('Control', 'error_windows'):
+            self.strikes[kind] = 0
+            return True
+        return False
+
+    def step(self, result):
+        window = self._window(result)
+        self.previous = result
+        with self.lock:
+            self.last = window
+            self.updated = time.time()
+            if not self.auto:
+                return
+            decrease = self.tune.getfloat('Control', 'decrease')
+            step = self.tune.getint('Control', 'interval_step')
+            ftp_spike = self._spike(window, 'ftp.download.seconds')
+            ftp_bad = bool(window['ftp.download.failed'] + window['ftp.download.retries'] or ftp_spike)
+            db_bad = self._spike(window, 'db.mrotask.seconds') or self._spike(window, 'db.downlog.seconds')
+            target = dict(self.settings)
+            if self._persistent('ftp', ftp_bad):
+                target['download_workers'] = int(target['download_workers'] * decrease)
+                target['scan_interval'] = target['scan_interval'] * 2
+            elif not ftp_bad:
+                if window['download_queue'] > 0:
+                    target['download_workers'] += 1
+                # 有新文件时缩短扫描间隔，没有时逐步放宽
+                target['scan_interval'] += -step if window['scan.new_files'] else step
+            if self._persistent('db', db_bad):
+                target['parse_workers'] = int(target['parse_workers'] * decrease)
+            elif not db_bad and (window['parse_backlog']
+                                 > target['parse_workers'] * self.tune.getint('Parse', 'claim_size')):
+                target['parse_workers'] += 1
+            changed = False
+            for knob, value in target.items():
+                value = self._clamp(knob, value)
+                if knob not in self.pinned and value != self.settings[knob]:
+                    registry().inc('control.adjustments', knob=knob,
+                                   direction='up' if value > self.settings[knob] else 'down')
+                    self.settings[knob] = value
+                    changed = True
+            if changed:
+                self._publish()
+
+    def override(self, request: dict) -> dict:
+        # 控制接口: {"download_workers": 6} 固定设置；{"release": ["download_workers"]} 恢复自动调整；
+        # {"auto": false} 暂停全部自动调整。超出上下界的值报错
+        # 先校验全部字段，有错误时不做任何修改
+        for key, value in request.items():
+            if key == 'release':
+                for knob in (value if isinstance(value, list) else [value]):
+                    if knob not in KNOBS:
+                        raise ValueError(f"Unknown setting: {knob}")
+            elif key in KNOBS:
+                low, high = self.bounds[key]
+                if not isinstance(value, int) or isinstance(value, bool) or not low <= value <= high:
+                    raise ValueError(f"{key} must be an integer in [{low}, {high}]")
+            elif key != 'auto':
+                raise ValueError(f"Unknown setting: {key}")
+        with self.lock:
+            for key, value in request.items():
+                if key == 'auto':
+                    self.auto = bool(value)
+                elif key == 'release':
+                    self.pinned.difference_update(value if isinstance(value, list) else [value])
+                else:
+                    self.settings[key] = value
+                    self.pinned.add(key)
+            self._publish()
+        return self.snapshot()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {'auto': self.auto, 'settings': dict(self.settings), 'bounds': dict(self.bounds),
+                    'pinned': sorted(self.pinned), 'window': dict(self.last), 'updated': self.updated}
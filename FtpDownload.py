@@ -0,0 +1,319 @@
+import ftplib
+import hashlib
+import importlib
+import queue
+import re
+import threading
+import time
+import zlib
+from collections import deque
+
+# 下载后校验: 算法 -> (HASH 命令中的算法名, 非标准的 X 命令, 摘要的十六进制长度)
+CHECKSUMS = {
+    'md5': ('MD5', ('XMD5', 'MD5'), 32),
+    'sha1': ('SHA-1', ('XSHA1',), 40),
+    'sha256': ('SHA-256', ('XSHA256',), 64),
+    'crc32': ('CRC32', ('XCRC',), 8),
+}
+
+
+class ChecksumUnsupported(Exception):
+    pass
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+def remote_checksum(session: ftplib.FTP, path: str, algorithm: str) -> str:
+    # 依次尝试 HASH(draft-bryan-ftpext-hash)与各服务器的 X 命令，都不支持时抛出 ChecksumUnsupported
+    hash_name, commands, length = CHECKSUMS[algorithm]
+    pattern = re.compile(r'\b[0-9a-fA-F]{%d}\b' % length)
+    attempts = [('OPTS HASH ' + hash_name, 'HASH ' + path)] + [(None, f'{command} {path}') for command in commands]
+    for opts, command in attempts:
+        try:
+            if opts:
+                session.sendcmd(opts)
+            reply = session.sendcmd(command)
+        except ftplib.error_perm:
+            continue
+        # 去掉响应码后查找摘要，CRC32 的 8 位摘要可能与响应中的其他数字混淆，取最后一个
+        found = pattern.findall(reply[4:])
+        if found:
+            return found[-1].lower()
+    raise ChecksumUnsupported(algorithm)
+
+
+def local_checksum(fileobj, algorithm: str) -> str:
+    if algorithm == 'crc32':
+        crc = 0
+        for chunk in iter(lambda: fileobj.read(1024 * 1024), b''):
+            crc = zlib.crc32(chunk, crc)
+        return '%08x' % crc
+    digest = hashlib.new(algorithm)
+    for chunk in iter(lambda: fileobj.read(1024 * 1024), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DownloadStats:
+    # 按下载线程统计文件数、字节数与传输耗时(只统计实际传输时间，不含等待上传完成的时间)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.workers = {}
+
+    def transfer(self):
+        return _Transfer(self, threading.current_thread().name)
+
+    def add(self, worker, nbytes, seconds, ok=True):
+        with self.lock:
+            entry = self.workers.setdefault(worker, {'files': 0, 'failed': 0, 'bytes': 0, 'seconds': 0.0})
+            if ok:
+                entry['files'] += 1
+            else:
+                entry['failed'] += 1
+            entry['bytes'] += nbytes
+            entry['seconds'] += seconds
+
+    def snapshot(self):
+        with self.lock:
+            result = {}
+            for worker, entry in self.workers.items():
+                result[worker] = dict(entry)
+                result[worker]['bytes_per_sec'] = entry['bytes'] / entry['seconds'] if entry['seconds'] else 0.0
+            total_bytes = sum(e['bytes'] for e in self.workers.values())
+            # 各线程并行传输，总速率取各线程速率之和
+            result['total'] = {'files': sum(e['files'] for e in self.workers.values()),
+                               'failed': sum(e['failed'] for e in self.workers.values()),
+                               'bytes': total_bytes,
+                               'bytes_per_sec': sum(r['bytes_per_sec'] for r in result.values())}
+            return result
+
+
+class _Transfer:
+    def __init__(self, stats, worker):
+        self.stats = stats
+        self.worker = worker
+        self.nbytes = 0
+        self.start = None
+
+    def callback(self, chunk):
+        if self.start is None:
+            self.start = time.time()
+        self.nbytes += len(chunk)
+
+    def finish(self, ok=True):
+        seconds = time.time() - self.start if self.start is not None else 0.0
+        self.stats.add(self.worker, self.nbytes, seconds, ok)
+
+
+class DownloadEngine:
+    # 单个文件的下载与按线程的传输统计，由调用方的下载线程调用；连接从 FtpScanClass 的连接池中借用
+    def __init__(self, ftp_scan=None):
+        self.ftp_scan = ftp_scan
+        self.stats = DownloadStats()
+
+    def download_one(self, file_info, ftp_scan=None, in_memory=False, progress=None):
+        # 多数据源时由调用方指定文件所属的 FtpScanClass；in_memory 时返回的是内存缓冲区而不是本地路径
+        # progress 在每收到一块数据时调用(参数为该数据块)，用于调用方在传输过程中续约
+        ftp_scan = ftp_scan or self.ftp_scan
+        if not ftp_scan.manager_dict['status']:
+            return file_info, None
+        transfer = self.stats.transfer()
+        callback = transfer.callback
+        if progress is not None:
+            def callback(chunk):
+                transfer.callback(chunk)
+                progress(chunk)
+        local_file = ftp_scan.file_download(file_info, callback, in_memory)
+        transfer.finish(local_file is not None)
+        return file_info, local_file
+
+
+class FifoScheduler:
+    # 原有的顺序: 每个数据源内先进先出(扫描结果已按大小从小到大排序)，不区分大小文件
+    def __init__(self, tune=None):
+        pass
+
+    def priority(self, file_info, enqueued, now):
+        return enqueued
+
+    def starving(self, enqueued, now):
+        return False
+
+    def is_large(self, file_info):
+        return False
+
+
+class FreshnessScheduler:
+    # 综合文件年龄、大小与排队时间: priority 越小越先处理
+    # 年龄(当前时间 - 文件时间 file_info[2]，服务器时区未知时为首次扫描到的时间)按新鲜度 SLA 归一，越接近 SLA 越优先；
+    # 大小按 large_size 归一，小文件略优先
+    # 排队超过 starvation 秒的文件视为饥饿，不再参与比较，按排队先后优先取出
+    def __init__(self, tune):
+        self.sla = tune.getfloat('Scheduler', 'sla')
+        self.size_weight = tune.getfloat('Scheduler', 'size_weight')
+        self.large_size = tune.getint('Scheduler', 'large_size')
+        self.starvation = tune.getfloat('Scheduler', 'starvation')
+
+    def priority(self, file_info, enqueued, now):
+        age = max(0.0, now - file_info[2])
+        return self.size_weight * file_info[1] / self.large_size - age / self.sla
+
+    def starving(self, enqueued, now):
+        return 0 < self.starvation <= now - enqueued
+
+    def is_large(self, file_info):
+        return file_info[1] >= self.large_size
+
+
+SCHEDULERS = {'fifo': FifoScheduler, 'freshness': FreshnessScheduler}
+
+
+def make_scheduler(tune):
+    # Scheduler.policy 为内置策略名，或 "模块:类名" 形式的自定义策略(构造参数为 TuneInfo)
+    policy = tune.get('Scheduler', 'policy')
+    if ':' in policy:
+        module, name = policy.split(':', 1)
+        return getattr(importlib.import_module(module), name)(tune)
+    if policy not in SCHEDULERS:
+        raise Exception(f"Unknown scheduler policy: {policy}")
+    return SCHEDULERS[policy](tune)
+
+
+class FairQueue:
+    # 按数据源分别排队的队列，接口与 queue.Queue 相同；get 在各数据源之间轮转取任务
+    # 每个数据源同时处理的文件数不超过其上限(task_done 后释放)，单个大数据源不会占满全部工作线程
+    # 数据源内的先后由 scheduler 决定，有饥饿的文件时优先取出等待最久的；
+    # 大文件同时处理的个数不超过 large_slots，其余线程留给小文件，没有小文件等待时不受限制
+    # capacity 限制所有数据源合计同时处理的文件数(0 为不限)，可在运行中调整，多出的线程等待
+    # large_slots 为 0 时取并发数(workers，设置 capacity 后为 capacity)的一半，workers 也为 0 时不限
+    def __init__(self, maxsize=100, key=lambda item: item[3], scheduler=None, file_info=lambda item: item,
+                 large_slots=0, workers=0):
+        self.maxsize = maxsize
+        self.key = key
+        self.scheduler = scheduler or FifoScheduler()
+        self.file_info = file_info
+        self.large_config = large_slots
+        self.large_slots = self._large_slots(workers)
+        self.cond = threading.Condition()
+        self.queues = {}
+        self.order = []
+        self.next = 0
+        self.limits = {}
+        self.active = {}
+        self.large_active = 0
+        self.small_queued = 0
+        self.capacity = 0
+
+    def _large_slots(self, workers):
+        return self.large_config or (max(1, workers // 2) if workers > 0 else 0)
+
+    def set_capacity(self, capacity):
+        with self.cond:
+            self.capacity = capacity
+            if capacity > 0:
+                self.large_slots = self._large_slots(capacity)
+            self.cond.notify_all()
+
+    def set_limit(self, key, limit):
+        with self.cond:
+            self.limits[key] = limit
+            self.cond.notify_all()
+
+    def _queue(self, key):
+        if key not in self.queues:
+            self.queues[key] = deque()
+            self.order.append(key)
+            self.active.setdefault(key, 0)
+        return self.queues[key]
+
+    def put(self, item, timeout=None):
+        # 只有该数据源自己的队列满时才阻塞
+        key = self.key(item)
+        large = self.scheduler.is_large(self.file_info(item))
+        with self.cond:
+            items = self._queue(key)
+            if not self.cond.wait_for(lambda: len(items) < self.maxsize, timeout):
+                raise queue.Full
+            items.append((item, time.time(), large))
+            if not large:
+                self.small_queued += 1
+            self.cond.notify_all()
+
+    def _large_ok(self):
+        return self.large_slots <= 0 or self.large_active < self.large_slots or self.small_queued == 0
+
+    def _best(self, entries, now, large_ok):
+        # 数据源内 priority 最小的可取任务的下标
+        best = None
+        for index, (item, enqueued, large) in enumerate(entries):
+            if large and not large_ok:
+                continue
+            priority = self.scheduler.priority(self.file_info(item), enqueued, now)
+            if best is None or priority < best[0]:
+                best = (priority, index)
+        return best[1]
+
+    def _pick(self, now):
+        # 从上次取过的数据源之后开始，找第一个有可取任务且未达到并发上限的数据源；
+        # 各数据源中排队最久的可取任务已饥饿时，改为取其中等待最久的一个
+        if 0 < self.capacity <= sum(self.active.values()):
+            return None
+        large_ok = self._large_ok()
+        first = None
+        starving = None
+        for i in range(len(self.order)):
+            pos = (self.next + i) % len(self.order)
+            key = self.order[pos]
+            limit = self.limits.get(key, 0)
+            entries = self.queues[key]
+            if not entries or (0 < limit <= self.active[key]):
+                continue
+            # 队列按入队时间排列，第一个可取的即为等待最久的
+            oldest = next((j for j, entry in enumerate(entries) if large_ok or not entry[2]), None)
+            if oldest is None:
+                continue
+            if first is None:
+                first = (pos, self._best(entries, now, large_ok))
+            enqueued = entries[oldest][1]
+            if self.scheduler.starving(enqueued, now) and (starving is None or enqueued < starving[2]):
+                starving = (pos, oldest, enqueued)
+        if starving is not None:
+            return starving[:2]
+        return first
+
+    def get(self, timeout=None):
+        with self.cond:
+            if not self.cond.wait_for(lambda: self._pick(time.time()) is not None, timeout):
+                raise queue.Empty
+            pos, index = self._pick(time.time())
+            self.next = (pos + 1) % len(self.order)
+            key = self.order[pos]
+            items = self.queues[key]
+            item, _, large = items[index]
+            del items[index]
+            self.active[key] += 1
+            if large:
+                self.large_active += 1
+            else:
+                self.small_queued -= 1
+            self.cond.notify_all()
+            return item
+
+    def task_done(self, item):
+        with self.cond:
+            key = self.key(item)
+            self.active[key] = max(0, self.active.get(key, 0) - 1)
+            if self.scheduler.is_large(self.file_info(item)):
+                self.large_active = max(0, self.large_active - 1)
+            self.cond.notify_all()
+
+    def qsize(self):
+        with self.cond:
+            return sum(len(items) for items in self.queues.values())
+
+    def sizes(self):
+        with self.cond:
+            return {key: {'queued': len(items), 'active': self.active[key], 'limit': self.limits.get(key, 0)}
+                    for key, items in self.queues.items()}
@@ -0,0 +1,142 @@
+import json
+import os
+import stat
+import threading
+import time
+from typing import Dict, Iterator, Optional, Tuple
+
+
+class FtpManifest:
+    # 目录清单: {目录: {'mtime': 目录修改时间, 'listed': 列出时间, 'since': 首次看到该目录修改时间的本地时间,
+    #               'files': {文件名: [大小, 修改时间]}, 'subdirs': {子目录名: 修改时间}}}
+    def __init__(self, ftp_name: str, manifest_path: str = './database/manifest'):
+        self.ftp_name = ftp_name
+        self.file_path = os.path.join(manifest_path, f'{ftp_name}.json')
+        self.dirs: Dict[str, dict] = {}
+        self.lock = threading.Lock()
+        self.listed = 0
+        self.reused = 0
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.file_path, 'r', encoding='utf-8') as f:
+                self.dirs = json.load(f).get('dirs', {})
+        except (FileNotFoundError, ValueError):
+            self.dirs = {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+        tmp_path = self.file_path + '.tmp'
+        with self.lock:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'ftp_name': self.ftp_name, 'dirs': self.dirs}, f)
+            os.replace(tmp_path, self.file_path)
+
+    def clear(self):
+        with self.lock:
+            self.dirs = {}
+
+    @staticmethod
+    def list_dir(ftp, path: str) -> dict:
+        # listdir 会发送一次 LIST 并把结果写入 ftputil 的 stat 缓存，随后的 lstat 不再产生网络请求
+        entry = {'files': {}, 'subdirs': {}}
+        for name in ftp.listdir(path):
+            st = ftp.lstat(ftp.path.join(path, name))
+            if stat.S_ISDIR(st.st_mode):
+                entry['subdirs'][name] = st.st_mtime
+            else:
+                entry['files'][name] = [st.st_size, st.st_mtime]
+        return entry
+
+    @staticmethod
+    def _settled(old: dict, dir_mtime: float, precision: float, clock_known: bool) -> bool:
+        listed = old.get('listed', 0)
+        if listed - old.get('since', listed) >= precision:
+            return True
+        return clock_known and listed - precision >= dir_mtime
+
+    def walk(self, ftp, root: str, full: bool = False, status: Optional[dict] = None,
+             relist: Optional[set] = None, precision: float = 120,
+             clock_known: bool = False) -> Iterator[Tuple[str, Dict[str, list], bool]]:
+        # 仅重新列出修改时间发生变化的叶子目录；含子目录的目录需要重新列出才能得到子目录的修改时间
+        # relist 中的目录含有仍在上传的文件，追加写入不会改变目录修改时间，因此必须重新列出
+        # LIST 的修改时间通常只精确到分钟，同一分钟内新增的文件不会改变目录修改时间，目录修改时间"稳定"后才复用:
+        # 首次看到当前修改时间后至少 precision 秒又列出过一次(只用本地时钟，与服务器时区无关)；
+        # clock_known(已设置 time_shift，修改时间已换算为 UTC)时，上次列出时修改时间已早于 precision 秒也算稳定
+        self.listed = 0
+        self.reused = 0
+        seen = set()
+        stack = [(root, None)]
+        while stack:
+            if status is not None and not status['status']:
+                return
+            path, dir_mtime = stack.pop()
+            seen.add(path)
+            old = self.dirs.get(path)
+            if (not full and old is not None and not old['subdirs'] and dir_mtime is not None
+                    and old['mtime'] == dir_mtime and self._settled(old, dir_mtime, precision, clock_known)
+                    and not (relist and path in relist)):
+                entry = old
+                changed = False
+                self.reused += 1
+            else:
+                listed = time.time()
+                entry = self.list_dir(ftp, path)
+                entry['mtime'] = dir_mtime
+                entry['listed'] = listed
+                entry['since'] = old.get('since', listed) if old is not None and old['mtime'] == dir_mtime else listed
+                with self.lock:
+                    self.dirs[path] = entry
+                changed = old is None or old['files'] != entry['files']
+                self.listed += 1
+            yield path, entry['files'], changed
+            for name, mtime in entry['subdirs'].items():
+                stack.append((ftp.path.join(path, name), mtime))
+        # 一次完整遍历后删除已不存在的目录
+        with self.lock:
+            for path in [p for p in self.dirs if p not in seen]:
+                del self.dirs[path]
+
+
+class StabilityTracker:
+    # 根据连续多次扫描得到的文件大小/修改时间判断对方是否已上传完成
+    # 连续 stable_scans 次扫描未变化，或修改时间早于 stable_age 秒，即判定为上传完成
+    # mtime 须已按服务器时区换算(FtpScanClass 设置 time_shift)，时区未知时调用方以 stable_age=0 关闭按时间的判定
+    def __init__(self, stable_scans: int = 2, stable_age: float = 300):
+        self.stable_scans = stable_scans
+        self.stable_age = stable_age
+        self.pending: Dict[str, list] = {}
+        self.seen = set()
+        # 首次扫描到各文件的本地时间，文件下载登记后(不再出现在扫描结果中)删除
+        self.first_seen: Dict[str, float] = {}
+
+    def begin(self):
+        self.seen = set()
+
+    def observe(self, ftp_file: str, size: int, mtime: float, now: Optional[float] = None) -> bool:
+        now = time.time() if now is None else now
+        self.seen.add(ftp_file)
+        self.first_seen.setdefault(ftp_file, now)
+        if self.stable_age > 0 and now - mtime >= self.stable_age:
+            self.pending.pop(ftp_file, None)
+            return True
+        state = self.pending.get(ftp_file)
+        if state is None or state[0] != size or state[1] != mtime:
+            self.pending[ftp_file] = [size, mtime, 1]
+        else:
+            state[2] += 1
+        if self.pending[ftp_file][2] >= self.stable_scans:
+            del self.pending[ftp_file]
+            return True
+        return False
+
+    def end(self):
+        # 删除本次扫描中未出现的文件(已被删除或已下载)
+        for ftp_file in [f for f in self.pending if f not in self.seen]:
+            del self.pending[ftp_file]
+        for ftp_file in [f for f in self.first_seen if f not in self.seen]:
+            del self.first_seen[ftp_file]
+
+    def pending_dirs(self, dirname) -> set:
+        return {dirname(f) for f in self.pending}
@@ -0,0 +1,114 @@
+import ftplib
+import queue
+import threading
+import time
+
+import ftputil
+from ftputil.error import FTPOSError
+
+
+class FtpSession(ftplib.FTP):
+    # ftputil 默认的会话会把端口当作 acct 参数传入 ftplib.FTP，这里显式连接指定端口
+    def __init__(self, host, user, passwd, port=21, timeout=60):
+        super().__init__(timeout=timeout)
+        self.connect(host, int(port))
+        self.login(user, passwd)
+
+
+def open_ftp(ftpinfo, timeout=60):
+    return ftputil.FTPHost(ftpinfo.host, ftpinfo.user, ftpinfo.passwd, ftpinfo.port, timeout=timeout,
+                           session_factory=FtpSession)
+
+
+class FtpConnectionPool:
+    # 已登录 FTP 连接池，连接空闲超过 check_idle 秒后借出前先做 NOOP 检查，失效则重新连接
+    def __init__(self, ftpinfo, max_size=4, timeout=60, check_idle=30):
+        self.ftpinfo = ftpinfo
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.size = 0
+        self.closed = False
+        self.connects = 0
+        self.reconnects = 0
+
+    def _open(self):
+        ftp = open_ftp(self.ftpinfo, self.timeout)
+        self.connects += 1
+        return ftp
+
+    def _is_alive(self, ftp):
+        try:
+            ftp.keep_alive()
+            return True
+        except (FTPOSError, Exception):
+            return False
+
+    def _discard(self, ftp):
+        try:
+            ftp.close()
+        except (FTPOSError, Exception):
+            pass
+        with self.lock:
+            self.size -= 1
+
+    def acquire(self, block=True):
+        if self.closed:
+            raise Exception('FtpConnectionPool is closed')
+        while True:
+            try:
+                ftp, last_used = self.idle.get_nowait()
+            except queue.Empty:
+                with self.lock:
+                    can_open = self.size < self.max_size
+                    if can_open:
+                        self.size += 1
+                if can_open:
+                    try:
+                        return self._open()
+                    except (FTPOSError, Exception):
+                        with self.lock:
+                            self.size -= 1
+                        raise
+                try:
+                    ftp, last_used = self.idle.get(block, self.timeout)
+                except queue.Empty:
+                    raise Exception('Timeout waiting for FTP connection')
+            if time.time() - last_used < self.check_idle or self._is_alive(ftp):
+                return ftp
+            self._discard(ftp)
+            self.reconnects += 1
+
+    def release(self, ftp, broken=False):
+        if broken or self.closed:
+            self._discard(ftp)
+        else:
+            self.idle.put((ftp, time.time()))
+
+    def connection(self):
+        return _PooledFtp(self)
+
+    def close(self):
+        self.closed = True
+        while True:
+            try:
+                ftp, _ = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(ftp)
+
+
+class _PooledFtp:
+    def __init__(self, pool):
+        self.pool = pool
+        self.ftp = None
+
+    def __enter__(self):
+        self.ftp = self.pool.acquire()
+        return self.ftp
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        # 出现 FTP 异常时不再复用该连接
+        self.pool.release(self.ftp, broken=exc_type is not None and issubclass(exc_type, (FTPOSError, OSError)))
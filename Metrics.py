@@ -0,0 +1,358 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+# 延迟直方图的桶上界(秒)
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, float('inf'))
+# manager_dict 中各进程指标快照的键前缀
+KEY_PREFIX = 'metrics:'
+# 进程退出时交给汇总方的最终快照的键前缀，汇总后删除
+RETIRED_PREFIX = 'metrics_retired:'
+# 存在汇总方(MetricsServer)时置位；没有汇总方时退出的进程不留下快照
+COLLECTOR_KEY = 'metrics_collector'
+
+
+def _key(name: str, labels: Dict[str, str]) -> str:
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{k}={labels[k]}' for k in sorted(labels)) + '}'
+
+
+class _Timer:
+    def __init__(self, registry, key):
+        self.registry = registry
+        self.key = key
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        self.registry._observe(self.key, time.perf_counter() - self.start)
+
+
+class MetricsRegistry:
+    # 进程内指标: 计数器(累加)、仪表(当前值)、延迟直方图；所有操作只持一次锁，开销在微秒级
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[str, float] = {}
+        self.gauges: Dict[str, float] = {}
+        self.histograms: Dict[str, list] = {}
+        self.start_time = time.time()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name: str, seconds: float, **labels):
+        self._observe(_key(name, labels), seconds)
+
+    def _observe(self, key: str, seconds: float):
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                # [count, sum, max, 各桶计数...]
+                hist = self.histograms[key] = [0, 0.0, 0.0] + [0] * len(BUCKETS)
+            hist[0] += 1
+            hist[1] += seconds
+            if seconds > hist[2]:
+                hist[2] = seconds
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    hist[3 + i] += 1
+                    break
+
+    def timer(self, name: str, **labels) -> _Timer:
+        return _Timer(self, _key(name, labels))
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {'pid': os.getpid(), 'time': time.time(), 'start_time': self.start_time,
+                    'counters': dict(self.counters), 'gauges': dict(self.gauges),
+                    'histograms': {k: list(v) for k, v in self.histograms.items()}}
+
+
+_registry: Optional[MetricsRegistry] = None
+_registry_pid = None
+_registry_lock = threading.Lock()
+
+
+def registry() -> MetricsRegistry:
+    # 每个进程一个注册表，fork 出的子进程不继承父进程的计数
+    global _registry, _registry_pid
+    if _registry is None or _registry_pid != os.getpid():
+        with _registry_lock:
+            if _registry is None or _registry_pid != os.getpid():
+                _registry = MetricsRegistry()
+                _registry_pid = os.getpid()
+    return _registry
+
+
+class MetricsPublisher:
+    # 后台线程定期把本进程的指标快照写入 manager_dict，由主进程的 MetricsServer 汇总
+    def __init__(self, manager_dict, name: str, interval: float = 5):
+        self.manager_dict = manager_dict
+        self.key = f'{KEY_PREFIX}{name}:{os.getpid()}'
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='MetricsPublisher', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def publish(self):
+        try:
+            self.manager_dict[self.key] = registry().snapshot()
+        except (EOFError, OSError, BrokenPipeError):
+            pass
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.publish()
+
+    def stop(self):
+        # 删除本进程的键，最终快照交给汇总方计入已退出进程的总计，避免 manager_dict 中的键随进程重启不断增加
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        try:
+            if self.manager_dict.get(COLLECTOR_KEY):
+                self.manager_dict[RETIRED_PREFIX + self.key[len(KEY_PREFIX):]] = registry().snapshot()
+            self.manager_dict.pop(self.key, None)
+        except (EOFError, OSError, BrokenPipeError):
+            pass
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _merge(total: dict, snap: dict):
+    # 把快照的计数器与直方图累加到 total
+    for key, value in snap['counters'].items():
+        total['counters'][key] = total['counters'].get(key, 0) + value
+    for key, hist in snap['histograms'].items():
+        acc = total['histograms'].get(key)
+        if acc is None:
+            total['histograms'][key] = list(hist)
+        else:
+            acc[0] += hist[0]
+            acc[1] += hist[1]
+            acc[2] = max(acc[2], hist[2])
+            for i in range(3, len(hist)):
+                acc[i] += hist[i]
+
+
+def aggregate(snapshots: Dict[str, dict], stale_after: float = 30, retired: Optional[dict] = None) -> dict:
+    # 计数器与直方图跨进程累加(已退出进程的计数由 retired 保留)，仪表只取最近仍在上报的进程
+    now = time.time()
+    result = {'time': now, 'processes': {}, 'counters': {}, 'gauges': {}, 'histograms': {}}
+    if retired is not None:
+        _merge(result, retired)
+    for name, snap in snapshots.items():
+        alive = now - snap['time'] <= stale_after
+        result['processes'][name] = {'pid': snap['pid'], 'alive': alive, 'updated': snap['time']}
+        _merge(result, snap)
+        if alive:
+            for key, value in snap['gauges'].items():
+                result['gauges'][key] = result['gauges'].get(key, 0) + value
+    for key, hist in result['histograms'].items():
+        result['histograms'][key] = _summary(hist)
+    return result
+
+
+def _summary(hist: list) -> dict:
+    count = hist[0]
+    buckets = hist[3:]
+
+    def quantile(q):
+        # 取累计计数首次达到 q 的桶上界
+        target = count * q
+        seen = 0
+        for bound, n in zip(BUCKETS, buckets):
+            seen += n
+            if seen >= target:
+                return bound if bound != float('inf') else hist[2]
+        return hist[2]
+
+    return {'count': count, 'sum': hist[1], 'avg': hist[1] / count if count else 0.0, 'max': hist[2],
+            'p50': quantile(0.5) if count else 0.0, 'p95': quantile(0.95) if count else 0.0,
+            'p99': quantile(0.99) if count else 0.0,
+            'buckets': {str(bound): n for bound, n in zip(BUCKETS, buckets)}}
+
+
+def _prom_name(key: str):
+    name, _, labels = key.partition('{')
+    name = name.replace('.', '_').replace('-', '_')
+    if labels:
+        labels = ','.join(f'{k}="{v}"' for k, v in (item.split('=', 1) for item in labels.rstrip('}').split(',')))
+    return name, labels
+
+
+def to_prometheus(result: dict) -> str:
+    lines = []
+
+    def line(name, labels, value):
+        lines.append(f'mro_{name}{{{labels}}} {value}' if labels else f'mro_{name} {value}')
+
+    for key, value in sorted(result['counters'].items()):
+        name, labels = _prom_name(key)
+        line(f'{name}_total', labels, value)
+    for key, value in sorted(result['gauges'].items()):
+        name, labels = _prom_name(key)
+        line(name, labels, value)
+    for key, summary in sorted(result['histograms'].items()):
+        name, labels = _prom_name(key)
+        sep = ',' if labels else ''
+        seen = 0
+        for bound, n in summary['buckets'].items():
+            seen += n
+            le = '+Inf' if bound == 'inf' else bound
+            line(f'{name}_bucket', f'{labels}{sep}le="{le}"', seen)
+        line(f'{name}_sum', labels, summary['sum'])
+        line(f'{name}_count', labels, summary['count'])
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    # 主进程中运行: 汇总各进程指标，提供本地 HTTP 查询(/metrics 为 JSON，/prometheus 为文本格式)，并定期写快照文件
+    # 设置了 controller 时另提供 /control: GET 读取当前并发设置，POST JSON 覆盖设置
+    def __init__(self, manager_dict, host: str = '127.0.0.1', port: int = 9108, interval: float = 5,
+                 snapshot_path: Optional[str] = None, controller=None):
+        self.manager_dict = manager_dict
+        self.controller = controller
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.snapshot_path = snapshot_path
+        self.httpd = None
+        self.stopped = threading.Event()
+        self.threads = []
+        # 已退出进程的计数器与直方图之和，其键已从 manager_dict 删除
+        self.retired = {'counters': {}, 'histograms': {}}
+        self.retired_lock = threading.Lock()
+        try:
+            self.manager_dict[COLLECTOR_KEY] = True
+        except (EOFError, OSError, BrokenPipeError):
+            pass
+
+    def _retire(self, key: str):
+        # pop 返回 None 说明已被其他线程的 collect 处理过
+        snap = self.manager_dict.pop(key, None)
+        if snap is not None:
+            _merge(self.retired, snap)
+
+    def collect(self) -> dict:
+        stale_after = self.interval * 6
+        now = time.time()
+        snapshots = {}
+        with self.retired_lock:
+            try:
+                for key, value in self.manager_dict.items():
+                    if not isinstance(key, str):
+                        continue
+                    if key.startswith(RETIRED_PREFIX):
+                        self._retire(key)
+                    elif key.startswith(KEY_PREFIX):
+                        # 长时间未上报且进程已不存在(被杀或崩溃，未能执行 MetricsPublisher.stop)
+                        if now - value['time'] > stale_after and not _pid_alive(value['pid']):
+                            self._retire(key)
+                        else:
+                            snapshots[key[len(KEY_PREFIX):]] = value
+            except (EOFError, OSError, BrokenPipeError):
+                pass
+            # 主进程自身的指标
+            snapshots[f'main:{os.getpid()}'] = registry().snapshot()
+            return aggregate(snapshots, stale_after, self.retired)
+
+    def write_snapshot(self):
+        if not self.snapshot_path:
+            return
+        os.makedirs(os.path.dirname(self.snapshot_path) or '.', exist_ok=True)
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.collect(), f)
+        os.replace(tmp_path, self.snapshot_path)
+
+    def _snapshot_loop(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write_snapshot()
+            except OSError:
+                pass
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, code, body, content_type='application/json'):
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                if self.path.split('?')[0] != '/control' or server.controller is None:
+                    self.send_error(404)
+                    return
+                try:
+                    request = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+                    if not isinstance(request, dict):
+                        raise ValueError('request body must be a JSON object')
+                    body = json.dumps(server.controller.override(request)).encode('utf-8')
+                except ValueError as e:
+                    self._reply(400, json.dumps({'error': str(e)}).encode('utf-8'))
+                    return
+                self._reply(200, body)
+
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if path == '/control' and server.controller is not None:
+                    body, content_type = json.dumps(server.controller.snapshot()).encode('utf-8'), 'application/json'
+                elif path == '/metrics':
+                    body, content_type = json.dumps(server.collect()).encode('utf-8'), 'application/json'
+                elif path == '/prometheus':
+                    body, content_type = to_prometheus(server.collect()).encode('utf-8'), 'text/plain; version=0.0.4'
+                else:
+                    self.send_error(404)
+                    return
+                self._reply(200, body, content_type)
+
+            def log_message(self, format, *args):
+                pass
+
+        if self.port:
+            self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+            self.threads.append(threading.Thread(target=self.httpd.serve_forever, name='MetricsHttp', daemon=True))
+        self.threads.append(threading.Thread(target=self._snapshot_loop, name='MetricsSnapshot', daemon=True))
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+        try:
+            self.write_snapshot()
+        except OSError:
+            pass
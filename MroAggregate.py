@@ -0,0 +1,189 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from MroParse import MroRow, MroXmlParser, MroZipClass
+
+# MRO 中 RSRP 上报值 0~97 对应 -140~-43 dBm，RSRQ 上报值 0~34 对应 -19.5~-3 dB
+RSRP_BINS = 98
+RSRQ_BINS = 35
+RSRP_OFFSET = -140
+SC_RSRP = 'MR.LteScRSRP'
+SC_RSRQ = 'MR.LteScRSRQ'
+NC_RSRP = 'MR.LteNcRSRP'
+
+
+def cell_key(enb_id, cell_id):
+    return (np.asarray(enb_id, dtype=np.int64) << 32) | (np.asarray(cell_id, dtype=np.int64) & 0xFFFFFFFF)
+
+
+def split_key(key) -> Tuple[np.ndarray, np.ndarray]:
+    key = np.asarray(key, dtype=np.int64)
+    return key >> 32, key & 0xFFFFFFFF
+
+
+class CellStats:
+    # 按小区汇总的统计结果，keys 为排序后的小区键，其余数组与 keys 一一对应；可跨 XML、跨进程合并
+    FIELDS = ('samples', 'rsrp_hist', 'rsrq_hist', 'nc_rows', 'overlap_samples')
+
+    def __init__(self, keys: Optional[np.ndarray] = None):
+        self.keys = np.zeros(0, dtype=np.int64) if keys is None else keys
+        n = len(self.keys)
+        self.samples = np.zeros(n, dtype=np.int64)
+        self.rsrp_hist = np.zeros((n, RSRP_BINS), dtype=np.int64)
+        self.rsrq_hist = np.zeros((n, RSRQ_BINS), dtype=np.int64)
+        self.nc_rows = np.zeros(n, dtype=np.int64)
+        self.overlap_samples = np.zeros(n, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def merge(self, other: 'CellStats') -> 'CellStats':
+        if not len(other):
+            return self
+        keys = np.union1d(self.keys, other.keys)
+        merged = CellStats(keys)
+        for stats in (self, other):
+            idx = np.searchsorted(keys, stats.keys)
+            for field in self.FIELDS:
+                getattr(merged, field)[idx] += getattr(stats, field)
+        for field in ('keys',) + self.FIELDS:
+            setattr(self, field, getattr(merged, field))
+        return self
+
+    def kpis(self, coverage_rsrp: int = -110) -> Dict[str, np.ndarray]:
+        enb_id, cell_id = split_key(self.keys)
+        rsrp_count = self.rsrp_hist.sum(axis=1)
+        valid = np.maximum(rsrp_count, 1)
+        rsrp_dbm = np.arange(RSRP_BINS) + RSRP_OFFSET
+        rsrq_db = np.arange(RSRQ_BINS) * 0.5 - 20
+        cum = self.rsrp_hist.cumsum(axis=1)
+        result = {
+            'enb_id': enb_id,
+            'cell_id': cell_id,
+            'samples': self.samples,
+            'rsrp_avg': (self.rsrp_hist * rsrp_dbm).sum(axis=1) / valid,
+            'rsrq_avg': (self.rsrq_hist * rsrq_db).sum(axis=1) / np.maximum(self.rsrq_hist.sum(axis=1), 1),
+            'coverage_rate': self.rsrp_hist[:, coverage_rsrp - RSRP_OFFSET:].sum(axis=1) / valid,
+            'overlap_rate': self.overlap_samples / np.maximum(self.samples, 1),
+            'nc_rows': self.nc_rows,
+        }
+        for q in (5, 50, 95):
+            # 由直方图的累计分布求分位数
+            target = rsrp_count * (q / 100.0)
+            result[f'rsrp_p{q}'] = (cum < target[:, None]).sum(axis=1) + RSRP_OFFSET
+        return result
+
+    def to_records(self) -> List[Dict[str, float]]:
+        kpis = self.kpis()
+        return [{name: values[i].item() for name, values in kpis.items()} for i in range(len(self))]
+
+
+class MroAggregator:
+    # 将解析出的测量流按 batch_size 条一批转为 NumPy 数组，用 unique/bincount 完成按小区分组统计
+    def __init__(self, batch_size: int = 65536, overlap_db: int = 6, overlap_count: int = 3,
+                 overlap_rsrp: int = -110):
+        self.batch_size = batch_size
+        self.overlap_db = overlap_db
+        self.overlap_count = overlap_count
+        self.overlap_rsrp = overlap_rsrp
+        self.stats = CellStats()
+        self.columns: Dict[Tuple[str, ...], Optional[Tuple[int, int, int]]] = {}
+        self._reset()
+
+    def _reset(self):
+        self.b_key = []
+        self.b_first = []
+        self.b_sc_rsrp = []
+        self.b_sc_rsrq = []
+        self.b_nc_rsrp = []
+
+    def _column_index(self, smr: Tuple[str, ...]) -> Optional[Tuple[int, int, int]]:
+        if smr not in self.columns:
+            if SC_RSRP in smr:
+                self.columns[smr] = (smr.index(SC_RSRP),
+                                     smr.index(SC_RSRQ) if SC_RSRQ in smr else -1,
+                                     smr.index(NC_RSRP) if NC_RSRP in smr else -1)
+            else:
+                # 不含服务小区 RSRP 的测量块(如 PlrULQci)不参与统计
+                self.columns[smr] = None
+        return self.columns[smr]
+
+    @staticmethod
+    def _value(values, i) -> int:
+        if i < 0 or i >= len(values):
+            return -1
+        v = values[i]
+        return v if isinstance(v, int) else -1
+
+    def add(self, row: MroRow):
+        cols = self._column_index(row.smr)
+        if cols is None:
+            return
+        # 只在新样本开始时切分批次，保证同一个 object 的多行落在同一批
+        first = row.v_index == 0 or not self.b_key
+        if first and len(self.b_key) >= self.batch_size:
+            self.flush()
+        values = row.values
+        self.b_key.append((row.enb_id << 32) | (row.cell_id & 0xFFFFFFFF))
+        self.b_first.append(first)
+        self.b_sc_rsrp.append(self._value(values, cols[0]))
+        self.b_sc_rsrq.append(self._value(values, cols[1]))
+        self.b_nc_rsrp.append(self._value(values, cols[2]))
+
+    def consume(self, rows: Iterable[MroRow]) -> 'MroAggregator':
+        add = self.add
+        for row in rows:
+            add(row)
+        return self
+
+    def flush(self):
+        if not self.b_key:
+            return
+        key = np.array(self.b_key, dtype=np.int64)
+        first = np.array(self.b_first, dtype=bool)
+        sc_rsrp = np.array(self.b_sc_rsrp, dtype=np.int64)
+        sc_rsrq = np.array(self.b_sc_rsrq, dtype=np.int64)
+        nc_rsrp = np.array(self.b_nc_rsrp, dtype=np.int64)
+        self._reset()
+        self.add_arrays(key, first, sc_rsrp, sc_rsrq, nc_rsrp)
+
+    def add_arrays(self, key: np.ndarray, first: np.ndarray, sc_rsrp: np.ndarray, sc_rsrq: np.ndarray,
+                   nc_rsrp: np.ndarray):
+        # 直接汇总一批列数据，缺失值用 -1 表示；批次必须从一个新样本(first 为 True)开始
+        if not len(key):
+            return
+        keys, inv = np.unique(key, return_inverse=True)
+        n = len(keys)
+        batch = CellStats(keys)
+        batch.samples = np.bincount(inv[first], minlength=n)
+        valid = first & (sc_rsrp >= 0)
+        batch.rsrp_hist = np.bincount(inv[valid] * RSRP_BINS + np.clip(sc_rsrp[valid], 0, RSRP_BINS - 1),
+                                      minlength=n * RSRP_BINS).reshape(n, RSRP_BINS)
+        valid = first & (sc_rsrq >= 0)
+        batch.rsrq_hist = np.bincount(inv[valid] * RSRQ_BINS + np.clip(sc_rsrq[valid], 0, RSRQ_BINS - 1),
+                                      minlength=n * RSRQ_BINS).reshape(n, RSRQ_BINS)
+        has_nc = nc_rsrp >= 0
+        batch.nc_rows = np.bincount(inv[has_nc], minlength=n)
+
+        # 重叠覆盖: 服务小区 RSRP 不低于 overlap_rsrp，且有 overlap_count 个以上邻区与其相差不超过 overlap_db
+        obj = np.cumsum(first) - 1
+        row_sc = sc_rsrp[first][obj]
+        close = has_nc & (row_sc >= self.overlap_rsrp - RSRP_OFFSET) & (nc_rsrp >= row_sc - self.overlap_db)
+        per_obj = np.bincount(obj, weights=close, minlength=int(first.sum()))
+        batch.overlap_samples = np.bincount(inv[first][per_obj >= self.overlap_count], minlength=n)
+        self.stats.merge(batch)
+
+    def result(self) -> CellStats:
+        self.flush()
+        return self.stats
+
+
+def aggregate_bundle(zip_class: MroZipClass, xml_list: Optional[List[Dict[str, str]]] = None,
+                     aggregator: Optional[MroAggregator] = None) -> CellStats:
+    # 接在 MroZipClass 之后: 逐个 XML 流式解析并分批汇总，不保留原始行
+    aggregator = aggregator or MroAggregator()
+    parser = MroXmlParser(zip_class)
+    for xml_info in (xml_list if xml_list is not None else zip_class.scan_xml_list()):
+        aggregator.consume(parser.iter_rows(xml_info))
+    return aggregator.result()
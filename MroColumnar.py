@@ -0,0 +1,257 @@
+import hashlib
+import json
+import os
+import shutil
+import struct
+import tempfile
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from MroAggregate import MroAggregator, CellStats, SC_RSRP, SC_RSRQ, NC_RSRP
+from MroParse import MroRow
+
+# 文件结构: MAGIC(4) + 版本(2) + 头长度(4) + JSON 头 + 按 ALIGN 对齐的各列数据
+MAGIC = b'MROC'
+VERSION = 1
+ALIGN = 64
+SUFFIX = '.mroc'
+# 测量值列中的 NIL 及非整数值
+NIL = np.iinfo(np.int32).min
+DICT_COLUMNS = ('object_id', 'timestamp', 'smr')
+VALUE_PREFIX = 'm:'
+
+
+def xml_key(main_zip: str, sub_zip_path: str, xml_name: str) -> str:
+    # 与 MroTask 的 main_zip/sub_zip_path/xml_name 对应
+    return hashlib.sha1('|'.join((main_zip, sub_zip_path, xml_name)).encode('utf-8')).hexdigest()
+
+
+def columnar_path(root: str, main_zip: str, sub_zip_path: str, xml_name: str) -> str:
+    digest = xml_key(main_zip, sub_zip_path, xml_name)
+    return os.path.join(root, digest[:2], digest + SUFFIX)
+
+
+def _align(n: int) -> int:
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+class MroColumnarWriter:
+    # 按列写出解析结果: object_id/timestamp/smr 字典编码，测量值按 smr 列名各存一列 int32
+    # 每批数据先追加到临时列文件，close 时拼装成最终文件，内存占用只与 batch_size 有关
+    def __init__(self, path: str, main_zip: str, sub_zip_path: str, xml_name: str, batch_size: int = 65536):
+        self.path = path
+        self.key = {'main_zip': main_zip, 'sub_zip_path': sub_zip_path, 'xml_name': xml_name}
+        self.batch_size = batch_size
+        self.rows = 0
+        self.dicts: Dict[str, Dict[str, int]] = {name: {} for name in DICT_COLUMNS}
+        self.fixed = {'enb_id': np.int32, 'cell_id': np.int32, 'v_index': np.uint16,
+                      'object_id': np.uint32, 'timestamp': np.uint32, 'smr': np.uint16}
+        # 测量值列: 列名 -> 首次出现时的行号，之前的行补 NIL
+        self.value_start: Dict[str, int] = {}
+        self.value_files: Dict[str, str] = {}
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.tmp_dir = tempfile.mkdtemp(prefix='mroc_', dir=os.path.dirname(path) or None)
+        self.closed = False
+        self._reset()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+    def _reset(self):
+        self.batch = {name: [] for name in self.fixed}
+        self.batch_values: Dict[str, list] = {name: [] for name in self.value_start}
+        self.batch_rows = 0
+
+    def _code(self, column: str, value: str) -> int:
+        codes = self.dicts[column]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(codes)
+        return code
+
+    def write(self, row: MroRow):
+        batch = self.batch
+        batch['enb_id'].append(row.enb_id)
+        batch['cell_id'].append(row.cell_id)
+        batch['v_index'].append(row.v_index)
+        batch['object_id'].append(self._code('object_id', row.object_id))
+        batch['timestamp'].append(self._code('timestamp', row.timestamp))
+        batch['smr'].append(self._code('smr', ' '.join(row.smr)))
+        values = row.values
+        for i, name in enumerate(row.smr):
+            column = self.batch_values.get(name)
+            if column is None:
+                self.value_start[name] = self.rows + self.batch_rows
+                self.value_files[name] = f'value_{len(self.value_files)}'
+                column = self.batch_values[name] = []
+            v = values[i] if i < len(values) else None
+            column.append((self.batch_rows, v if isinstance(v, int) else NIL))
+        self.batch_rows += 1
+        if self.batch_rows >= self.batch_size:
+            self.flush()
+
+    def write_rows(self, rows: Iterable[MroRow]) -> int:
+        for row in rows:
+            self.write(row)
+        return self.rows + self.batch_rows
+
+    def _append(self, name: str, array: np.ndarray):
+        with open(os.path.join(self.tmp_dir, name), 'ab') as f:
+            array.tofile(f)
+
+    def flush(self):
+        if not self.batch_rows:
+            return
+        for name, dtype in self.fixed.items():
+            self._append(name, np.array(self.batch[name], dtype=dtype))
+        for name, items in self.batch_values.items():
+            column = np.full(self.batch_rows, NIL, dtype=np.int32)
+            if items:
+                idx, values = zip(*items)
+                column[list(idx)] = values
+            start = self.value_start[name]
+            if start > self.rows:
+                # 该列在本批中途才出现，只写出从首次出现开始的部分
+                column = column[start - self.rows:]
+            self._append(self.value_files[name], column)
+        self.rows += self.batch_rows
+        self._reset()
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        columns = []
+        offset = 0
+        for name, dtype in self.fixed.items():
+            nbytes = self.rows * np.dtype(dtype).itemsize
+            columns.append({'name': name, 'dtype': np.dtype(dtype).str, 'offset': offset, 'nbytes': nbytes,
+                            'file': name, 'pad_rows': 0})
+            offset = _align(offset + nbytes)
+        for name, start in self.value_start.items():
+            nbytes = self.rows * 4
+            columns.append({'name': VALUE_PREFIX + name, 'dtype': np.dtype(np.int32).str, 'offset': offset,
+                            'nbytes': nbytes, 'file': self.value_files[name], 'pad_rows': start})
+            offset = _align(offset + nbytes)
+        header = {'version': VERSION, 'key': self.key, 'rows': self.rows,
+                  'dicts': {name: list(codes) for name, codes in self.dicts.items()},
+                  'columns': [{k: c[k] for k in ('name', 'dtype', 'offset', 'nbytes')} for c in columns]}
+        header_bytes = json.dumps(header).encode('utf-8')
+        data_start = _align(len(MAGIC) + 6 + len(header_bytes))
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC + struct.pack('<HI', VERSION, len(header_bytes)) + header_bytes)
+            for column in columns:
+                f.seek(data_start + column['offset'])
+                if column['pad_rows']:
+                    np.full(column['pad_rows'], NIL, dtype=np.int32).tofile(f)
+                col_file = os.path.join(self.tmp_dir, column['file'])
+                if os.path.exists(col_file):
+                    with open(col_file, 'rb') as src:
+                        shutil.copyfileobj(src, f, 1024 * 1024)
+            f.truncate(data_start + offset)
+        os.replace(tmp_path, self.path)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        self.closed = True
+
+    def abort(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        self.closed = True
+
+
+class MroColumnarReader:
+    # 以 mmap 方式打开，列数据直接作为 NumPy 视图返回，不做拷贝
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            prefix = f.read(len(MAGIC) + 6)
+            if prefix[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"Not a columnar MRO file: {path}")
+            version, header_len = struct.unpack('<HI', prefix[len(MAGIC):])
+            if version != VERSION:
+                raise ValueError(f"Unsupported columnar MRO version {version}: {path}")
+            self.header = json.loads(f.read(header_len).decode('utf-8'))
+        self.data_start = _align(len(MAGIC) + 6 + header_len)
+        self.rows = self.header['rows']
+        self.key = self.header['key']
+        self.dicts: Dict[str, List[str]] = self.header['dicts']
+        self.columns = {c['name']: c for c in self.header['columns']}
+        self.mm = np.memmap(path, dtype=np.uint8, mode='r') if self.rows else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        self.close()
+
+    def close(self):
+        self.mm = None
+
+    def column(self, name: str) -> np.ndarray:
+        c = self.columns[name]
+        if self.mm is None:
+            return np.zeros(0, dtype=np.dtype(c['dtype']))
+        start = self.data_start + c['offset']
+        return self.mm[start:start + c['nbytes']].view(np.dtype(c['dtype']))
+
+    def value(self, smr_name: str) -> Optional[np.ndarray]:
+        return self.column(VALUE_PREFIX + smr_name) if VALUE_PREFIX + smr_name in self.columns else None
+
+    def value_names(self) -> List[str]:
+        return [name[len(VALUE_PREFIX):] for name in self.columns if name.startswith(VALUE_PREFIX)]
+
+    def decode(self, name: str, codes: np.ndarray) -> List[str]:
+        values = self.dicts[name]
+        return [values[c] for c in codes]
+
+    def iter_rows(self) -> Iterable[MroRow]:
+        enb_id, cell_id = self.column('enb_id'), self.column('cell_id')
+        v_index, object_id = self.column('v_index'), self.column('object_id')
+        timestamp, smr = self.column('timestamp'), self.column('smr')
+        smr_names = [tuple(s.split()) for s in self.dicts['smr']]
+        values = {name: self.value(name) for name in self.value_names()}
+        for i in range(self.rows):
+            names = smr_names[smr[i]]
+            yield MroRow(int(enb_id[i]), int(cell_id[i]), self.dicts['object_id'][object_id[i]],
+                         self.dicts['timestamp'][timestamp[i]], names,
+                         tuple(None if values[n][i] == NIL else int(values[n][i]) for n in names),
+                         int(v_index[i]))
+
+
+def aggregate_columnar(readers: Iterable[MroColumnarReader], aggregator: Optional[MroAggregator] = None,
+                       batch_size: int = 1 << 20) -> CellStats:
+    # 直接基于列视图重新汇总，无需再次解析 XML
+    aggregator = aggregator or MroAggregator()
+    for reader in readers:
+        if not reader.rows:
+            continue
+        smr_ok = np.array([SC_RSRP in s.split() for s in reader.dicts['smr']], dtype=bool)[reader.column('smr')]
+        enb_id, cell_id = reader.column('enb_id'), reader.column('cell_id')
+        empty = np.full(reader.rows, NIL, dtype=np.int32)
+        values = [reader.value(name) for name in (SC_RSRP, SC_RSRQ, NC_RSRP)]
+        values = [v if v is not None else empty for v in values]
+        first_all = reader.column('v_index') == 0
+        first_all[0] = True
+        # 按样本边界切分批次，避免一次性生成过大的中间数组
+        starts = np.flatnonzero(first_all)
+        step = max(1, int(batch_size * len(starts) / reader.rows))
+        bounds = starts[::step].tolist() + [reader.rows]
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            mask = smr_ok[lo:hi]
+            if not mask.any():
+                continue
+            first = first_all[lo:hi][mask]
+            first[0] = True
+            key = (enb_id[lo:hi][mask].astype(np.int64) << 32) | (cell_id[lo:hi][mask].astype(np.int64) & 0xFFFFFFFF)
+            sc_rsrp, sc_rsrq, nc_rsrp = (np.where(v[lo:hi][mask] == NIL, -1, v[lo:hi][mask]).astype(np.int64)
+                                         for v in values)
+            aggregator.add_arrays(key, first, sc_rsrp, sc_rsrq, nc_rsrp)
+    return aggregator.result()
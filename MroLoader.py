@@ -0,0 +1,237 @@
+import collections
+import os
+import tempfile
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence
+
+import pymysql
+
+from Config import MysqlInfo, MysqlPool, ErrorLog, TuneInfo, MEASUREMENT_TABLES, _SqliteConnection
+from MroColumnar import xml_key
+from MroParse import MroRow
+
+MEASUREMENT_COLUMNS = ('xml_key', 'row_no', 'enb_id', 'cell_id', 'time_stamp', 'v_index',
+                       'sc_rsrp', 'sc_rsrq', 'nc_earfcn', 'nc_pci', 'nc_rsrp', 'nc_rsrq')
+MEASUREMENT_SMR = ('MR.LteScRSRP', 'MR.LteScRSRQ', 'MR.LteNcEarfcn', 'MR.LteNcPci', 'MR.LteNcRSRP',
+                   'MR.LteNcRSRQ')
+CELL_KPI_COLUMNS = ('xml_key', 'ftp_name', 'main_zip', 'enb_id', 'cell_id', 'samples', 'nc_rows', 'rsrp_avg',
+                    'rsrq_avg', 'rsrp_p5', 'rsrp_p50', 'rsrp_p95', 'coverage_rate', 'overlap_rate', 'uptime')
+# 可重试的错误: 连接断开、锁等待超时、死锁等
+RETRY_ERRORS = (pymysql.OperationalError, pymysql.InterfaceError, pymysql.InternalError)
+
+
+class BulkLoader:
+    # 批量写入 MySQL: insert 模式用多行 INSERT ... ON DUPLICATE KEY UPDATE，infile 模式用 LOAD DATA LOCAL INFILE
+    # 每 commit_interval 个批次提交一次，未提交的批次保留在内存中，出错时回滚并整体重放
+    # Database.backend 为 sqlite 时写入同一个 SQLite 文件(INSERT OR REPLACE，自动提交)
+    def __init__(self, table: str, columns: Sequence[str], mode: Optional[str] = None,
+                 batch_size: Optional[int] = None, commit_interval: Optional[int] = None,
+                 max_retries: Optional[int] = None, connect: bool = True):
+        tune = TuneInfo()
+        self.table = table
+        self.columns = tuple(columns)
+        self.mode = mode or tune.get('Loader', 'mode')
+        self.batch_size = batch_size or tune.getint('Loader', 'batch_size')
+        self.commit_interval = commit_interval or tune.getint('Loader', 'commit_interval')
+        self.max_retries = tune.getint('Loader', 'max_retries') if max_retries is None else max_retries
+        self.spool_dir = tune.get('Loader', 'spool_dir') or None
+        self.sqlite_path = tune.get('Database', 'sqlite_path') if tune.get('Database', 'backend') == 'sqlite' else None
+        self.mysqlinfo = MysqlInfo(section='LocalServer')
+        self.mysqlinfo.db_name = 'mroparse'
+        self.errlog = ErrorLog('BulkLoader')
+        # 结果表与 downlog 一起由 init_schema/ensure_schema 创建
+        MysqlPool.get(self.mysqlinfo, self.mysqlinfo.db_name).ensure_schema()
+        self.conn = None
+        self.cursor = None
+        self.batch: List[tuple] = []
+        self.pending: List[List[tuple]] = []
+        self.rows = 0
+        self.batches = 0
+        self.retries = 0
+        self.load_seconds = 0.0
+        self.latency = collections.deque(maxlen=1000)
+        self.start_time = None
+        # connect 为 False 时在第一次写入时连接，连接失败按可重试错误处理
+        if connect:
+            self._connect()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _connect(self):
+        if self.sqlite_path:
+            self.conn = _SqliteConnection(self.sqlite_path)
+            self.cursor = self.conn.cursor()
+            return
+        try:
+            self.conn = pymysql.connect(
+                host=self.mysqlinfo.host,
+                port=self.mysqlinfo.port,
+                user=self.mysqlinfo.user,
+                password=self.mysqlinfo.passwd,
+                database=self.mysqlinfo.db_name,
+                autocommit=False,
+                local_infile=self.mode == 'infile'
+            )
+            self.cursor = self.conn.cursor()
+        except pymysql.Error as e:
+            self.cursor = None
+            self.conn = None
+            raise Exception(f"Error connecting to MySQL: {e}")
+
+    def _disconnect(self):
+        try:
+            if self.conn:
+                self.conn.close()
+        except pymysql.Error:
+            pass
+        self.conn = None
+        self.cursor = None
+
+    def create_table(self):
+        self.cursor.execute(MEASUREMENT_TABLES[self.table])
+        self.conn.commit()
+
+    def _insert_sql(self) -> str:
+        cols = ', '.join(self.columns)
+        if self.sqlite_path:
+            return f"INSERT OR REPLACE INTO {self.table} ({cols}) VALUES ({', '.join(['%s'] * len(self.columns))})"
+        updates = ', '.join(f"{c} = VALUES({c})" for c in self.columns)
+        return (f"INSERT INTO {self.table} ({cols}) VALUES ({', '.join(['%s'] * len(self.columns))}) "
+                f"ON DUPLICATE KEY UPDATE {updates}")
+
+    @staticmethod
+    def _tsv_value(value) -> str:
+        if value is None:
+            return '\\N'
+        return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+    def _load(self, batch: List[tuple]):
+        if self.mode == 'infile' and not self.sqlite_path:
+            # 先写到临时 TSV，再由服务端整体导入；REPLACE 保证重放时覆盖已有行
+            with tempfile.NamedTemporaryFile('w', suffix='.tsv', dir=self.spool_dir, delete=False,
+                                             encoding='utf-8', newline='\n') as f:
+                for row in batch:
+                    f.write('\t'.join(self._tsv_value(v) for v in row) + '\n')
+                tsv_path = f.name
+            try:
+                self.cursor.execute(
+                    f"LOAD DATA LOCAL INFILE %s REPLACE INTO TABLE {self.table} CHARACTER SET utf8mb4 "
+                    f"FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' "
+                    f"({', '.join(self.columns)})", (tsv_path.replace('\\', '/'),))
+            finally:
+                os.remove(tsv_path)
+        else:
+            self.cursor.executemany(self._insert_sql(), batch)
+
+    def _run(self, batches: List[List[tuple]], commit: bool):
+        attempt = 0
+        todo = batches
+        while True:
+            try:
+                if self.cursor is None:
+                    try:
+                        self._connect()
+                    except Exception as e:
+                        # 重连失败同样按可重试错误处理
+                        raise pymysql.OperationalError(str(e))
+                for batch in todo:
+                    self._load(batch)
+                if commit:
+                    self.conn.commit()
+                return
+            except RETRY_ERRORS as e:
+                attempt += 1
+                self.retries += 1
+                try:
+                    self.conn.rollback()
+                except (pymysql.Error, AttributeError):
+                    pass
+                self._disconnect()
+                if attempt > self.max_retries:
+                    self.errlog.add_error('load', f"table {self.table}: {len(batches)} batches failed; error: {e}")
+                    raise
+                # 回滚后重放当前事务中尚未提交的全部批次
+                todo = self.pending + batches
+                time.sleep(min(2 ** attempt, 30))
+
+    def add(self, row: tuple):
+        if self.start_time is None:
+            self.start_time = time.time()
+        self.batch.append(row)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def add_many(self, rows: Iterable[tuple]):
+        for row in rows:
+            self.add(row)
+
+    def flush(self, commit: bool = False):
+        if self.batch:
+            batch, self.batch = self.batch, []
+            start = time.time()
+            commit = commit or len(self.pending) + 1 >= self.commit_interval
+            self._run([batch], commit)
+            self.latency.append(time.time() - start)
+            self.load_seconds += time.time() - start
+            self.rows += len(batch)
+            self.batches += 1
+            self.pending = [] if commit else self.pending + [batch]
+        elif commit and self.pending:
+            self._run([], True)
+            self.pending = []
+
+    def close(self):
+        self.flush(commit=True)
+        self._disconnect()
+
+    def abort(self):
+        try:
+            if self.conn:
+                self.conn.rollback()
+        except pymysql.Error:
+            pass
+        self.batch = []
+        self.pending = []
+        self._disconnect()
+
+    def stats(self) -> Dict[str, float]:
+        latency = sorted(self.latency)
+        elapsed = time.time() - self.start_time if self.start_time else 0.0
+        return {'rows': self.rows, 'batches': self.batches, 'retries': self.retries,
+                'rows_per_sec': self.rows / elapsed if elapsed else 0.0,
+                'load_rows_per_sec': self.rows / self.load_seconds if self.load_seconds else 0.0,
+                'batch_latency_avg': sum(latency) / len(latency) if latency else 0.0,
+                'batch_latency_p95': latency[int(len(latency) * 0.95)] if latency else 0.0,
+                'batch_latency_max': latency[-1] if latency else 0.0}
+
+
+def measurement_rows(rows: Iterable[MroRow], main_zip: str, sub_zip_path: str, xml_name: str) -> Iterator[tuple]:
+    # 将解析结果转换为 mro_measurement 表的行，row_no 为 XML 内的行号，用于幂等重放
+    key = xml_key(main_zip, sub_zip_path, xml_name)
+    columns: Dict[tuple, Optional[List[int]]] = {}
+    for row_no, row in enumerate(rows):
+        idx = columns.get(row.smr)
+        if row.smr not in columns:
+            idx = columns[row.smr] = ([row.smr.index(c) if c in row.smr else -1 for c in MEASUREMENT_SMR]
+                                      if MEASUREMENT_SMR[0] in row.smr else None)
+        if idx is None:
+            continue
+        values = row.values
+        yield (key, row_no, row.enb_id, row.cell_id, row.timestamp, row.v_index,
+               *(values[i] if 0 <= i < len(values) and isinstance(values[i], int) else None for i in idx))
+
+
+def cell_kpi_rows(records: Iterable[Dict[str, float]], ftp_name: str, main_zip: str, sub_zip_path: str,
+                  xml_name: str, uptime=None) -> Iterator[tuple]:
+    # 一个 XML 的小区 KPI(CellStats.to_records)转换为 mro_cell_kpi 表的行
+    key = xml_key(main_zip, sub_zip_path, xml_name)
+    uptime = uptime or time.strftime("%Y-%m-%d %H:%M:%S")
+    for record in records:
+        yield (key, ftp_name, main_zip) + tuple(record[c] for c in CELL_KPI_COLUMNS[3:-1]) + (uptime,)
@@ -1,46 +1,607 @@
 import io
+import json
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
 import zipfile
-from typing import List, Dict, Optional
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from itertools import groupby
+from typing import List, Dict, Optional, Iterator, IO, Union, NamedTuple, Tuple, Callable
+from xml.etree import ElementTree
+
+from Metrics import registry
+
+# 内层压缩包解压后超过该大小时落到临时文件，避免整个读入内存
+SPOOL_THRESHOLD = 64 * 1024 * 1024
+# 已打开的内层压缩包缓存上限(字节)
+CACHE_BYTES = 256 * 1024 * 1024
+# 并行解压时已解压、未被取走的数据上限(字节)
+PARALLEL_BYTES = 256 * 1024 * 1024
+INDEX_SUFFIX = '.idx'
+INDEX_VERSION = 1
+
+
+class _MemberWindow(io.RawIOBase):
+    # 父文件中 [start, start + size) 区间的只读视图，用于直接访问未压缩的成员
+    def __init__(self, fileobj: IO[bytes], start: int, size: int):
+        super().__init__()
+        self.fileobj = fileobj
+        self.start = start
+        self.size = size
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        else:
+            self.pos = self.size + offset
+        self.pos = max(0, min(self.pos, self.size))
+        return self.pos
+
+    def read(self, n=-1):
+        remain = self.size - self.pos
+        if n is None or n < 0 or n > remain:
+            n = remain
+        if n <= 0:
+            return b''
+        self.fileobj.seek(self.start + self.pos)
+        data = self.fileobj.read(n)
+        self.pos += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class _InflateReader(io.RawIOBase):
+    # 对 deflate 压缩数据边读边解压，每次最多保留 chunk_size 字节的解压结果
+    def __init__(self, src: IO[bytes], chunk_size: int = 1024 * 1024):
+        super().__init__()
+        self.src = src
+        self.chunk_size = chunk_size
+        self.decompressor = zlib.decompressobj(-15)
+        self.buffer = b''
+        self.pos = 0
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.pos >= len(self.buffer):
+            if self.eof:
+                return 0
+            data = self.decompressor.unconsumed_tail or self.src.read(self.chunk_size)
+            if data:
+                self.buffer = self.decompressor.decompress(data, self.chunk_size)
+            else:
+                self.buffer = self.decompressor.flush()
+                self.eof = True
+            self.pos = 0
+        n = min(len(b), len(self.buffer) - self.pos)
+        b[:n] = self.buffer[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+
+class ArchiveCache:
+    # 已打开内层压缩包的 LRU 缓存，按解压后占用的字节数淘汰；淘汰某一层时同时淘汰其下的所有层
+    def __init__(self, max_bytes: int = CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.items: OrderedDict = OrderedDict()
+        self.total = 0
+
+    def get(self, key: str):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        self.items.move_to_end(key)
+        return item[0]
+
+    def put(self, key: str, obj, size: int):
+        self.items[key] = (obj, size)
+        self.total += size
+        for old_key in list(self.items):
+            if self.total <= self.max_bytes:
+                break
+            # 不淘汰刚放入的层及其上层，否则会关闭正在使用的文件
+            if (old_key in self.items and self.items[old_key][1] > 0
+                    and old_key != key and not key.startswith(old_key + '->')):
+                self.evict(old_key)
+
+    def evict(self, key: str):
+        for sub_key in [k for k in self.items if k == key or k.startswith(key + '->')]:
+            obj, size = self.items.pop(sub_key)
+            self.total -= size
+            obj.close()
+
+    def clear(self):
+        for key in list(self.items):
+            obj, _ = self.items.pop(key)
+            obj.close()
+        self.total = 0
 
 
 class MroZipClass:
-    def __init__(self, file_path: str):
+    def __init__(self, file_path: str, spool_threshold: int = SPOOL_THRESHOLD, spool_dir: Optional[str] = None,
+                 cache_bytes: int = CACHE_BYTES, fileobj: Optional[IO[bytes]] = None, workers: int = 0,
+                 parallel_bytes: int = PARALLEL_BYTES):
+        # fileobj 不为空时 bundle 已在内存中，直接从中索引与读取，file_path 只作为任务中的主包路径
         self.file_path = file_path
+        self.fileobj = fileobj
+        self.spool_threshold = spool_threshold
+        self.spool_dir = spool_dir
+        self.index: Optional[Dict[str, Dict[str, list]]] = None
+        self.cache = ArchiveCache(cache_bytes)
+        # workers > 1 时同一层中相互独立的成员在线程池中并行解压(zlib 解压时释放 GIL)
+        self.workers = workers
+        self.parallel_bytes = parallel_bytes
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.local = threading.local()
+        self.handles: List[IO[bytes]] = []
+        self.lock = threading.Lock()
+        self.prefetched = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        self.close()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        with self.lock:
+            for handle in self.handles:
+                handle.close()
+            self.handles = []
+        self.cache.clear()
+        if self.fileobj is not None:
+            self.fileobj.close()
+            self.fileobj = None
+
+    def persist(self):
+        # 把内存中的 bundle 写到 file_path，并保存索引，之后可由解析进程按路径读取
+        if self.fileobj is None or os.path.exists(self.file_path):
+            return
+        os.makedirs(os.path.dirname(self.file_path) or '.', exist_ok=True)
+        tmp_path = self.file_path + '.tmp'
+        self.fileobj.seek(0)
+        with open(tmp_path, 'wb') as f:
+            shutil.copyfileobj(self.fileobj, f, 1024 * 1024)
+        os.replace(tmp_path, self.file_path)
+        if self.index:
+            self.save_index()
+
+    @property
+    def index_path(self) -> str:
+        return self.file_path + INDEX_SUFFIX
+
+    def _index_stamp(self) -> list:
+        st = os.stat(self.file_path)
+        return [st.st_size, int(st.st_mtime)]
 
-    def __get_compression_library(self, file_path: Optional[io.BytesIO] = None) -> type(zipfile):
+    def save_index(self):
+        if self.index is None:
+            return
+        tmp_path = self.index_path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': INDEX_VERSION, 'stamp': self._index_stamp(), 'levels': self.index}, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            pass
+
+    def load_index(self) -> bool:
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') != INDEX_VERSION or data.get('stamp') != self._index_stamp():
+                return False
+            self.index = data['levels']
+            return True
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def build_index(self):
+        for _ in self.iter_xml_list():
+            pass
+
+    def __get_compression_library(self, file_path: Optional[Union[str, IO[bytes]]] = None) -> type(zipfile):
         if file_path is None:
-            file_path = io.BytesIO(open(self.file_path, 'rb').read())
+            file_path = self.file_path
         return zipfile if zipfile.is_zipfile(file_path) else None
 
-    def scan_xml_list(self, file_path: Optional[io.BytesIO] = None, parent_path: Optional[List[str]] = None,
-                      max_depth: Optional[int] = None) -> List[Dict[str, str]]:
-        if file_path is None:
-            file_path = io.BytesIO(open(self.file_path, 'rb').read())
-        xml_list = []
+    def _open_member(self, zf: zipfile.ZipFile, info: zipfile.ZipInfo) -> IO[bytes]:
+        # 未压缩的成员直接在外层文件中 seek 读取；压缩的成员按大小放入内存或临时文件
+        if info.compress_type == zipfile.ZIP_STORED:
+            return zf.open(info)
+        if info.file_size <= self.spool_threshold:
+            return io.BytesIO(zf.read(info))
+        spool = tempfile.TemporaryFile(dir=self.spool_dir)
+        with zf.open(info) as src:
+            shutil.copyfileobj(src, spool, 1024 * 1024)
+        spool.seek(0)
+        return spool
+
+    def iter_xml_list(self, file_path: Optional[Union[str, IO[bytes]]] = None,
+                      parent_path: Optional[List[str]] = None,
+                      max_depth: Optional[int] = None) -> Iterator[Dict[str, str]]:
         if max_depth is not None and parent_path and len(parent_path) >= max_depth:
-            return xml_list
-        zf = zipfile.ZipFile(file_path)
-        for name in zf.namelist():
-            if name.endswith('.xml'):
-                path = parent_path if parent_path else []
-                xml_list.append({'main': self.file_path, 'path': '->'.join(map(str, path)), 'xml_file': name})
-            elif not name.endswith('/'):
-                sub_path = parent_path + [name] if parent_path else [name]
-                sub_file = io.BytesIO(zf.read(name))
-                xml_list.extend(self.scan_xml_list(sub_file, sub_path, max_depth))
+            return
+        top = file_path is None and not parent_path
+        if file_path is None:
+            file_path = self.file_path if self.fileobj is None else self.fileobj
+        if top or self.index is None:
+            self.index = {}
+        with zipfile.ZipFile(file_path) as zf:
+            # 记录每一层压缩包的成员偏移表，供 read_xml_data 直接定位
+            self.index['->'.join(parent_path or [])] = {
+                info.filename: self._entry(info) for info in zf.infolist() if not info.is_dir()}
+            with closing(self._iter_members(zf, file_path)) as members:
+                for info, data in members:
+                    name = info.filename
+                    if name.endswith('.xml'):
+                        path = parent_path if parent_path else []
+                        yield {'main': self.file_path, 'path': '->'.join(map(str, path)), 'xml_file': name}
+                    else:
+                        sub_path = parent_path + [name] if parent_path else [name]
+                        sub_file = io.BytesIO(data) if data is not None else self._open_member(zf, info)
+                        with sub_file:
+                            # 非 zip 成员直接跳过
+                            if zipfile.is_zipfile(sub_file):
+                                yield from self.iter_xml_list(sub_file, sub_path, max_depth)
+        if top and self.fileobj is None:
+            self.save_index()
+
+    def _iter_members(self, zf: zipfile.ZipFile, source: Union[str, IO[bytes]]) -> Iterator[tuple]:
+        # 按成员顺序返回 (info, 解压后的数据)；顺序模式或不能并行解压的成员数据为 None，由调用方自行打开
+        infos = [info for info in zf.infolist() if not info.is_dir()]
+        if self.workers <= 1:
+            for info in infos:
+                yield info, None
+            return
+        read, view = self._parallel_source(source)
+        try:
+            jobs = ((info, read if read is not None and not info.filename.endswith('.xml') else None, self._entry(info))
+                    for info in infos)
+            with closing(self._prefetch(jobs)) as results:
+                yield from results
+        finally:
+            if view is not None:
+                view.release()
+
+    def scan_xml_list(self, file_path: Optional[Union[str, IO[bytes]]] = None, parent_path: Optional[List[str]] = None,
+                      max_depth: Optional[int] = None) -> List[Dict[str, str]]:
+        with registry().timer('zip.list.seconds'):
+            xml_list = list(self.iter_xml_list(file_path, parent_path, max_depth))
+        registry().inc('zip.xml_files', len(xml_list))
         return xml_list
 
-    def read_xml_data(self, xml_info: Dict[str, str]) -> Optional[bytes]:
+    @staticmethod
+    def _entry(info: zipfile.ZipInfo) -> list:
+        return [info.header_offset, info.compress_type, info.compress_size, info.file_size]
+
+    @staticmethod
+    def _data_start(header: bytes, header_offset: int) -> Optional[int]:
+        # 解析本地文件头，返回成员数据的起始偏移；加密的成员返回 None
+        if len(header) != 30 or header[:4] != b'PK\x03\x04':
+            raise zipfile.BadZipFile(f"Bad local file header at offset {header_offset}")
+        flags = struct.unpack('<H', header[6:8])[0]
+        if flags & 0x1:
+            return None
+        name_len, extra_len = struct.unpack('<HH', header[26:30])
+        return header_offset + 30 + name_len + extra_len
+
+    def _pool(self) -> ThreadPoolExecutor:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='unzip')
+        return self.executor
+
+    def _read_main(self, offset: int, size: int) -> bytes:
+        # 每个解压线程对主包持有自己的文件句柄，互不影响读取位置
+        handle = getattr(self.local, 'handle', None)
+        if handle is None or handle.closed:
+            handle = self.local.handle = open(self.file_path, 'rb')
+            with self.lock:
+                self.handles.append(handle)
+        handle.seek(offset)
+        return handle.read(size)
+
+    def _parallel_source(self, source: Union[str, IO[bytes]]) -> Tuple[Optional[Callable], Optional[memoryview]]:
+        # 返回可在多个线程中同时调用的 read(offset, size)：磁盘上的主包每个线程各开一个句柄，内存中的压缩包按
+        # memoryview 切片；其他(临时文件、未压缩成员的视图)返回 None，按顺序解压
+        if isinstance(source, str):
+            return self._read_main, None
+        if isinstance(source, io.BytesIO):
+            view = source.getbuffer()
+            return (lambda offset, size: view[offset:offset + size]), view
+        return None, None
+
+    def _inflate(self, read: Callable, entry: list) -> Optional[bytes]:
+        header_offset, _, compress_size, file_size = entry
+        data_start = self._data_start(bytes(read(header_offset, 30)), header_offset)
+        if data_start is None:
+            return None
+        with registry().timer('zip.inflate.seconds'):
+            data = zlib.decompress(read(data_start, compress_size), -15, max(file_size, 1))
+        if len(data) != file_size:
+            raise zipfile.BadZipFile(f"Bad member size at offset {header_offset}")
+        return data
+
+    def _prefetch(self, jobs: Iterator[tuple]) -> Iterator[tuple]:
+        # jobs 为 (item, read, entry)，read 不为空且可整体解压到内存的成员提交到线程池，按 jobs 的顺序返回 (item, 数据)
+        # 已解压未取走的数据总量不超过 parallel_bytes；每个调用方至少预取一个，嵌套调用不会相互等待
+        pending = deque()
+        next_job = next(jobs, None)
+        try:
+            while next_job is not None or pending:
+                while next_job is not None:
+                    item, read, entry = next_job
+                    parallel = (read is not None and entry is not None and entry[1] == zipfile.ZIP_DEFLATED
+                                and entry[3] <= self.spool_threshold)
+                    size = entry[3] if parallel else 0
+                    with self.lock:
+                        if parallel and pending and self.prefetched + size > self.parallel_bytes:
+                            break
+                        self.prefetched += size
+                    pending.append((item, self._pool().submit(self._inflate, read, entry) if parallel else None, size))
+                    next_job = next(jobs, None)
+                item, future, size = pending.popleft()
+                try:
+                    data = future.result() if future is not None else None
+                finally:
+                    with self.lock:
+                        self.prefetched -= size
+                yield item, data
+        finally:
+            for item, future, size in pending:
+                # 调用方提前结束时等待已开始的解压完成，之后才能释放 memoryview
+                if future is not None and not future.cancel():
+                    try:
+                        future.result()
+                    except Exception:
+                        pass
+                with self.lock:
+                    self.prefetched -= size
+
+    def _open_indexed(self, parent: IO[bytes], entry: list, stream: bool = False) -> Optional[IO[bytes]]:
+        # 按偏移表读取成员: 未压缩的返回父文件中的视图，deflate 压缩的解压到内存或临时文件
+        # stream 为 True 时返回边读边解压的只读流，不支持 seek
+        header_offset, compress_type, compress_size, file_size = entry
+        if compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            return None
+        parent.seek(header_offset)
+        data_start = self._data_start(parent.read(30), header_offset)
+        if data_start is None:
+            return None
+        if compress_type == zipfile.ZIP_STORED:
+            return io.BufferedReader(_MemberWindow(parent, data_start, file_size))
+        src = _MemberWindow(parent, data_start, compress_size)
+        if stream:
+            return io.BufferedReader(_InflateReader(src))
+        out = io.BytesIO() if file_size <= self.spool_threshold else tempfile.TemporaryFile(dir=self.spool_dir)
+        decompressor = zlib.decompressobj(-15)
+        while True:
+            chunk = src.read(1024 * 1024)
+            if not chunk:
+                break
+            out.write(decompressor.decompress(chunk))
+        out.write(decompressor.flush())
+        out.seek(0)
+        return out
+
+    def _open_member_at(self, parent: IO[bytes], level: str, name: str, stream: bool = False) -> IO[bytes]:
+        entry = self.index.get(level, {}).get(name)
+        sub_file = self._open_indexed(parent, entry, stream) if entry is not None else None
+        if sub_file is None:
+            zf = zipfile.ZipFile(parent)
+            sub_file = zf.open(name) if stream else self._open_member(zf, zf.getinfo(name))
+        return sub_file
+
+    def _open_level(self, path_list: List[str]) -> IO[bytes]:
+        # 逐层打开并缓存，同一个 bundle 中相邻 XML 共享已解压的内层压缩包
+        key = '->'.join(path_list)
+        level = self.cache.get(key)
+        if level is not None:
+            return level
+        if not path_list:
+            level = open(self.file_path, 'rb') if self.fileobj is None else self.fileobj
+            size = 0
+        else:
+            parent_key = '->'.join(path_list[:-1])
+            parent = self._open_level(path_list[:-1])
+            level = self._open_member_at(parent, parent_key, path_list[-1])
+            entry = self.index.get(parent_key, {}).get(path_list[-1])
+            # 未压缩的层只是父文件中的视图，不占用缓存空间
+            size = 0 if entry is None or entry[1] == zipfile.ZIP_STORED else entry[3]
+        self.cache.put(key, level, size)
+        return level
+
+    def open_xml(self, xml_info: Dict[str, str]) -> Optional[IO[bytes]]:
+        # 以流的方式打开 XML，内存占用与 XML 大小无关
+        with registry().timer('zip.open.seconds'):
+            path_list = self._prepare(xml_info)
+            if path_list is None:
+                return None
+            level = self._open_level(path_list)
+            return self._open_member_at(level, xml_info['path'], xml_info['xml_file'], stream=True)
+
+    def _prepare(self, xml_info: Dict[str, str]) -> Optional[List[str]]:
+        # 切换到 XML 所在的主包并加载索引，返回内层压缩包路径
         if 'path' not in xml_info or 'xml_file' not in xml_info:
             return None
         path_list = xml_info['path'].split('->') if xml_info['path'] else []
         main_path = xml_info.get('main', self.file_path)
         if main_path is None:
             return None
-        file_obj = io.BytesIO(open(main_path, 'rb').read())
-        for path in path_list:
-            zf = zipfile.ZipFile(file_obj)
-            sub_file = io.BytesIO(zf.read(path))
-            file_obj = sub_file
-        with zipfile.ZipFile(file_obj, 'r') as zf:
-            return zf.read(xml_info['xml_file'])
+        if main_path != self.file_path:
+            self.close()
+            self.file_path = main_path
+            self.index = None
+        if self.index is None and not self.load_index():
+            self.build_index()
+        return path_list
+
+    def read_xml_data(self, xml_info: Dict[str, str]) -> Optional[bytes]:
+        f = self.open_xml(xml_info)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def read_xml_many(self, xml_infos: List[Dict[str, str]]) -> Iterator[Tuple[Dict[str, str], Optional[bytes]]]:
+        # 按顺序读取多个 XML；并行模式下同一内层压缩包中相邻的 XML 在线程池中并行解压
+        if self.workers <= 1:
+            for xml_info in xml_infos:
+                yield xml_info, self.read_xml_data(xml_info)
+            return
+        for _, group in groupby(xml_infos, key=lambda x: (x.get('main', self.file_path), x.get('path'))):
+            group = list(group)
+            path_list = self._prepare(group[0])
+            if path_list is None:
+                for xml_info in group:
+                    yield xml_info, None
+                continue
+            level = self._open_level(path_list)
+            # 一组 XML 读完之前不会打开其他层，缓存不会淘汰正在读取的层
+            read, view = self._parallel_source(self.file_path if not path_list and self.fileobj is None else level)
+            entries = self.index.get(group[0]['path'], {})
+            try:
+                jobs = ((xml_info, read, entries.get(xml_info['xml_file'])) for xml_info in group)
+                with closing(self._prefetch(jobs)) as results:
+                    for xml_info, data in results:
+                        yield xml_info, data if data is not None else self.read_xml_data(xml_info)
+            finally:
+                if view is not None:
+                    view.release()
+
+
+class MroRow(NamedTuple):
+    # 一条测量记录，对应 <object> 下的一个 <v>；smr 为列名，values 与之一一对应
+    # v_index 为该 <v> 在 <object> 中的序号，0 表示一次新的测量样本，其余为同一样本的其他邻区
+    enb_id: int
+    cell_id: int
+    object_id: str
+    timestamp: str
+    smr: Tuple[str, ...]
+    values: Tuple[Optional[Union[int, float, str]], ...]
+    v_index: int = 0
+
+
+def _to_value(text: str) -> Optional[Union[int, float, str]]:
+    if text == 'NIL':
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        try:
+            return float(text)
+        except ValueError:
+            return text
+
+
+def _to_int(text: Optional[str]) -> int:
+    try:
+        return int(text)
+    except (TypeError, ValueError):
+        return -1
+
+
+class MroXmlParser:
+    # 基于 iterparse 的 MRO XML 流式解析，逐个 <object> 处理后立即清理元素，内存占用与 XML 大小无关
+    def __init__(self, zip_class: Optional[MroZipClass] = None):
+        self.zip_class = zip_class
+        self.rows = 0
+        self.files = 0
+        self.seconds = 0.0
+
+    @staticmethod
+    def _cell_id(object_id: str, enb_id: int) -> int:
+        # object id 通常为 ECI(eNB id * 256 + cell id)，部分厂家带 ":频点:PCI" 后缀
+        eci = _to_int(object_id.split(':', 1)[0].split('-', 1)[0])
+        if eci > 0xFF and enb_id >= 0 and eci >> 8 == enb_id:
+            return eci & 0xFF
+        return eci
+
+    def parse_file(self, fileobj: IO[bytes]) -> Iterator[MroRow]:
+        start = time.perf_counter()
+        rows = 0
+        enb_id = -1
+        start_time = ''
+        smr: Tuple[str, ...] = ()
+        root = None
+        measurement = None
+        try:
+            for event, elem in ElementTree.iterparse(fileobj, events=('start', 'end')):
+                tag = elem.tag
+                if event == 'start':
+                    if root is None:
+                        root = elem
+                    elif tag == 'eNB':
+                        enb_id = _to_int(elem.get('id', elem.get('userLabel')))
+                    elif tag == 'measurement':
+                        measurement = elem
+                    elif tag == 'fileHeader':
+                        start_time = elem.get('startTime', '')
+                    continue
+                if tag == 'smr':
+                    smr = tuple((elem.text or '').split())
+                elif tag == 'object':
+                    object_id = elem.get('id', '')
+                    cell_id = self._cell_id(object_id, enb_id)
+                    timestamp = elem.get('TimeStamp', elem.get('timeStamp', start_time))
+                    for v_index, v in enumerate(elem.iter('v')):
+                        rows += 1
+                        yield MroRow(enb_id, cell_id, object_id, timestamp, smr,
+                                     tuple(_to_value(x) for x in (v.text or '').split()), v_index)
+                    elem.clear()
+                    if measurement is not None:
+                        measurement.remove(elem)
+                elif tag in ('measurement', 'eNB'):
+                    elem.clear()
+                    if root is not None:
+                        # 已处理完的子元素仍挂在根节点下，需要一并清除
+                        root.clear()
+        finally:
+            seconds = time.perf_counter() - start
+            self.rows += rows
+            self.files += 1
+            self.seconds += seconds
+            metrics = registry()
+            metrics.inc('parse.rows', rows)
+            metrics.inc('parse.files')
+            metrics.observe('parse.file.seconds', seconds)
+
+    def iter_rows(self, xml_info: Dict[str, str]) -> Iterator[MroRow]:
+        if self.zip_class is None:
+            self.zip_class = MroZipClass(xml_info['main'])
+        fileobj = self.zip_class.open_xml(xml_info)
+        if fileobj is None:
+            return
+        with fileobj:
+            yield from self.parse_file(fileobj)
+
+    def stats(self) -> Dict[str, float]:
+        return {'files': self.files, 'rows': self.rows, 'seconds': self.seconds,
+                'rows_per_sec': self.rows / self.seconds if self.seconds else 0.0}
@@ -1,181 +1,763 @@
+import io
 import multiprocessing
 import os
+import queue
+import shutil
+import threading
 import time
 import ftputil
 from ftputil.error import FTPOSError
-from Config import FTPInfo, DownLog, ErrorLog, MysqlInfo
+from Config import FTPInfo, DownLog, ErrorLog, MysqlInfo, TuneInfo
+from FtpManifest import FtpManifest, StabilityTracker
+from FtpPool import FtpConnectionPool, open_ftp
+from FtpDownload import (DownloadEngine, FairQueue, make_scheduler, ChecksumMismatch, ChecksumUnsupported,
+                         remote_checksum, local_checksum)
+from Metrics import MetricsPublisher, registry
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
-from MroParse import MroZipClass
+from MroParse import MroZipClass, MroXmlParser, INDEX_SUFFIX
+from ParseWorker import parse_xml, kpi_loader, kpi_rows, save_kpis
 from SubTasks import MroTask
 
 class FtpScanClass:
 
-    def __init__(self, manager_dict):
+    def __init__(self, manager_dict, section='FTPInfo'):
         self.manager_dict = manager_dict
-        self.ftpinfo = FTPInfo()
+        self.ftpinfo = FTPInfo(section=section)
         self.ftpinfo.read()
         self.ftp = None
         self.errlog = None
+        self.tune = TuneInfo()
+        self.manifest = FtpManifest(self.ftpinfo.ftp_name, self.tune.get('Scan', 'manifest_path'))
+        self.scan_count = 0
+        self.time_shift = None
+        self.pool = FtpConnectionPool(self.ftpinfo,
+                                      max_size=self.ftpinfo.pool_size or self.tune.getint('Download', 'pool_size'),
+                                      timeout=self.tune.getint('Download', 'pool_timeout'),
+                                      check_idle=self.tune.getint('Download', 'check_idle'))
         self.connect_to_ftp()
-        self.db = DownLog()
+        # 服务器时区未知时 LIST 的修改时间不能与本地时间比较，只按连续 stable_scans 次扫描未变化判定上传完成
+        self.tracker = StabilityTracker(self.tune.getint('Scan', 'stable_scans'),
+                                        self.tune.getfloat('Scan', 'stable_age') if self.time_shift is not None else 0)
+        self.db = DownLog(self.ftpinfo)
+        self.checksum_unsupported = set()
+        # 正在下载的远端路径: 租约到期后重新排队的文件不会与仍在下载的线程同时写同一个 .part 文件
+        self.downloading = set()
+        self.downloading_lock = threading.Lock()
 
     def connect_to_ftp(self):
         try:
-            self.ftp = ftputil.FTPHost(self.ftpinfo.host,
-                                       self.ftpinfo.user,
-                                       self.ftpinfo.passwd,
-                                       self.ftpinfo.port,
-                                       timeout=60)
+            self.ftp = open_ftp(self.ftpinfo)
+            self.ftp.stat_cache.resize(self.tune.getint('Scan', 'stat_cache_size'))
         except (FTPOSError, Exception) as e:
             # self.errlog.add_error('connect_to_ftp', 'Error for Ftp Connect: {}'.format(str(e)))
             raise Exception('Error for Ftp Connect: {}'.format(str(e)))
+        self.time_shift = self._set_time_shift()
+
+    def _set_time_shift(self):
+        # LIST 中的修改时间是服务器时区的时间，设置 time_shift 后 ftputil 换算为 UTC，才能与本地时间比较
+        # ftpinfo.ini 的 time_shift 为秒数时直接使用，为 sync 时在 sync_path 下写临时文件测量(需要写权限)；
+        # 未配置或测量失败时返回 None
+        time_shift = self.ftpinfo.time_shift.strip()
+        if not time_shift:
+            return None
+        try:
+            if time_shift == 'sync':
+                self.ftp.chdir(self.ftpinfo.sync_path)
+                self.ftp.synchronize_times()
+            else:
+                self.ftp.set_time_shift(float(time_shift))
+            return self.ftp.time_shift()
+        except (ftputil.error.FTPError, ValueError) as e:
+            ErrorLog('FtpScanClass').add_error('time_shift', 'source {} time_shift {} error: {}'.format(
+                self.ftpinfo.ftp_name, time_shift, str(e)))
+            return None
 
     def stop(self):
         self.manager_dict['status'] = False
 
     def scan_newfiles(self, errlog):
+        source = self.ftpinfo.ftp_name
+        with registry().timer('scan.seconds', source=source):
+            if self.tune.get('Scan', 'scan_mode') == 'incremental':
+                new_files = self.scan_newfiles_incremental(errlog)
+            else:
+                new_files = self.scan_newfiles_full(errlog)
+        registry().inc('scan.new_files', len(new_files), source=source)
+        registry().set('scan.pending_files', len(self.tracker.pending), source=source)
+        return new_files
+
+    def scan_newfiles_full(self, errlog):
         ftp_path = self.ftpinfo.sync_path
         scan_filter = self.ftpinfo.scan_filter.split('|')
         new_files = []
         self.errlog = errlog
         try:
+            self.ftp.stat_cache.clear()
+            self.tracker.begin()
             for root, dirs, files in self.ftp.walk(ftp_path):
                 if not self.manager_dict['status']:
                     break
-                for name in files:
-                    ftp_file = self.ftp.path.join(root, name)
-                    if ftp_file.endswith('.zip') and not self.db.isexists(ftp_file):
-                        dir_name = self.ftp.path.dirname(ftp_path)
-                        if not any(temp_dir in dir_name for temp_dir in scan_filter):
+                zip_files = [self.ftp.path.join(root, name) for name in files if name.endswith('.zip')]
+                for ftp_file in self.db.filter_new(zip_files):
+                    dir_name = self.ftp.path.dirname(ftp_path)
+                    if not any(temp_dir in dir_name for temp_dir in scan_filter):
+                        with registry().timer('ftp.stat.seconds', source=self.ftpinfo.ftp_name):
                             file_size = self.ftp.path.getsize(ftp_file)
-                            file_mtime = time.time()
-                            file_info = (ftp_file, file_size, file_mtime, self.ftpinfo.ftp_name)
-                            new_files.append(file_info)
+                            file_mtime = self.ftp.path.getmtime(ftp_file)
+                        if self.tracker.observe(ftp_file, file_size, file_mtime):
+                            new_files.append(self._file_info(ftp_file, file_size, file_mtime))
+            self.tracker.end()
         except (FTPOSError, Exception) as e:
             self.errlog.add_error('scan_newfiles', 'Error occurred while scanning New FTP directory:{}'.format(str(e)))
             return []
 
         return sorted(new_files, key=lambda f: f[1])
 
+    def scan_newfiles_incremental(self, errlog):
+        # 增量扫描: 只重新列出发生变化的目录，文件大小直接取自 LIST 结果，不再逐个发送 SIZE
+        ftp_path = self.ftpinfo.sync_path
+        scan_filter = [f for f in self.ftpinfo.scan_filter.split('|') if f]
+        new_files = []
+        self.errlog = errlog
+        full_every = self.tune.getint('Scan', 'full_scan_every')
+        full = full_every > 0 and self.scan_count % full_every == 0
+        self.scan_count += 1
+        try:
+            self.ftp.stat_cache.clear()
+            relist = self.tracker.pending_dirs(self.ftp.path.dirname)
+            self.tracker.begin()
+            for root, files, changed in self.manifest.walk(self.ftp, ftp_path, full, self.manager_dict, relist,
+                                                             self.tune.getfloat('Scan', 'mtime_precision'),
+                                                             self.time_shift is not None):
+                if any(temp_dir in root for temp_dir in scan_filter):
+                    continue
+                zip_files = {self.ftp.path.join(root, name): attr for name, attr in files.items()
+                             if name.endswith('.zip')}
+                for ftp_file in self.db.filter_new(zip_files):
+                    file_size, file_mtime = zip_files[ftp_file]
+                    if self.tracker.observe(ftp_file, file_size, file_mtime):
+                        new_files.append(self._file_info(ftp_file, file_size, file_mtime))
+            self.tracker.end()
+            self.manifest.save()
+            registry().inc('scan.dirs_listed', self.manifest.listed, source=self.ftpinfo.ftp_name)
+            registry().inc('scan.dirs_reused', self.manifest.reused, source=self.ftpinfo.ftp_name)
+        except (FTPOSError, Exception) as e:
+            self.errlog.add_error('scan_newfiles_incremental',
+                                  'Error occurred while scanning New FTP directory:{}'.format(str(e)))
+            return []
+
+        return sorted(new_files, key=lambda f: f[1])
+
+    def _file_info(self, ftp_file, file_size, file_mtime):
+        # file_info[2] 为计算新鲜度(调度优先级与 SLA 指标)的起点: 时区已知时为换算到 UTC 的 mtime，
+        # 未知时 LIST 的时间不能与本地时间比较(ftputil 还会把"未来"的时间退回一年)，改用首次扫描到该文件的时间
+        file_time = file_mtime if self.time_shift is not None else self.tracker.first_seen.get(ftp_file, time.time())
+        return ftp_file, file_size, file_time, self.ftpinfo.ftp_name
+
     def save_all_files_log(self):
         self.ftpinfo.read()
         ftp_path = self.ftpinfo.sync_path
         try:
             for root, dirs, files in self.ftp.walk(ftp_path):
-                for name in files:
-                    ftp_file = self.ftp.path.join(root, name)
-                    if ftp_file.endswith('.zip') and not self.db.isexists(ftp_file):
-                        self.db.savelog(ftp_file)
+                zip_files = [self.ftp.path.join(root, name) for name in files if name.endswith('.zip')]
+                if zip_files and not self.db.savelog_many(zip_files):
+                    return False
         except (FTPOSError, Exception) as e:
             # self.errlog.add_error('save_all_files_log',
             # 'Error occurred while scanning All FTP directory {}'.format(str(e)))
             return False
         return True
 
-    def file_download(self, file_info):
-        filepath = file_info[0]
+    def local_path(self, filepath):
+        return os.path.join(self.ftpinfo.down_path, self.ftpinfo.ftp_name,
+                            *os.path.normpath(filepath).split(os.path.sep))
+
+    def file_download(self, file_info, callback=None, in_memory=False):
+        with self.downloading_lock:
+            if file_info[0] in self.downloading:
+                registry().inc('ftp.download.busy', source=self.ftpinfo.ftp_name)
+                return None
+            self.downloading.add(file_info[0])
         try:
-            self.ftpinfo.read()
-            filesize = file_info[1]
-            scantime = file_info[2]
+            return self._file_download(file_info, callback, in_memory)
+        finally:
+            with self.downloading_lock:
+                self.downloading.discard(file_info[0])
 
-            with ftputil.FTPHost(self.ftpinfo.host, self.ftpinfo.user, self.ftpinfo.passwd, self.ftpinfo.port,
-                                 timeout=60) as ftp:
+    def _file_download(self, file_info, callback=None, in_memory=False):
+        # 连接从连接池借用，可被多个下载线程同时调用
+        # in_memory 为 True 时下载到内存缓冲区并返回缓冲区，不写 down_path(大小已由调用方按 Download.memory_max 限制)
+        # 连接中断时换一个连接重试 Download.retries 次，下载到磁盘的从已下载的位置续传
+        filepath = file_info[0]
+        download_path = self.local_path(filepath)
+        if not in_memory and os.path.isfile(download_path):
+            # 上次已下载但未登记(进程在登记前退出): 能做校验和时改回 .part 文件，经过大小与校验和确认后才使用，
+            # 大小相同时不再传输，内容与远端不一致时丢弃并重新下载；只能比较大小时不可信，删除后重新下载
+            algorithm = self.tune.get('Download', 'checksum')
+            try:
+                if algorithm and algorithm not in self.checksum_unsupported:
+                    os.replace(download_path, download_path + '.part')
+                    registry().inc('ftp.download.reused', source=self.ftpinfo.ftp_name)
+                else:
+                    os.remove(download_path)
+            except OSError as e:
+                # 文件被占用、没有权限等: 本次不下载，下一轮扫描重试
+                ErrorLog('FtpScanClass').add_error('file_download', 'leftover file {} error: {}'.format(
+                    download_path, str(e)))
+                registry().inc('ftp.download.failed', source=self.ftpinfo.ftp_name)
+                return None
+        retries = self.tune.getint('Download', 'retries')
+        for attempt in range(retries + 1):
+            ftp = None
+            broken = False
+            try:
+                ftp = self.pool.acquire()
                 ftp_path = os.path.dirname(filepath)
                 ftp.chdir(ftp_path)
-                download_path = os.path.join(
-                    self.ftpinfo.down_path,
-                    self.ftpinfo.ftp_name,
-                    *os.path.normpath(filepath).split(os.path.sep))
-
-                os.makedirs(os.path.dirname(download_path), exist_ok=True)
-                init_size = filesize
-                size_change_time = scantime
-                # 检测文件大小是否发生变化，如果在一段时间内文件大小未发生变化则开始下载
-                while self.manager_dict['status']:
-                    cur_size = ftp.stat(filepath).cur_size = ftp.stat(filepath).st_size
-                    if cur_size != init_size:
-                        init_size = cur_size
-                        size_change_time = time.time()
-                    elif time.time() - size_change_time >= 9:
-                        # 文件大小未发生变化9秒，判定为对方已经上传完成
-                        ftp.download(filepath, download_path)
-                        return download_path
-                    time.sleep(3)
-
-        except (ftputil.error.FTPIOError, Exception) as e:
-            # self.errlog.add_error('file_download',
-            #                      'Error occurred while downloading file {}: {}'.format(filepath, str(e)))
-            return None
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
+                # 上传是否完成已由扫描阶段的 StabilityTracker 判定，这里直接下载
+                with registry().timer('ftp.download.seconds', source=self.ftpinfo.ftp_name):
+                    if in_memory:
+                        result = self._download_memory(ftp, file_info, callback)
+                    else:
+                        result = self._download_disk(ftp, file_info, download_path, callback)
+                registry().inc('ftp.download.files', source=self.ftpinfo.ftp_name,
+                               target='memory' if in_memory else 'disk')
+                registry().inc('ftp.download.bytes', file_info[1], source=self.ftpinfo.ftp_name)
+                return result
+
+            except (ftputil.error.FTPIOError, Exception) as e:
+                # self.errlog.add_error('file_download',
+                #                      'Error occurred while downloading file {}: {}'.format(filepath, str(e)))
+                broken = isinstance(e, (FTPOSError, OSError))
+                if attempt < retries and self.manager_dict['status']:
+                    registry().inc('ftp.download.retries', source=self.ftpinfo.ftp_name)
+                    continue
+                registry().inc('ftp.download.failed', source=self.ftpinfo.ftp_name)
+                return None
+            finally:
+                if ftp is not None:
+                    self.pool.release(ftp, broken)
+        return None
+
+    def _copy(self, src, dst, callback):
+        while True:
+            chunk = src.read(64 * 1024)
+            if not chunk:
+                break
+            dst.write(chunk)
+            if callback is not None:
+                callback(chunk)
+
+    def _download_memory(self, ftp, file_info, callback):
+        buffer = io.BytesIO()
+        with ftp.open(file_info[0], 'rb') as src:
+            self._copy(src, buffer, callback)
+        if buffer.tell() != file_info[1]:
+            raise Exception(f"Size mismatch for {file_info[0]}: local {buffer.tell()}, remote {file_info[1]}")
+        buffer.seek(0)
+        self._verify(ftp, file_info[0], buffer)
+        buffer.seek(0)
+        return buffer
+
+    def _download_disk(self, ftp, file_info, download_path, callback):
+        # 先写入 .part 文件，已有 .part 时用 REST 从其末尾续传；大小与校验和一致后才改名为正式文件
+        part_path = download_path + '.part'
+        os.makedirs(os.path.dirname(download_path), exist_ok=True)
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        if offset > file_info[1]:
+            # 远端文件比已下载的部分还小(已被重新上传)，从头下载
+            offset = 0
+        if offset:
+            registry().inc('ftp.download.resumed', source=self.ftpinfo.ftp_name)
+            registry().inc('ftp.download.resumed_bytes', offset, source=self.ftpinfo.ftp_name)
+        if offset < file_info[1] or not offset:
+            with ftp.open(file_info[0], 'rb', rest=offset or None) as src, \
+                    open(part_path, 'ab' if offset else 'wb') as dst:
+                self._copy(src, dst, callback)
+        size = os.path.getsize(part_path)
+        if size != file_info[1]:
+            if size > file_info[1]:
+                os.remove(part_path)
+            raise Exception(f"Size mismatch for {file_info[0]}: local {size}, remote {file_info[1]}")
+        with open(part_path, 'rb') as f:
+            try:
+                self._verify(ftp, file_info[0], f)
+            except ChecksumMismatch:
+                # 内容不一致时丢弃已下载的部分，下次从头下载
+                os.remove(part_path)
+                raise
+        os.replace(part_path, download_path)
+        return download_path
+
+    def _verify(self, ftp, filepath, fileobj):
+        # Download.checksum 为空时只校验大小；服务器不支持所选算法时记录下来，之后不再尝试
+        algorithm = self.tune.get('Download', 'checksum')
+        if not algorithm or algorithm in self.checksum_unsupported:
+            return
+        try:
+            # ftputil 没有公开底层会话，校验命令直接发给 ftplib 会话
+            remote = remote_checksum(ftp._session, filepath, algorithm)
+        except ChecksumUnsupported:
+            self.checksum_unsupported.add(algorithm)
+            registry().inc('ftp.checksum.unsupported', source=self.ftpinfo.ftp_name)
+            return
+        local = local_checksum(fileobj, algorithm)
+        if remote != local:
+            registry().inc('ftp.checksum.mismatch', source=self.ftpinfo.ftp_name)
+            raise ChecksumMismatch(f"{algorithm} mismatch for {filepath}: local {local}, remote {remote}")
+        registry().inc('ftp.checksum.verified', source=self.ftpinfo.ftp_name)
+
+    def close(self):
         if self.ftp is not None:
             self.ftp.close()
+        self.pool.close()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
 
 class FtpScanProcess(multiprocessing.Process):
-    def __init__(self, manager_dict, interval=60):
+    # 扫描 -> 下载 -> 索引 -> 任务登记 四个阶段各自独立运行，阶段之间用有界队列连接
+    # 本地磁盘空间不足或待解析任务积压超过阈值时暂停下载，解析由 ParseSupervisor 从 mrotask 表消费
+    # ftpinfo.ini 中的每个数据源各有一个扫描线程与连接池，下载线程由 FairQueue 在各数据源之间轮转分配
+    # 不超过 Download.memory_max 的 bundle 下载到内存，索引后直接在本进程解析，只在需要归档或重试时写入 down_path
+    def __init__(self, manager_dict, interval=60, result_queue=None):
         super().__init__()
         self.mysqlinfo = None
         self.mro_tasks = None
-        self.ftp_scan = None
+        self.sources = {}
+        self.download_engine = None
         self.interval = interval
         self.manager_dict = manager_dict
         manager_dict['status'] = True
         self.errlog = None
-        self.semaphore = asyncio.Semaphore(1)
+        self.tune = None
+        self.queues = {}
+        # (ftp_name, 路径) -> 租约到期时间，0 表示在队列中等待(不计时)
+        self.inflight = {}
+        self.inflight_lock = threading.Lock()
+        self.parse_backlog = 0
+        self.paused = ''
+        # 内存解析的结果与解析进程一样上报给 ParseSupervisor
+        self.result_queue = result_queue
+        self.buffered = 0
 
     def run(self):
         self.manager_dict['status'] = True
         self.errlog = ErrorLog('FtpScanProcess')
-        self.ftp_scan = FtpScanClass(self.manager_dict)
+        self.tune = TuneInfo()
+        publisher = MetricsPublisher(self.manager_dict, 'FtpScanProcess',
+                                     self.tune.getfloat('Metrics', 'publish_interval')).start()
+        self.download_engine = DownloadEngine()
         self.mro_tasks = MroTask()
         self.mysqlinfo = MysqlInfo(section='LocalServer')
         print(self.mysqlinfo.host)
 
-        if self.ftp_scan.ftp is None:
-            self.errlog.add_error('run', 'error FTP Connect Fail')
-            self.manager_dict['status'] = False
+        # 下载、索引、内存解析三个阶段按同一调度策略取文件，大文件占用的线程数由 large_slots 限制
+        scheduler = make_scheduler(self.tune)
+        large_slots = self.tune.getint('Scheduler', 'large_slots')
 
+        def stage_queue(size, workers, **kwargs):
+            return FairQueue(size, scheduler=scheduler, large_slots=large_slots, workers=workers, **kwargs)
+
+        self.queues = {'download': stage_queue(self.tune.getint('Pipeline', 'download_queue'),
+                                               self.tune.getint('Download', 'workers')),
+                       'index': stage_queue(self.tune.getint('Pipeline', 'index_queue'),
+                                            self.tune.getint('Pipeline', 'index_workers'),
+                                            key=lambda item: item[0][3], file_info=lambda item: item[0]),
+                       'parse': stage_queue(self.tune.getint('Pipeline', 'parse_queue'),
+                                            self.tune.getint('Pipeline', 'parse_workers'),
+                                            key=lambda item: item[0][3], file_info=lambda item: item[0]),
+                       'register': queue.Queue(self.tune.getint('Pipeline', 'register_queue'))}
+        threads = [threading.Thread(target=self.scan_stage, args=(section,), name=f'scan_{section}')
+                   for section in FTPInfo.sections()]
+        # 启用 Control 时按上界启动下载线程，实际并发由 download 队列的 capacity 控制
+        download_workers = self.tune.getint('Download', 'workers')
+        if self.tune.getboolean('Control', 'enabled'):
+            self.queues['download'].set_capacity(download_workers)
+            download_workers = max(download_workers, self.tune.getint('Control', 'download_max'))
+        threads += [threading.Thread(target=self.download_stage, name=f'download_{i}')
+                    for i in range(download_workers)]
+        threads += [threading.Thread(target=self.index_stage, name=f'index_{i}')
+                    for i in range(self.tune.getint('Pipeline', 'index_workers'))]
+        if self.tune.getint('Download', 'memory_max') > 0:
+            threads += [threading.Thread(target=self.parse_stage, name=f'parse_{i}')
+                        for i in range(self.tune.getint('Pipeline', 'parse_workers'))]
+        threads.append(threading.Thread(target=self.register_stage, name='register'))
+        for thread in threads:
+            thread.start()
+        while self.manager_dict['status']:
+            self._apply_control()
+            self.manager_dict['pipeline_stats'] = self.pipeline_stats()
+            self.manager_dict['download_stats'] = self.download_engine.stats.snapshot()
+            time.sleep(1)
+        for thread in threads:
+            thread.join()
+        for ftp_scan in self.sources.values():
+            ftp_scan.close()
+        publisher.stop()
+        # 子进程退出时不会执行 atexit，这里主动写出缓冲中的错误日志
+        self.errlog.flush(5)
+
+    def _apply_control(self):
+        # ConcurrencyController 或控制接口写入 manager_dict['control']，运行中生效，无需重启进程
+        if not self.tune.getboolean('Control', 'enabled'):
+            return
+        control = self.manager_dict.get('control')
+        if not control:
+            return
+        self.queues['download'].set_capacity(control.get('download_workers', 0))
+        self.interval = control.get('scan_interval', self.interval)
+
+    def pipeline_stats(self):
+        with self.inflight_lock:
+            inflight = len(self.inflight)
+        metrics = registry()
+        for name, q in self.queues.items():
+            metrics.set('pipeline.queue', q.qsize(), stage=name)
+        metrics.set('pipeline.inflight', inflight)
+        metrics.set('pipeline.paused', 1 if self.paused else 0)
+        metrics.set('pipeline.buffered_bytes', self.buffered)
+        return {'queues': {name: q.qsize() for name, q in self.queues.items()},
+                'sources': self.queues['download'].sizes(),
+                'inflight': inflight,
+                'buffered': self.buffered,
+                'parse_backlog': self.parse_backlog,
+                'paused': self.paused}
+
+    def _put(self, name, item):
+        # 下游队列已满时阻塞等待，形成背压
+        self._hold(item if name == 'download' else item[0], False)
         while self.manager_dict['status']:
             try:
-                new_files = self.ftp_scan.scan_newfiles(self.errlog)
+                self.queues[name].put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, name):
+        while self.manager_dict['status']:
+            try:
+                item = self.queues[name].get(timeout=1)
+            except queue.Empty:
+                continue
+            self._hold(item if name == 'download' else item[0])
+            return item
+        return None
+
+    def _hold(self, file_info, held=True):
+        # 租约: 阶段线程取出文件时开始计时，放入下一个队列后停止计时(排队等待不算超时)
+        # 线程卡住或异常退出时租约到期，扫描线程会把该文件重新排队
+        key = (file_info[3], file_info[0])
+        with self.inflight_lock:
+            if key in self.inflight:
+                self.inflight[key] = time.time() + self.tune.getint('Pipeline', 'download_lease') if held else 0
+
+    def _renewer(self, file_info):
+        # 下载过程中收到数据时续约(间隔不超过 download_lease 的 1/4，至多 10 秒一次)，
+        # 传输时间超过 download_lease 的大文件不会在下载中被重新排队
+        interval = min(10.0, self.tune.getint('Pipeline', 'download_lease') / 4)
+        renewed = [time.time()]
+
+        def progress(chunk):
+            now = time.time()
+            if now - renewed[0] >= interval:
+                renewed[0] = now
+                self._hold(file_info)
+        return progress
+
+    def _done(self, file_info):
+        with self.inflight_lock:
+            self.inflight.pop((file_info[3], file_info[0]), None)
+
+    def _reserve(self, size):
+        # 内存中的 bundle 总大小不超过 Download.memory_budget，超出时改为下载到磁盘
+        if not 0 < size <= self.tune.getint('Download', 'memory_max'):
+            return False
+        with self.inflight_lock:
+            if self.buffered + size > self.tune.getint('Download', 'memory_budget'):
+                return False
+            self.buffered += size
+            return True
+
+    def _release(self, size):
+        with self.inflight_lock:
+            self.buffered -= size
+
+    def _backpressure(self):
+        min_free = self.tune.getint('Pipeline', 'min_free_mb') * 1024 * 1024
+        max_backlog = self.tune.getint('Pipeline', 'max_parse_backlog')
+        for down_path in {ftp_scan.ftpinfo.down_path for ftp_scan in list(self.sources.values())}:
+            try:
+                os.makedirs(down_path, exist_ok=True)
+                if shutil.disk_usage(down_path).free < min_free:
+                    return 'disk'
+            except OSError:
+                pass
+        if 0 < max_backlog <= self.parse_backlog:
+            return 'parse_backlog'
+        return ''
+
+    def _connect_source(self, section, errlog):
+        try:
+            ftp_scan = FtpScanClass(self.manager_dict, section)
+        except Exception as e:
+            errlog.add_error('connect_source', 'source {} error: {}'.format(section, str(e)))
+            return None
+        self.sources[ftp_scan.ftpinfo.ftp_name] = ftp_scan
+        self.queues['download'].set_limit(ftp_scan.ftpinfo.ftp_name, ftp_scan.pool.max_size)
+        return ftp_scan
+
+    def scan_stage(self, section):
+        errlog = ErrorLog('FtpScanProcess')
+        ftp_scan = None
+        while self.manager_dict['status']:
+            try:
+                # 数据源连接失败时只影响自身，下一轮重试
+                ftp_scan = ftp_scan or self._connect_source(section, errlog)
+                new_files = ftp_scan.scan_newfiles(errlog) if ftp_scan is not None else []
                 if new_files:
-                    for file_info in new_files:
-                        if not self.manager_dict['status']:
-                            break
-                        local_file = self.ftp_scan.file_download(file_info)
-                        if local_file is not None:
-                            asyncio.run(self.parse_mro_file(local_file, file_info[3]))
-                        with DownLog() as db:
-                            print("save log")
-                            db.savelog(file_info[0])
-                for i in range(self.interval):
-                    if self.manager_dict['status']:
-                        time.sleep(1)
-                    else:
+                    ftp_scan.ftpinfo.read()
+                for file_info in new_files:
+                    key = (file_info[3], file_info[0])
+                    with self.inflight_lock:
+                        deadline = self.inflight.get(key)
+                        if deadline is not None and (deadline == 0 or deadline > time.time()):
+                            continue
+                        if deadline is not None:
+                            registry().inc('pipeline.lease_expired', source=file_info[3])
+                            errlog.add_error('ScanFtpNewFiles', 'lease expired, requeue {}'.format(file_info[0]))
+                        self.inflight[key] = 0
+                    if not self._put('download', file_info):
                         break
             except Exception as e:
-                self.errlog.add_error('ScanFtpNewFiles', 'error: {}'.format(str(e)))
+                errlog.add_error('ScanFtpNewFiles', 'error: {}'.format(str(e)))
+            for i in range(int(self.interval)):
+                if self.manager_dict['status']:
+                    time.sleep(1)
+                else:
+                    break
+
+    def download_stage(self):
+        errlog = ErrorLog('FtpScanProcess')
+        while self.manager_dict['status']:
+            self.paused = self._backpressure()
+            if self.paused:
+                time.sleep(1)
                 continue
+            file_info = self._get('download')
+            if file_info is None:
+                break
+            in_memory = self._reserve(file_info[1])
+            try:
+                file_info, local_file = self.download_engine.download_one(file_info, self.sources[file_info[3]],
+                                                                          in_memory, self._renewer(file_info))
+            except Exception as e:
+                # 单个文件的意外错误不能让下载线程退出，按下载失败处理
+                errlog.add_error('download_stage', 'download file {} ; error: {}'.format(file_info[0], str(e)))
+                local_file = None
+            finally:
+                self.queues['download'].task_done(file_info)
+            if local_file is None:
+                # 下载失败的文件不记入 DownLog，下一轮扫描会重新下载
+                if in_memory:
+                    self._release(file_info[1])
+                self._done(file_info)
+                continue
+            if not self._put('index', (file_info, local_file)):
+                break
 
-    async def parse_mro_file(self, file_path, ftp_name):
-        async with self.semaphore:
+    def index_stage(self):
+        errlog = ErrorLog('FtpScanProcess')
+        while self.manager_dict['status']:
+            item = self._get('index')
+            if item is None:
+                break
+            file_info, local_file = item
+            if not isinstance(local_file, str):
+                # 内存中的 bundle: 直接从缓冲区索引，交给解析阶段
+                zip_class = self.mro_zip(self.sources[file_info[3]].local_path(file_info[0]), local_file)
+                try:
+                    task_list = zip_class.scan_xml_list()
+                except Exception as e:
+                    errlog.add_error('scan_sub_tasks', "unmrozip from file {} ; error: {}".format(
+                        zip_class.file_path, str(e)))
+                    task_list = None
+                finally:
+                    self.queues['index'].task_done(item)
+                if task_list is None:
+                    # 损坏或不完整的 bundle 不登记，丢弃缓冲区，下一轮扫描重新下载
+                    zip_class.close()
+                    self._release(file_info[1])
+                    self._index_failed(file_info)
+                    continue
+                if not self._put('parse', (file_info, zip_class, task_list)):
+                    zip_class.close()
+                    self._release(file_info[1])
+                    break
+                continue
             try:
-                with ThreadPoolExecutor(max_workers=1) as pool:
-                    await self.mro_tasks.connect_to_db(self.mysqlinfo.user, self.mysqlinfo.passwd,
-                                                       self.mysqlinfo.host, self.mysqlinfo.port)
-                    task_list = \
-                        await asyncio.get_running_loop().run_in_executor(pool, MroZipClass(file_path).scan_xml_list)
+                with self.mro_zip(local_file) as zip_class:
+                    task_list = zip_class.scan_xml_list()
+            except Exception as e:
+                errlog.add_error('scan_sub_tasks', "unmrozip from file {} ; error: {}".format(local_file, str(e)))
+                task_list = None
+            finally:
+                self.queues['index'].task_done(item)
+            if task_list is None:
+                # 不写 DownLog 并删除本地文件，下一轮扫描重新下载(否则文件在 file_download 中会被当作已下载复用)
+                for path in (local_file, local_file + INDEX_SUFFIX):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                self._index_failed(file_info)
+                continue
+            if not self._put('register', (file_info, local_file, task_list)):
+                break
+
+    def _index_failed(self, file_info):
+        registry().inc('pipeline.index_failed', source=file_info[3])
+        self._done(file_info)
+
+    def parse_stage(self):
+        # 解析内存中的 bundle，各 XML 以解析结果的状态登记；解析失败的 XML 登记为 unparse，
+        # 并把 bundle 写入 down_path，由解析进程重试
+        errlog = ErrorLog('FtpScanProcess')
+        parser = MroXmlParser()
+        loader = kpi_loader()
+        rows = []
+        while self.manager_dict['status']:
+            item = self._get('parse')
+            if item is None:
+                break
+            file_info, zip_class, task_list = item
+            parser.zip_class = zip_class
+            tasks = []
+            try:
+                for xml_info in task_list:
+                    if not self.manager_dict['status']:
+                        # 停止时放弃该 bundle，下次启动重新下载
+                        tasks = None
+                        break
+                    start = time.time()
+                    rows_before = parser.rows
+                    stats = None
+                    try:
+                        stats = parse_xml(parser, xml_info, self.tune)
+                        rows += kpi_rows(stats, file_info[3], xml_info)
+                        status = 'parsed'
+                    except Exception as e:
+                        errlog.add_error('parse_stage', 'xml {} error: {}'.format(
+                            '->'.join(filter(None, (xml_info['main'], xml_info['path'], xml_info['xml_file']))),
+                            str(e)))
+                        status = 'unparse'
+                    tasks.append(dict(xml_info, task_status=status))
+                    if self.result_queue is not None:
+                        self.result_queue.put({'worker': 'sync', 'pid': os.getpid(), 'task_id': None,
+                                               'ftp_name': file_info[3], 'main_zip': xml_info['main'],
+                                               'status': 'parsed' if status == 'parsed' else 'error',
+                                               'rows': parser.rows - rows_before, 'seconds': time.time() - start,
+                                               'stats': stats})
+                if tasks is not None and not save_kpis(loader, rows, errlog):
+                    # 小区 KPI 未写入时各 XML 登记为 unparse，bundle 写入磁盘由解析进程重新解析
+                    tasks = [dict(task, task_status='unparse') for task in tasks]
+                if tasks is not None and (self.tune.getboolean('Download', 'persist')
+                                          or any(task['task_status'] != 'parsed' for task in tasks)):
+                    try:
+                        zip_class.persist()
+                    except OSError as e:
+                        errlog.add_error('parse_stage', 'persist {} error: {}'.format(zip_class.file_path, str(e)))
+            finally:
+                rows.clear()
+                zip_class.close()
+                self._release(file_info[1])
+                self.queues['parse'].task_done(item)
+            if tasks is None:
+                self._done(file_info)
+                continue
+            if not self._put('register', (file_info, zip_class.file_path, tasks)):
+                break
+            registry().inc('pipeline.parsed_in_memory', source=file_info[3])
+        loader.abort()
+
+    def register_stage(self):
+        # Tortoise 的连接与事件循环(及其上下文)绑定，任务登记集中在一个线程的同一个协程中完成
+        errlog = ErrorLog('FtpScanProcess')
+        try:
+            asyncio.run(self._register(errlog))
+        except Exception as e:
+            errlog.add_error('register_stage', 'error: {}'.format(str(e)))
+
+    async def _register(self, errlog):
+        # 数据库出错时记录错误，断开后按指数退避重连；登记协程不能退出，否则 register 队列写满后上游各阶段都会阻塞
+        last_check = 0
+        backoff = 1
+        connected = False
+        try:
+            while self.manager_dict['status']:
+                try:
+                    if not connected:
+                        await self.mro_tasks.connect_to_db(self.mysqlinfo.user, self.mysqlinfo.passwd,
+                                                           self.mysqlinfo.host, self.mysqlinfo.port)
+                        connected = True
+                    if time.time() - last_check >= self.tune.getint('Pipeline', 'backlog_check'):
+                        self.parse_backlog = await self.mro_tasks.tasks_backlog()
+                        last_check = time.time()
+                    backoff = 1
+                except Exception as e:
+                    errlog.add_error('register_stage', 'database error: {}'.format(str(e)))
+                    registry().inc('pipeline.register_db_errors')
+                    if connected:
+                        await self._close_tasks_db(errlog)
+                        connected = False
+                    for i in range(backoff):
+                        if not self.manager_dict['status']:
+                            break
+                        await asyncio.sleep(1)
+                    backoff = min(backoff * 2, 60)
+                    continue
+                try:
+                    # 本线程的事件循环上只有登记这一个协程，阻塞等待不影响其他任务
+                    file_info, local_file, task_list = self.queues['register'].get(timeout=1)
+                except queue.Empty:
+                    continue
+                self._hold(file_info)
+                try:
                     # task_list入库
-                    for task in task_list:
-                        await self.mro_tasks.tasks_add(task, ftp_name)
+                    await self.mro_tasks.tasks_add_many(task_list, file_info[3])
+                    self.sources[file_info[3]].db.savelog(file_info[0])
+                    registry().inc('pipeline.registered', source=file_info[3])
+                    # 新鲜度: 文件时间(mtime 或首次扫描到的时间，见 FtpScanClass._file_info)到任务登记
+                    # (内存解析的 bundle 即解析完成)的时间
+                    freshness = time.time() - file_info[2]
+                    registry().observe('pipeline.freshness.seconds', freshness, source=file_info[3])
+                    if freshness > self.tune.getfloat('Scheduler', 'sla'):
+                        registry().inc('pipeline.sla_missed', source=file_info[3])
+                except Exception as e:
+                    errlog.add_error('register_stage', "register file {} ; error: {}".format(local_file, str(e)))
+                    # 未写 DownLog，下一轮扫描重新处理；立即检查一次连接，连接已断开时走上面的重连
+                    last_check = 0
+                self._done(file_info)
+        finally:
+            if connected:
+                await self._close_tasks_db(errlog)
 
-            except Exception as e:
-                self.errlog.add_error('scan_sub_tasks', "unmrozip from file {} ; error: {}".format(file_path, str(e)))
+    async def _close_tasks_db(self, errlog):
+        try:
+            await self.mro_tasks.close_db()
+        except Exception as e:
+            errlog.add_error('register_stage', 'close database error: {}'.format(str(e)))
+            # 关闭失败时也要让下次 connect_to_db 重新初始化
+            self.mro_tasks._db_initialized = False
+
+    def mro_zip(self, file_path, fileobj=None):
+        tune = self.tune
+        return MroZipClass(file_path, tune.getint('Zip', 'spool_threshold'), tune.get('Zip', 'spool_dir') or None,
+                           tune.getint('Zip', 'cache_bytes'), fileobj, tune.getint('Zip', 'workers'),
+                           tune.getint('Zip', 'parallel_bytes'))
 
     def stop(self):
         self.manager_dict['status'] = False
-        if hasattr(self, 'ftp_scan') and self.ftp_scan is not None:
-            self.ftp_scan.stop()
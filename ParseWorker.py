@@ -0,0 +1,319 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+from Config import ErrorLog, MysqlInfo, TuneInfo
+from Metrics import MetricsPublisher
+from MroAggregate import MroAggregator
+from MroColumnar import MroColumnarWriter, columnar_path
+from MroLoader import BulkLoader, CELL_KPI_COLUMNS, cell_kpi_rows
+from MroParse import MroZipClass, MroXmlParser
+from SubTasks import MroTask
+
+
+def _tee(rows, writer):
+    for row in rows:
+        writer.write(row)
+        yield row
+
+
+def parse_xml(parser, xml_info, tune):
+    # 解析一个 XML 并按小区汇总，配置了 columnar_dir 时同时写出列式文件；解析进程与 FtpScanProcess 的内存解析共用
+    aggregator = MroAggregator(tune.getint('Parse', 'batch_size'))
+    rows = parser.iter_rows(xml_info)
+    columnar_dir = tune.get('Parse', 'columnar_dir')
+    if columnar_dir:
+        path = columnar_path(columnar_dir, xml_info['main'], xml_info['path'], xml_info['xml_file'])
+        with MroColumnarWriter(path, xml_info['main'], xml_info['path'], xml_info['xml_file']) as writer:
+            aggregator.consume(_tee(rows, writer))
+    else:
+        aggregator.consume(rows)
+    return aggregator.result()
+
+
+def kpi_rows(stats, ftp_name, xml_info):
+    return list(cell_kpi_rows(stats.to_records(), ftp_name, xml_info['main'], xml_info['path'], xml_info['xml_file']))
+
+
+def kpi_loader():
+    return BulkLoader('mro_cell_kpi', CELL_KPI_COLUMNS, connect=False)
+
+
+def save_kpis(loader, rows, errlog):
+    # 小区 KPI 提交成功后调用方才把对应任务登记为 parsed；失败时返回 False，由调用方把任务退回 unparse 稍后重新解析
+    if not rows:
+        return True
+    try:
+        loader.add_many(rows)
+        loader.flush(commit=True)
+        return True
+    except Exception as e:
+        loader.abort()
+        errlog.add_error('save_kpis', 'save {} cell kpi rows error: {}'.format(len(rows), str(e)))
+        return False
+    finally:
+        rows.clear()
+
+
+class ParseWorkerProcess(multiprocessing.Process):
+    # 解析进程: 从 mrotask 表领取任务，流式解析 XML 并汇总，小区 KPI 写入 mro_cell_kpi，统计通过 result_queue 上报给 ParseSupervisor
+    def __init__(self, manager_dict, result_queue, worker_id=0):
+        super().__init__(name=f'ParseWorker-{worker_id}')
+        self.manager_dict = manager_dict
+        self.result_queue = result_queue
+        self.worker_id = worker_id
+        self.errlog = None
+        self.tune = None
+        self.parser = None
+        self.zip_class = None
+        self.loader = None
+        self.kpi_rows = []
+        # 已领取且结果尚未写回 mrotask 的任务及其领取时的租约标识，由续约协程定期续约
+        self.holding = set()
+        self.lease_token = None
+
+    def run(self):
+        self.errlog = ErrorLog('ParseWorkerProcess')
+        self.tune = TuneInfo()
+        self.parser = MroXmlParser()
+        publisher = MetricsPublisher(self.manager_dict, self.name,
+                                     self.tune.getfloat('Metrics', 'publish_interval')).start()
+        try:
+            asyncio.run(self._main())
+        except Exception as e:
+            self.errlog.add_error('run', 'worker {} error: {}'.format(self.worker_id, str(e)))
+            raise
+        finally:
+            publisher.stop()
+            # 子进程退出时不会执行 atexit，这里主动写出缓冲中的错误日志
+            self.errlog.flush(5)
+
+    async def _main(self):
+        mysqlinfo = MysqlInfo(section='LocalServer')
+        mro_tasks = MroTask()
+        self.loader = kpi_loader()
+        await mro_tasks.connect_to_db(mysqlinfo.user, mysqlinfo.passwd, mysqlinfo.host, mysqlinfo.port)
+        claim_size = self.tune.getint('Parse', 'claim_size')
+        idle_sleep = self.tune.getint('Parse', 'idle_sleep')
+        lease = self.tune.getint('Parse', 'lease')
+        checkpoint_interval = self.tune.getfloat('Parse', 'checkpoint_interval')
+        reclaim_interval = self.tune.getint('Parse', 'reclaim_interval')
+        last_reclaim = 0
+        heartbeat = asyncio.create_task(self._heartbeat(mro_tasks, max(1.0, lease / 3)))
+        try:
+            while self._wanted():
+                if time.time() - last_reclaim >= reclaim_interval:
+                    # 各解析进程都会定期回收过期租约，UPDATE 是幂等的
+                    await mro_tasks.tasks_reclaim(lease)
+                    last_reclaim = time.time()
+                tasks = await mro_tasks.tasks_claim(claim_size)
+                if not tasks:
+                    for i in range(idle_sleep):
+                        if not self._wanted():
+                            break
+                        await asyncio.sleep(1)
+                    continue
+                self.holding = {task.task_id for task in tasks}
+                self.lease_token = tasks[0].lease_token
+                task_status = {}
+                last_checkpoint = time.time()
+                for task in tasks:
+                    if not self.manager_dict['parse_status']:
+                        # 停止时未处理的任务退回队列
+                        task_status[task.task_id] = 'unparse'
+                        continue
+                    # 解析在线程中执行，事件循环保持空闲，续约协程照常运行
+                    task_status[task.task_id] = await asyncio.to_thread(self.parse_task, task)
+                    if time.time() - last_checkpoint >= checkpoint_interval:
+                        # 按 XML 记录进度；进程崩溃后只有未完成的 XML 会被重新解析
+                        await self._update(mro_tasks, task_status)
+                        task_status = {}
+                        last_checkpoint = time.time()
+                if task_status:
+                    await self._update(mro_tasks, task_status)
+        finally:
+            heartbeat.cancel()
+            if self.zip_class is not None:
+                self.zip_class.close()
+            self.loader.abort()
+            await mro_tasks.close_db()
+
+    async def _heartbeat(self, mro_tasks, interval):
+        # 续约: 每 interval 秒为已领取且尚未登记结果的任务刷新 uptime，
+        # 单个 XML 解析时间超过 Parse.lease 时任务也不会被其他进程回收后重复解析
+        while True:
+            await asyncio.sleep(interval)
+            if not self.holding:
+                continue
+            try:
+                await mro_tasks.tasks_renew(list(self.holding), self.lease_token)
+            except Exception as e:
+                self.errlog.add_error('heartbeat', 'worker {} renew error: {}'.format(self.worker_id, str(e)))
+
+    async def _update(self, mro_tasks, task_status):
+        await mro_tasks.tasks_update_many(self._save(task_status), self.lease_token)
+        self.holding.difference_update(task_status)
+
+    def _save(self, task_status):
+        if not save_kpis(self.loader, self.kpi_rows, self.errlog):
+            return {task_id: 'unparse' if status == 'parsed' else status for task_id, status in task_status.items()}
+        return task_status
+
+    def _wanted(self):
+        # 运行中减少解析进程数时(manager_dict['control'])，编号超出的进程处理完手上的任务后退出
+        if not self.manager_dict['parse_status']:
+            return False
+        control = self.manager_dict.get('control')
+        return not control or self.worker_id < control.get('parse_workers', self.worker_id + 1)
+
+    def _zip(self, main_zip):
+        # 同一 bundle 的相邻任务复用已打开的压缩包与索引
+        if self.zip_class is None or self.zip_class.file_path != main_zip:
+            if self.zip_class is not None:
+                self.zip_class.close()
+            tune = self.tune
+            self.zip_class = MroZipClass(main_zip, tune.getint('Zip', 'spool_threshold'),
+                                         tune.get('Zip', 'spool_dir') or None, tune.getint('Zip', 'cache_bytes'),
+                                         workers=tune.getint('Zip', 'workers'),
+                                         parallel_bytes=tune.getint('Zip', 'parallel_bytes'))
+        return self.zip_class
+
+    def parse_task(self, task):
+        xml_info = {'main': task.main_zip, 'path': task.sub_zip_path, 'xml_file': task.xml_name}
+        start = time.time()
+        rows_before = self.parser.rows
+        stats = None
+        try:
+            self.parser.zip_class = self._zip(task.main_zip)
+            stats = parse_xml(self.parser, xml_info, self.tune)
+            self.kpi_rows += kpi_rows(stats, task.ftp_name, xml_info)
+            status = 'parsed'
+        except Exception as e:
+            self.errlog.add_error('parse_task', 'task {} {} error: {}'.format(
+                task.task_id, '->'.join(filter(None, (task.main_zip, task.sub_zip_path, task.xml_name))), str(e)))
+            status = 'error'
+        # KPI 已由 save_kpis 入库，这里只上报计数与小区键(用于统计小区数)，不传完整的 CellStats
+        self.result_queue.put({'worker': self.worker_id, 'pid': os.getpid(), 'task_id': task.task_id,
+                               'ftp_name': task.ftp_name, 'main_zip': task.main_zip, 'status': status,
+                               'rows': self.parser.rows - rows_before, 'seconds': time.time() - start,
+                               'cells': stats.keys if stats is not None else None})
+        return status
+
+
+class ParseSupervisor:
+    # 按 CPU 核数(可配置)启动解析进程，进程异常退出时自动重启，stop 时等待各进程处理完手上的任务再退出
+    # 异常退出后按编号指数退避(1 秒起，至多 Parse.restart_backoff_max 秒)再重启，运行超过 restart_stable 秒后退避清零
+    # 启用 Control 时进程数跟随 manager_dict['control'] 中的 parse_workers 增减
+    def __init__(self, manager_dict, workers=None):
+        self.manager_dict = manager_dict
+        self.tune = TuneInfo()
+        self.workers = workers or self.tune.getint('Parse', 'workers') or os.cpu_count() or 1
+        self.result_queue = multiprocessing.Queue()
+        self.processes = {}
+        self.monitor = None
+        self.running = False
+        self.lock = threading.Lock()
+        self.restarts = 0
+        self.tasks = {'parsed': 0, 'error': 0}
+        self.rows = 0
+        self.seconds = 0.0
+        self.start_time = None
+        self.cells = {}
+        self.started = {}
+        self.backoff = {}
+        self.next_spawn = {}
+
+    def _spawn(self, worker_id):
+        process = ParseWorkerProcess(self.manager_dict, self.result_queue, worker_id)
+        process.start()
+        self.processes[worker_id] = process
+        self.started[worker_id] = time.time()
+
+    def _exited(self, worker_id, process):
+        # 异常退出: 运行时间很短时退避时间翻倍，运行稳定过一段时间后从 1 秒重新开始
+        if process.exitcode == 0:
+            self.backoff.pop(worker_id, None)
+            return
+        self.restarts += 1
+        if time.time() - self.started.get(worker_id, 0) >= self.tune.getfloat('Parse', 'restart_stable'):
+            delay = 1
+        else:
+            delay = min(self.backoff.get(worker_id, 0.5) * 2, self.tune.getfloat('Parse', 'restart_backoff_max'))
+        self.backoff[worker_id] = delay
+        self.next_spawn[worker_id] = time.time() + delay
+
+    def start(self):
+        if self.running:
+            return
+        self.manager_dict['parse_status'] = True
+        self.running = True
+        self.start_time = time.time()
+        for worker_id in range(self._target()):
+            self._spawn(worker_id)
+        self.monitor = threading.Thread(target=self._monitor, name='ParseSupervisor', daemon=True)
+        self.monitor.start()
+
+    def _collect(self, timeout=1.0):
+        try:
+            result = self.result_queue.get(timeout=timeout)
+        except queue.Empty:
+            return False
+        with self.lock:
+            self.tasks[result['status']] = self.tasks.get(result['status'], 0) + 1
+            self.rows += result['rows']
+            self.seconds += result['seconds']
+            if result['cells'] is not None:
+                self.cells.setdefault(result['ftp_name'], set()).update(result['cells'].tolist())
+        return True
+
+    def _monitor(self):
+        while self.running:
+            self._collect()
+            if not self.manager_dict['parse_status']:
+                continue
+            target = self._target()
+            for worker_id, process in list(self.processes.items()):
+                if not process.is_alive():
+                    process.join()
+                    self._exited(worker_id, process)
+                    del self.processes[worker_id]
+            for worker_id in range(target):
+                if worker_id not in self.processes and time.time() >= self.next_spawn.get(worker_id, 0):
+                    # 进程崩溃后(退避时间到后)重启，或按新的进程数补足
+                    self._spawn(worker_id)
+            self.manager_dict['parse_stats'] = self.snapshot()
+
+    def _target(self):
+        control = self.manager_dict.get('control') if self.tune.getboolean('Control', 'enabled') else None
+        return control.get('parse_workers', self.workers) if control else self.workers
+
+    def stop(self, timeout=60):
+        self.manager_dict['parse_status'] = False
+        deadline = time.time() + timeout
+        for process in self.processes.values():
+            # 等待期间 monitor 线程持续读取结果队列，避免子进程因队列未清空而无法退出
+            process.join(max(0.0, deadline - time.time()))
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self.running = False
+        if self.monitor is not None:
+            self.monitor.join()
+        while self._collect(timeout=0.1):
+            pass
+        self.processes = {}
+        self.manager_dict['parse_stats'] = self.snapshot()
+
+    def snapshot(self):
+        with self.lock:
+            return {'workers': sum(1 for p in self.processes.values() if p.is_alive()),
+                    'restarts': self.restarts,
+                    'tasks': dict(self.tasks),
+                    'rows': self.rows,
+                    'rows_per_sec': self.rows / (time.time() - self.start_time) if self.start_time else 0.0,
+                    'rows_per_sec_per_worker': self.rows / self.seconds if self.seconds else 0.0,
+                    'cells': {name: len(cells) for name, cells in self.cells.items()}}
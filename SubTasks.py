@@ -1,14 +1,25 @@
 import datetime
-from typing import Any
+import hashlib
+import uuid
+from typing import Any, Dict, List, Optional
 
 from async_generator import asynccontextmanager
 from tortoise import Model, fields, transactions, Tortoise
 
-from Config import MysqlInfo
+from Config import MysqlInfo, TuneInfo
+from Metrics import registry
 from tortoise import Model, fields
 
-
-
+# 领取任务用的索引: 不按数据源领取时(解析进程)走 claim_index，按 task_id 顺序读取 unparse 行，LIMIT 后即停止，
+# 不会 filesort 并锁住全部 unparse 行；按数据源领取与统计积压时走 status_index
+TASK_INDEXES = {
+    'claim_index': '(task_status, task_id)',
+    'status_index': '(task_status, ftp_name, task_id)',
+}
+# 旧版本创建的 mrotask 表缺少的普通列(task_key 带唯一索引，单独处理)
+TASK_COLUMNS = {
+    'lease_token': 'VARCHAR(32) NULL',
+}
 
 
 class MroTask(Model):
@@ -20,6 +31,10 @@ class MroTask(Model):
     task_status = fields.CharField(max_length=255)
     uptime = fields.DatetimeField()
     ftp_name = fields.CharField(max_length=255)
+    # (main_zip, sub_zip_path, xml_name, ftp_name) 的 sha1，四个 VARCHAR(255) 的联合索引超出 InnoDB 索引长度限制
+    task_key = fields.CharField(max_length=40, unique=True, null=True)
+    # 每次领取生成的租约标识: 租约过期被回收、再被其他进程领取后，原进程的续约与结果写回不再生效
+    lease_token = fields.CharField(max_length=32, null=True)
 
     def __init__(self, **kwargs: Any):
         super().__init__(**kwargs)
@@ -27,51 +42,176 @@ class MroTask(Model):
 
     async def connect_to_db(self, user, passwd, host, port):
         if not self._db_initialized:
+            tune = TuneInfo()
+            sqlite = tune.get('Database', 'backend') == 'sqlite'
             await Tortoise.init(
-                db_url=f'mysql://{user}:{passwd}@{host}:{port}/mroparse',
-                modules={'models': ['__main__']}
+                db_url=f"sqlite://{tune.get('Database', 'sqlite_path')}" if sqlite else
+                f'mysql://{user}:{passwd}@{host}:{port}/mroparse',
+                modules={'models': ['SubTasks']}
             )
             await Tortoise.generate_schemas()
+            if sqlite:
+                conn = Tortoise.get_connection('default')
+                _, rows = await conn.execute_query("PRAGMA table_info(mrotask)")
+                existing = {row['name'] for row in rows}
+                for name, definition in TASK_COLUMNS.items():
+                    if name not in existing:
+                        await conn.execute_script(f"ALTER TABLE mrotask ADD COLUMN {name} {definition}")
+                for name, columns in TASK_INDEXES.items():
+                    await conn.execute_script(f"CREATE INDEX IF NOT EXISTS {name} ON mrotask {columns}")
+            else:
+                await self._ensure_schema()
             self._db_initialized = True
 
+    async def close_db(self):
+        if self._db_initialized:
+            await Tortoise.close_connections()
+            self._db_initialized = False
+
+    async def _ensure_schema(self):
+        # 旧版本创建的 mrotask 表没有 task_key、lease_token 列与领取任务用的索引，在此补充
+        conn = Tortoise.get_connection('default')
+        _, rows = await conn.execute_query(
+            "SELECT column_name FROM information_schema.columns "
+            "WHERE table_schema = DATABASE() AND table_name = 'mrotask' AND column_name = 'task_key'")
+        if not rows:
+            await conn.execute_script("ALTER TABLE mrotask ADD COLUMN task_key VARCHAR(40) NULL, "
+                                      "ADD UNIQUE INDEX task_key (task_key)")
+        for name, definition in TASK_COLUMNS.items():
+            _, rows = await conn.execute_query(
+                "SELECT column_name FROM information_schema.columns "
+                "WHERE table_schema = DATABASE() AND table_name = 'mrotask' AND column_name = %s", [name])
+            if not rows:
+                await conn.execute_script(f"ALTER TABLE mrotask ADD COLUMN {name} {definition}")
+        for name, columns in TASK_INDEXES.items():
+            _, rows = await conn.execute_query(
+                "SELECT index_name FROM information_schema.statistics "
+                "WHERE table_schema = DATABASE() AND table_name = 'mrotask' AND index_name = %s", [name])
+            if not rows:
+                await conn.execute_script(f"CREATE INDEX {name} ON mrotask {columns}")
+
+    @staticmethod
+    def task_fields(task: Dict[str, str], ftp_name: str) -> Dict[str, str]:
+        # 兼容 MroZipClass.scan_xml_list 的结果(main/path/xml_file)与表字段名(main_zip/sub_zip_path/xml_name)
+        main_zip = task.get('main_zip', task.get('main'))
+        sub_zip_path = task.get('sub_zip_path', task.get('path', ''))
+        xml_name = task.get('xml_name', task.get('xml_file'))
+        task_key = hashlib.sha1('|'.join((main_zip, sub_zip_path, xml_name, ftp_name)).encode('utf-8')).hexdigest()
+        return {'main_zip': main_zip, 'sub_zip_path': sub_zip_path, 'xml_name': xml_name, 'ftp_name': ftp_name,
+                'task_key': task_key}
+
     @asynccontextmanager
     async def transaction_context(self):
         async with transactions.in_transaction():
             yield
 
     async def tasks_add(self, task, ftp_name):
+        task = self.task_fields(task, ftp_name)
         async with self.transaction_context():
             # 检查数据库中是否存在相同的数据
-            existing_task = await MroTask.filter(
-                main_zip=task['main_zip'], sub_zip_path=task['sub_zip_path'], ftp_name=ftp_name
-            ).first()
+            existing_task = await MroTask.filter(task_key=task['task_key']).first()
             # 如果不存在相同的数据，则将其添加到数据库中
             if not existing_task:
                 await MroTask.create(
-                    main_zip=task['main_zip'],
-                    sub_zip_path=task['sub_zip_path'],
-                    xml_name="unparse",
                     task_status="unparse",
                     uptime=datetime.datetime.now(),
-                    ftp_name=ftp_name
+                    **task
                 )
 
-    async def tasks_get(self, task_num, ftp_name):
-        async with self.transaction_context():
-            raw_tasks = await MroTask.raw(
-                f"SELECT * FROM mrotask WHERE task_status='unparse' AND ftp_name='{ftp_name}' LIMIT {task_num} FOR UPDATE"
-            )
-            tasks = [MroTask(**task) for task in raw_tasks]
+    async def tasks_add_many(self, task_list: List[Dict[str, str]], ftp_name, chunk_size=1000):
+        # 批量登记任务: 依赖 task_key 唯一索引，每 chunk_size 条一条 INSERT IGNORE，已存在的任务直接跳过
+        # 任务中带 task_status 时按该状态登记(已在 FtpScanProcess 内存中解析过的 XML 直接登记为 parsed)
+        now = datetime.datetime.now()
+        tasks = {}
+        for task in task_list:
+            fields_ = self.task_fields(task, ftp_name)
+            tasks[fields_['task_key']] = MroTask(task_status=task.get('task_status', 'unparse'), uptime=now,
+                                                 **fields_)
+        if not tasks:
+            return 0
+        with registry().timer('db.mrotask.seconds', op='add_many'):
+            async with self.transaction_context():
+                await MroTask.bulk_create(list(tasks.values()), batch_size=chunk_size, ignore_conflicts=True)
+        registry().inc('mrotask.added', len(tasks))
+        return len(tasks)
 
-            for task in tasks:
-                task.task_status = 'parsing'
-                task.uptime = datetime.datetime.now()
-                await task.save()
+    async def tasks_claim(self, task_num, ftp_name=None):
+        # 多个解析进程并发领取任务: FOR UPDATE SKIP LOCKED 跳过其他事务已锁定的行，再用一条 UPDATE 置为 parsing
+        # 同一批任务带同一个 lease_token，续约与写回结果时用它确认租约仍属于自己
+        with registry().timer('db.mrotask.seconds', op='claim'):
+            async with self.transaction_context():
+                query = MroTask.filter(task_status='unparse')
+                if ftp_name is not None:
+                    query = query.filter(ftp_name=ftp_name)
+                tasks = await query.order_by('task_id').limit(task_num).select_for_update(skip_locked=True)
+                if tasks:
+                    now = datetime.datetime.now()
+                    lease_token = uuid.uuid4().hex
+                    await MroTask.filter(task_id__in=[task.task_id for task in tasks]).update(
+                        task_status='parsing', uptime=now, lease_token=lease_token)
+                    for task in tasks:
+                        task.task_status = 'parsing'
+                        task.uptime = now
+                        task.lease_token = lease_token
+        registry().inc('mrotask.claimed', len(tasks))
         return tasks
 
+    @staticmethod
+    def _leased(task_ids: List[int], lease_token: Optional[str]):
+        # 只匹配仍由本次领取持有的任务: 状态为 parsing，给出 lease_token 时还须与领取时的一致
+        query = MroTask.filter(task_id__in=task_ids, task_status='parsing')
+        return query.filter(lease_token=lease_token) if lease_token is not None else query
+
+    async def tasks_renew(self, task_ids: List[int], lease_token: Optional[str] = None) -> int:
+        # 续约: 刷新仍在处理中的任务的 uptime，uptime 即领取租约的起点；返回续约成功的任务数
+        if not task_ids:
+            return 0
+        with registry().timer('db.mrotask.seconds', op='renew'):
+            return await self._leased(task_ids, lease_token).update(uptime=datetime.datetime.now())
+
+    async def tasks_reclaim(self, lease_seconds: int) -> int:
+        # 领取后超过 lease_seconds 未续约(解析进程崩溃或被杀)的任务退回 unparse，由其他解析进程重新领取
+        now = datetime.datetime.now()
+        with registry().timer('db.mrotask.seconds', op='reclaim'):
+            count = await MroTask.filter(task_status='parsing',
+                                         uptime__lt=now - datetime.timedelta(seconds=lease_seconds)).update(
+                task_status='unparse', uptime=now, lease_token=None)
+        registry().inc('mrotask.reclaimed', count)
+        return count
+
+    async def tasks_backlog(self, ftp_name=None):
+        query = MroTask.filter(task_status='unparse')
+        if ftp_name is not None:
+            query = query.filter(ftp_name=ftp_name)
+        with registry().timer('db.mrotask.seconds', op='backlog'):
+            backlog = await query.count()
+        registry().set('mrotask.backlog', backlog)
+        return backlog
+
+    async def tasks_get(self, task_num, ftp_name):
+        return await self.tasks_claim(task_num, ftp_name)
+
     async def tasks_update(self, task_id, status):
         async with self.transaction_context():
             task = await MroTask.get(task_id=task_id)
             task.task_status = status
             task.uptime = datetime.datetime.now()
             await task.save()
+
+    async def tasks_update_many(self, task_status: Dict[int, str], lease_token: Optional[str] = None) -> int:
+        # 批量写回领取的任务的结果，task_status 为 {task_id: status}，每种状态一条 UPDATE
+        # 只更新仍处于 parsing 且租约未被他人接手的行；租约已被回收的任务由新的领取者负责，这里跳过并计数
+        by_status: Dict[str, List[int]] = {}
+        for task_id, status in task_status.items():
+            by_status.setdefault(status, []).append(task_id)
+        now = datetime.datetime.now()
+        updated = 0
+        with registry().timer('db.mrotask.seconds', op='update_many'):
+            async with self.transaction_context():
+                for status, task_ids in by_status.items():
+                    count = await self._leased(task_ids, lease_token).update(task_status=status, uptime=now,
+                                                                             lease_token=None)
+                    updated += count
+                    registry().inc('mrotask.updated', count, status=status)
+        registry().inc('mrotask.stale_updates', len(task_status) - updated)
+        return updated
@@ -0,0 +1,103 @@
+import io
+import math
+import os
+import random
+import shutil
+import zipfile
+from typing import List, Optional
+
+# 生成基准测试用的 MRO 数据: 结构与厂家 OMC 上传的 MRO 压缩包一致(主包 -> 子包 -> XML)
+SMR_SC = ('MR.LteScEarfcn MR.LteScPci MR.LteScRSRP MR.LteScRSRQ MR.LteScTadv MR.LteSceNBRxTxTimeDiff '
+          'MR.LteScPHR MR.LteScAOA MR.LteScSinrUL MR.LteNcEarfcn MR.LteNcPci MR.LteNcRSRP MR.LteNcRSRQ')
+SMR_PLR = 'MR.LtePlrULQci1 MR.LtePlrULQci2 MR.LtePlrDLQci1 MR.LtePlrDLQci2'
+
+
+def make_xml(enb_id: int, objects: int = 50, neighbours: int = 3, cells: int = 3, seed: Optional[int] = None) -> bytes:
+    # 每个 object 为一个样本: 第一行为服务小区，之后每行一个邻区
+    rnd = random.Random(enb_id if seed is None else seed)
+    out = io.StringIO()
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n<bulkPmMrDataFile>\n')
+    out.write('<fileHeader fileFormatVersion="V2.0.0" reportTime="2023-03-27T10:00:00.000" '
+              'startTime="2023-03-27T09:45:00.000" endTime="2023-03-27T10:00:00.000" period="0"/>\n')
+    out.write(f'<eNB id="{enb_id}" userLabel="{enb_id}">\n<measurement mrName="MR.LteScRSRP">\n')
+    out.write(f'<smr>{SMR_SC}</smr>\n')
+    for i in range(objects):
+        cell = rnd.randrange(cells) + 1
+        out.write(f'<object id="{enb_id * 256 + cell}" MmeUeS1apId="{100000 + i}" MmeGroupId="1" MmeCode="1" '
+                  f'TimeStamp="2023-03-27T09:{45 + i % 15:02d}:{i % 60:02d}.000">\n')
+        sc_rsrp = rnd.randrange(20, 80)
+        sc = f'1825 {cell * 3} {sc_rsrp} {rnd.randrange(5, 30)} {rnd.randrange(0, 20)} NIL 40 NIL 18'
+        rows = max(1, rnd.randrange(neighbours + 1))
+        for n in range(rows):
+            if n < neighbours:
+                nc = f'1825 {rnd.randrange(504)} {max(0, sc_rsrp - rnd.randrange(12))} {rnd.randrange(5, 30)}'
+            else:
+                nc = 'NIL NIL NIL NIL'
+            out.write(f'<v>{sc} {nc}</v>\n')
+        out.write('</object>\n')
+    out.write('</measurement>\n<measurement mrName="MR.LtePlrULQci1">\n')
+    out.write(f'<smr>{SMR_PLR}</smr>\n')
+    for cell in range(1, cells + 1):
+        out.write(f'<object id="{enb_id * 256 + cell}">\n<v>0 0 0 0</v>\n</object>\n')
+    out.write('</measurement>\n</eNB>\n</bulkPmMrDataFile>\n')
+    return out.getvalue().encode('utf-8')
+
+
+def _zip_bytes(members: List[tuple], compression=zipfile.ZIP_DEFLATED) -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', compression) as zf:
+        for name, data in members:
+            zf.writestr(name, data)
+    return buf.getvalue()
+
+
+def make_bundle(path: str, xml_count: int = 100, depth: int = 2, members: int = 10, objects: int = 50,
+                enb_base: int = 100000, compression=zipfile.ZIP_DEFLATED) -> int:
+    # 生成嵌套压缩包: depth 为压缩包层数(1 表示 XML 直接在主包中)，members 为每层子包的个数
+    # XML 平均分配到最底层的子包中，返回实际写入的 XML 个数
+    counter = [0]
+
+    def build(level: int, count: int, prefix: str) -> List[tuple]:
+        if level >= depth or count <= 1:
+            items = []
+            for _ in range(count):
+                enb_id = enb_base + counter[0]
+                counter[0] += 1
+                items.append((f'FDD-LTE_MRO_HUAWEI_{enb_id}_20230327094500.xml', make_xml(enb_id, objects)))
+            return items
+        fan_out = min(members, count)
+        per_member = math.ceil(count / fan_out)
+        items = []
+        for i in range(fan_out):
+            sub_count = min(per_member, count - i * per_member)
+            if sub_count <= 0:
+                break
+            name = f'{prefix}{i:04d}.zip'
+            items.append((name, _zip_bytes(build(level + 1, sub_count, f'{prefix}{i:04d}_'), compression)))
+        return items
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    data = _zip_bytes(build(1, xml_count, 'MRO_'), compression)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return counter[0]
+
+
+def make_ftp_tree(root: str, files: int, per_dir: int = 500, template: Optional[str] = None,
+                  xml_count: int = 2, objects: int = 20) -> List[str]:
+    # 在 FTP 根目录下生成 files 个压缩包，按 日期/批次 分目录；各文件硬链接到同一个模板以节省磁盘(不支持时复制)
+    if template is None:
+        template = os.path.join(root, '.template.zip')
+        make_bundle(template, xml_count, depth=2, members=2, objects=objects)
+    paths = []
+    for i in range(files):
+        sub_dir = os.path.join(root, f'2023032{i // (per_dir * 100) % 10}', f'batch_{i // per_dir:05d}')
+        if i % per_dir == 0:
+            os.makedirs(sub_dir, exist_ok=True)
+        path = os.path.join(sub_dir, f'MRO_{i:07d}.zip')
+        try:
+            os.link(template, path)
+        except OSError:
+            shutil.copyfile(template, path)
+        paths.append(path)
+    return paths
@@ -0,0 +1,109 @@
+import configparser
+import logging
+import multiprocessing
+import os
+import socket
+import time
+
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.log import config_logging
+from pyftpdlib.servers import ThreadedFTPServer
+
+FTP_USER = 'bench'
+FTP_PASSWD = 'bench'
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _serve(root: str, port: int):
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(FTP_USER, FTP_PASSWD, root, perm='elr')
+    handler = type('BenchFTPHandler', (FTPHandler,), {'authorizer': authorizer, 'banner': 'bench'})
+    config_logging(level=logging.WARNING)
+    server = ThreadedFTPServer(('127.0.0.1', port), handler)
+    server.max_cons = 256
+    server.serve_forever(handle_exit=False)
+
+
+class LocalFtpServer:
+    # 本地 FTP 服务(pyftpdlib)，代替厂家 OMC
+    # pyftpdlib 处理 CWD 时会切换服务进程的当前目录，因此放在独立进程中运行，不影响被测代码的相对路径
+    def __init__(self, root: str, port: int = 0):
+        self.root = root
+        self.port = port or free_port()
+        os.makedirs(root, exist_ok=True)
+        self.process = multiprocessing.Process(target=_serve, args=(root, self.port), name='LocalFtpServer',
+                                               daemon=True)
+
+    def start(self, timeout: float = 10):
+        self.process.start()
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                with socket.create_connection(('127.0.0.1', self.port), timeout=1):
+                    return self
+            except OSError:
+                time.sleep(0.1)
+        raise Exception(f'Local FTP server did not start on port {self.port}')
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+
+
+class BenchEnv:
+    # 基准测试的工作目录: configure/ 下写入指向本地 FTP 与 SQLite 的配置，database/sqllite3.db 作为数据库
+    # 项目中的配置类使用相对路径，调用方需先 chdir 到 workdir 再导入项目模块
+    def __init__(self, workdir: str):
+        self.workdir = os.path.abspath(workdir)
+        self.ftp_root = os.path.join(self.workdir, 'ftp')
+        self.down_path = os.path.join(self.workdir, 'download')
+        self.ftp = None
+
+    def _write(self, name: str, sections: dict):
+        config = configparser.ConfigParser()
+        path = os.path.join(self.workdir, 'configure', name)
+        config.read(path)
+        for section, options in sections.items():
+            if not config.has_section(section):
+                config.add_section(section)
+            for key, value in options.items():
+                config.set(section, key, str(value))
+        with open(path + '.tmp', 'w') as f:
+            config.write(f)
+        os.replace(path + '.tmp', path)
+
+    def setup(self, download_workers: int = 4):
+        os.makedirs(os.path.join(self.workdir, 'configure'), exist_ok=True)
+        os.makedirs(os.path.join(self.workdir, 'database'), exist_ok=True)
+        self.ftp = LocalFtpServer(self.ftp_root).start()
+        # MysqlInfo 的配置仍需存在，实际连接走 SQLite
+        self._write('mysql.ini', {'LocalServer': {'host': '127.0.0.1', 'port': 3306, 'user': 'bench',
+                                                  'passwd': 'bench'}})
+        self.source('bench', '/')
+        self._write('tuning.ini', {
+            'Database': {'backend': 'sqlite', 'sqlite_path': './database/sqllite3.db'},
+            'Scan': {'stable_scans': 1, 'manifest_path': './database/manifest'},
+            'Download': {'workers': download_workers, 'pool_size': download_workers},
+            'Metrics': {'enabled': 0},
+        })
+        return self
+
+    def source(self, ftp_name: str, sync_path: str, section: str = 'FTPInfo'):
+        self._write('ftpinfo.ini', {section: {'ftp_name': ftp_name, 'host': '127.0.0.1', 'port': self.ftp.port,
+                                              'user': FTP_USER, 'passwd': FTP_PASSWD, 'sync_path': sync_path,
+                                              'down_path': self.down_path, 'scan_filter': 'temp',
+                                              # pyftpdlib 的 LIST 使用 GMT 时间
+                                              'time_shift': 0}})
+
+    def tune(self, section: str, **options):
+        self._write('tuning.ini', {section: options})
+
+    def close(self):
+        if self.ftp is not None:
+            self.ftp.stop()
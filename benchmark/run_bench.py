@@ -0,0 +1,235 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from MroBenchData import make_bundle, make_ftp_tree
+from MroBenchEnv import BenchEnv
+
+# 端到端基准测试: 本地 FTP + SQLite，依次测量扫描、下载、压缩包索引/读取与任务表读写，结果以 JSON 输出
+# 用法: python benchmark/run_bench.py --sizes 1000,10000 --scenarios scan,download,zip,tasks --output result.json
+
+
+def log(message):
+    print(f'[{time.strftime("%H:%M:%S")}] {message}', file=sys.stderr, flush=True)
+
+
+def bench_scan(env, n, args):
+    from Config import ErrorLog
+    from MroSync import FtpScanClass
+
+    tree = f'scan_{n}'
+    if not os.path.isdir(os.path.join(env.ftp_root, tree)):
+        make_ftp_tree(os.path.join(env.ftp_root, tree), n, args.per_dir, env.template)
+        # 目录修改时间调早一小时，模拟已上传完成的目录；刚修改过的目录(Scan.mtime_precision 内)每次都会重新列出
+        aged = time.time() - 3600
+        for root, dirs, files in os.walk(os.path.join(env.ftp_root, tree)):
+            os.utime(root, (aged, aged))
+    errlog = ErrorLog('Benchmark')
+    results = []
+    for mode in ('incremental', 'full'):
+        env.tune('Scan', scan_mode=mode)
+        env.source(f'{tree}_{mode}', f'/{tree}/')
+        ftp_scan = FtpScanClass({'status': True})
+        try:
+            start = time.perf_counter()
+            found = ftp_scan.scan_newfiles(errlog)
+            first = time.perf_counter() - start
+            listed = ftp_scan.manifest.listed
+            # 再扫一次: 目录未变化，增量模式只需列出根目录链路
+            start = time.perf_counter()
+            ftp_scan.scan_newfiles(errlog)
+            rescan = time.perf_counter() - start
+        finally:
+            ftp_scan.close()
+        results.append({'scenario': 'scan_newfiles', 'mode': mode, 'files': n, 'found': len(found),
+                        'seconds': first, 'files_per_sec': n / first if first else 0.0,
+                        'rescan_seconds': rescan, 'dirs_listed': listed,
+                        'rescan_dirs_listed': ftp_scan.manifest.listed})
+    return results
+
+
+def bench_download(env, n, args):
+    from Config import ErrorLog
+    from FtpDownload import DownloadEngine
+    from MroSync import FtpScanClass
+
+    count = min(n, args.download_max)
+    tree = f'download_{count}'
+    if not os.path.isdir(os.path.join(env.ftp_root, tree)):
+        make_ftp_tree(os.path.join(env.ftp_root, tree), count, args.per_dir, env.template)
+    env.tune('Scan', scan_mode='incremental')
+    env.source(tree, f'/{tree}/')
+    ftp_scan = FtpScanClass({'status': True})
+    try:
+        file_infos = ftp_scan.scan_newfiles(ErrorLog('Benchmark'))
+        engine = DownloadEngine(ftp_scan)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='download') as executor:
+            ok = sum(1 for _, local_file in executor.map(engine.download_one, file_infos) if local_file is not None)
+        seconds = time.perf_counter() - start
+        stats = engine.stats.snapshot()['total']
+    finally:
+        ftp_scan.close()
+    shutil.rmtree(os.path.join(env.down_path, tree), ignore_errors=True)
+    return [{'scenario': 'file_download', 'files': count, 'ok': ok, 'workers': args.workers,
+             'seconds': seconds, 'files_per_sec': count / seconds if seconds else 0.0,
+             'bytes': stats['bytes'], 'bytes_per_sec': stats['bytes'] / seconds if seconds else 0.0}]
+
+
+def bench_zip(env, n, args):
+    from MroParse import MroZipClass, INDEX_SUFFIX
+
+    path = os.path.join(env.workdir, 'bundles', f'bundle_{n}.zip')
+    if not os.path.exists(path):
+        make_bundle(path, n, args.depth, args.members, args.objects)
+    if os.path.exists(path + INDEX_SUFFIX):
+        os.remove(path + INDEX_SUFFIX)
+    with MroZipClass(path, workers=args.zip_workers) as zip_class:
+        start = time.perf_counter()
+        xml_list = zip_class.scan_xml_list()
+        list_seconds = time.perf_counter() - start
+    sample = xml_list[:args.read_max]
+    # 新建对象，从已保存的索引开始读取
+    with MroZipClass(path, workers=args.zip_workers) as zip_class:
+        nbytes = 0
+        start = time.perf_counter()
+        for _, data in zip_class.read_xml_many(sample):
+            nbytes += len(data)
+        read_seconds = time.perf_counter() - start
+    return [{'scenario': 'scan_xml_list', 'files': n, 'xml': len(xml_list), 'bundle_bytes': os.path.getsize(path),
+             'depth': args.depth, 'members': args.members, 'zip_workers': args.zip_workers, 'seconds': list_seconds,
+             'xml_per_sec': len(xml_list) / list_seconds if list_seconds else 0.0},
+            {'scenario': 'read_xml_data', 'files': n, 'xml': len(sample), 'zip_workers': args.zip_workers,
+             'bytes': nbytes, 'seconds': read_seconds,
+             'xml_per_sec': len(sample) / read_seconds if read_seconds else 0.0,
+             'bytes_per_sec': nbytes / read_seconds if read_seconds else 0.0}]
+
+
+def bench_tasks(env, n, args):
+    from SubTasks import MroTask
+
+    async def run():
+        mro_tasks = MroTask()
+        await mro_tasks.connect_to_db('bench', 'bench', '127.0.0.1', 3306)
+        ftp_name = f'tasks_{n}'
+        task_list = [{'main': f'/bench/MRO_{i // 100:07d}.zip', 'path': f'MRO_{i // 10 % 10:04d}.zip',
+                      'xml_file': f'FDD-LTE_MRO_{i}.xml'} for i in range(n)]
+        try:
+            single = task_list[:args.single_max]
+            start = time.perf_counter()
+            for task in single:
+                await mro_tasks.tasks_add(task, ftp_name + '_single')
+            add_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            await mro_tasks.tasks_add_many(task_list, ftp_name)
+            add_many_seconds = time.perf_counter() - start
+
+            claimed = 0
+            start = time.perf_counter()
+            while True:
+                tasks = await mro_tasks.tasks_get(args.claim_size, ftp_name)
+                if not tasks:
+                    break
+                claimed += len(tasks)
+                await mro_tasks.tasks_update_many({task.task_id: 'parsed' for task in tasks}, tasks[0].lease_token)
+            get_seconds = time.perf_counter() - start
+        finally:
+            await mro_tasks.close_db()
+        return [{'scenario': 'tasks_add', 'files': n, 'tasks': len(single), 'seconds': add_seconds,
+                 'tasks_per_sec': len(single) / add_seconds if add_seconds else 0.0},
+                {'scenario': 'tasks_add_many', 'files': n, 'tasks': n, 'seconds': add_many_seconds,
+                 'tasks_per_sec': n / add_many_seconds if add_many_seconds else 0.0},
+                {'scenario': 'tasks_get', 'files': n, 'tasks': claimed, 'claim_size': args.claim_size,
+                 'seconds': get_seconds, 'tasks_per_sec': claimed / get_seconds if get_seconds else 0.0}]
+
+    return asyncio.run(run())
+
+
+SCENARIOS = {'scan': bench_scan, 'download': bench_download, 'zip': bench_zip, 'tasks': bench_tasks}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True,
+                              timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MroSyncParse end-to-end benchmark')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='文件数，逗号分隔')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='scan,download,zip,tasks 的任意组合')
+    parser.add_argument('--workdir', default=None, help='工作目录，默认新建临时目录')
+    parser.add_argument('--keep', action='store_true', help='保留工作目录')
+    parser.add_argument('--output', default=None, help='结果 JSON 文件，默认输出到 stdout')
+    parser.add_argument('--workers', type=int, default=4, help='下载线程数')
+    parser.add_argument('--per-dir', type=int, default=500, help='FTP 目录中每个目录的文件数')
+    parser.add_argument('--download-max', type=int, default=2000, help='下载场景最多下载的文件数')
+    parser.add_argument('--depth', type=int, default=2, help='压缩包嵌套层数')
+    parser.add_argument('--members', type=int, default=10, help='每层子包个数')
+    parser.add_argument('--objects', type=int, default=20, help='每个 XML 的样本数')
+    parser.add_argument('--zip-workers', type=int, default=0, help='压缩包并行解压线程数，0 为顺序解压')
+    parser.add_argument('--read-max', type=int, default=10000, help='read_xml_data 最多读取的 XML 数')
+    parser.add_argument('--single-max', type=int, default=1000, help='tasks_add 逐条插入的最大条数')
+    parser.add_argument('--claim-size', type=int, default=100, help='tasks_get 每次领取的任务数')
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(',') if s]
+    scenarios = [s for s in args.scenarios.split(',') if s]
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error(f'unknown scenario: {scenario}')
+    workdir = args.workdir or tempfile.mkdtemp(prefix='mrobench_')
+    env = BenchEnv(workdir).setup(args.workers)
+    # 项目的配置类使用相对路径，导入前切换到工作目录
+    os.chdir(env.workdir)
+    sys.path.insert(0, REPO_DIR)
+    env.template = os.path.join(env.workdir, 'template.zip')
+    make_bundle(env.template, 2, depth=2, members=2, objects=args.objects)
+
+    results = []
+    try:
+        for n in sizes:
+            for scenario in scenarios:
+                log(f'{scenario} @ {n}')
+                start = time.perf_counter()
+                for result in SCENARIOS[scenario](env, n, args):
+                    results.append(result)
+                    log(json.dumps(result))
+                log(f'{scenario} @ {n} done in {time.perf_counter() - start:.1f}s')
+    finally:
+        env.close()
+        if not args.keep and not args.workdir:
+            os.chdir(REPO_DIR)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    from Metrics import aggregate, registry
+    report = {'meta': {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'commit': git_commit(),
+                       'python': platform.python_version(), 'platform': platform.platform(),
+                       'cpu_count': os.cpu_count(), 'args': vars(args)},
+              'results': results,
+              'metrics': aggregate({'benchmark': registry().snapshot()})}
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(os.path.join(REPO_DIR, args.output) if not os.path.isabs(args.output) else args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
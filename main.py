@@ -1,25 +1,44 @@
 # 这是一个示例 Python 脚本。
 import asyncio
+import json
 import multiprocessing
 import os
 import sys
 import time
 
-from Config import MysqlInfo, FTPInfo, DownLog
+from Config import MysqlInfo, FTPInfo, DownLog, TuneInfo, init_schema
+from Controller import ConcurrencyController
+from Metrics import MetricsServer
 from MroSync import FtpScanProcess
+from ParseWorker import ParseSupervisor
 
 
 async def handle_user_input():
-    global ftp_scan_process
+    global ftp_scan_process, parse_supervisor, metrics_server, controller
     while True:
         cmd = await asyncio.get_event_loop().run_in_executor(None, input, "Enter command (start, stop): ")
         if cmd == "start":
             if ftp_scan_process is None:
                 manager_dict = manager.dict()
                 manager_dict['status'] = True
-                ftp_scan_process = FtpScanProcess(manager_dict)
+                if metrics_server is None and tune.getboolean('Metrics', 'enabled'):
+                    metrics_server = MetricsServer(manager_dict, tune.get('Metrics', 'http_host'),
+                                                   tune.getint('Metrics', 'http_port'),
+                                                   tune.getfloat('Metrics', 'publish_interval'),
+                                                   tune.get('Metrics', 'snapshot_path')).start()
+                # 并发控制依赖汇总的指标，设置通过 manager_dict 传给各进程，/control 接口可随时读取与覆盖
+                # 各进程总会上报指标；未开启 Metrics 时用一个不启动 HTTP 与快照线程的 MetricsServer 汇总
+                if controller is None and tune.getboolean('Control', 'enabled'):
+                    collector = metrics_server or MetricsServer(manager_dict,
+                                                                interval=tune.getfloat('Metrics', 'publish_interval'))
+                    controller = ConcurrencyController(manager_dict, collector.collect, tune).start()
+                    if metrics_server is not None:
+                        metrics_server.controller = controller
+                parse_supervisor = ParseSupervisor(manager_dict)
+                ftp_scan_process = FtpScanProcess(manager_dict, result_queue=parse_supervisor.result_queue)
             if not ftp_scan_process or not ftp_scan_process.is_alive():
                 ftp_scan_process.start()
+                parse_supervisor.start()
                 time.sleep(1)
                 print("Process started.")
 
@@ -32,11 +51,28 @@ async def handle_user_input():
                 ftp_scan_process = None
             else:
                 print("Process is not started.")
+            if parse_supervisor:
+                parse_supervisor.stop()
+                parse_supervisor = None
+            if controller:
+                controller.stop()
+                controller = None
+            if metrics_server:
+                metrics_server.stop()
+                metrics_server = None
         elif cmd == "exit":
             if ftp_scan_process and ftp_scan_process.is_alive():
                 ftp_scan_process.stop()
                 ftp_scan_process.join()
+            if parse_supervisor:
+                parse_supervisor.stop()
+            if controller:
+                controller.stop()
+            if metrics_server:
+                metrics_server.stop()
             sys.exit()
+        elif cmd == 'control':
+            print(json.dumps(controller.snapshot(), indent=2) if controller else "Controller is not running.")
         elif cmd == 'del':
             DownLog().dellog_by_time('2023-03-27 10:00:00')
         else:
@@ -56,7 +92,15 @@ if __name__ == '__main__':
                down_path=os.path.join(os.getcwd(), 'sync'),
                scan_filter='tmp|temp')
     print("MySQL Check:", mysql.check())
+    try:
+        init_schema(mysql)
+    except Exception as e:
+        print("MySQL Schema:", e)
     print("FTP Check:", ftp.check())
     manager = multiprocessing.Manager()
+    tune = TuneInfo()
     ftp_scan_process = None
+    parse_supervisor = None
+    metrics_server = None
+    controller = None
     asyncio.run(handle_user_input())